@@ -1,145 +1,127 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, send_file
-import sqlite3
-import json
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, send_file, Response, stream_with_context
 import datetime
-import uuid
 import os
 from functools import wraps
-from openpyxl import Workbook
-from fpdf import FPDF
-import io
+import click
 from werkzeug.utils import secure_filename
+import db
+from cache import TTLCache
+import log_search
+import receiving
+import exports
+import rollups
+import dates
+import payloads
+import retention
+import tokens
+import idempotency
+import ingest_queue
+import jsonutil
+import migrations
+import metrics
+import pdfs
+import http_cache
+import changes
+import imports
+import reports
+import log_stream
+from log_writer import writer as log_writer
+from ingest_queue import ingest
+import validation
 
 app = Flask(__name__)
 app.secret_key = 'SAG_secret_key_2025'
+app.json = jsonutil.JSONProvider(app)
+app.teardown_appcontext(db.release)
+metrics.install(app)
+http_cache.install(app)
 
-# Ensure database exists function
-def ensure_db_exists():
-    """Ensure database and tables exist before any operation"""
-    try:
-        conn = sqlite3.connect('sagapi_database.db')
-        cursor = conn.cursor()
-        
-        # Check if users table exists
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
-        if not cursor.fetchone():
-            init_db()
+# Log API request/response
+def log_api_request(endpoint, status, response_code, request_body=None, response_body=None, agent_name=None, site=None):
+    with metrics.timer('log_api_request'):
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ip_address = request.remote_addr if request else None
         
-        conn.close()
-    except Exception as e:
-        print(f"Database initialization error: {e}")
-        init_db()
+        # Written in batches by the background log writer, which also serializes the
+        # bodies into payload blobs
+        log_writer.submit((timestamp, endpoint, agent_name, site, status, response_code,
+                           request_body or None, response_body or None, ip_address))
 
-# Database initialization
-def init_db():
-    conn = sqlite3.connect('sagapi_database.db')
-    cursor = conn.cursor()
-    
-    # Create api_logs table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS api_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            endpoint TEXT NOT NULL,
-            agent_name TEXT,
-            site TEXT,
-            status TEXT NOT NULL,
-            response_code INTEGER NOT NULL,
-            request_body TEXT,
-            response_body TEXT,
-            ip_address TEXT
-        )
-    ''')
-    
-    # Create receiving_tbs table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS receiving_tbs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            document_no TEXT UNIQUE NOT NULL,
-            timestamp TEXT NOT NULL,
-            partner_id TEXT NOT NULL,
-            journal_id TEXT NOT NULL,
-            date_order TEXT NOT NULL,
-            officers TEXT NOT NULL,
-            keterangan_description TEXT,
-            driver_name TEXT NOT NULL,
-            vehicle_no TEXT NOT NULL,
-            destination_warehouse_id TEXT NOT NULL,
-            branch_id TEXT NOT NULL,
-            original_payload TEXT
-        )
-    ''')
-    
-    # Create order_line table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS order_line (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            receiving_tbs_id INTEGER NOT NULL,
-            product_code TEXT NOT NULL,
-            qty_brutto REAL NOT NULL,
-            qty_tara REAL NOT NULL,
-            qty_netto REAL NOT NULL,
-            product_uom TEXT NOT NULL,
-            sortation_percent REAL,
-            sortation_weight REAL,
-            qty_netto2 REAL,
-            price_unit REAL NOT NULL,
-            product_qty INTEGER NOT NULL,
-            incoming_date TEXT NOT NULL,
-            outgoing_date TEXT NOT NULL,
-            FOREIGN KEY (receiving_tbs_id) REFERENCES receiving_tbs (id)
-        )
-    ''')
-    
-    # Create users table for login
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            role TEXT DEFAULT 'operator'
-        )
-    ''')
-    
-    # Insert default admin user
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (username, password, role) 
-        VALUES (?, ?, ?)
-    ''', ('admin', 'SAGsecure#2025', 'admin'))
-    
-    conn.commit()
-    conn.close()
+# Columns shown in the /logs list; request/response bodies are only loaded on the detail page
+LOG_LIST_COLUMNS = 'id, timestamp, endpoint, agent_name, site, status, response_code, ip_address'
 
-# Log API request/response
-def log_api_request(endpoint, status, response_code, request_body=None, response_body=None, agent_name=None, site=None):
-    conn = sqlite3.connect('sagapi_database.db')
-    cursor = conn.cursor()
+# Cached COUNT(*) per filter so paging does not rescan the table
+log_count_cache = TTLCache(maxsize=256, ttl=30)
+
+def build_log_filters(search, status_filter, start='', end=''):
+    clauses = ['1=1']
+    params = []
     
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    ip_address = request.remote_addr if request else None
+    # Range on the timestamp text uses the (timestamp, id) index
+    date_clauses, date_params = dates.text_range_clause('timestamp', start, end)
+    clauses.extend(date_clauses)
+    params.extend(date_params)
     
-    cursor.execute('''
-        INSERT INTO api_logs (timestamp, endpoint, agent_name, site, status, response_code, request_body, response_body, ip_address)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (timestamp, endpoint, agent_name, site, status, response_code, 
-          json.dumps(request_body) if request_body else None,
-          json.dumps(response_body) if response_body else None, ip_address))
+    if search and log_search.is_enabled():
+        # Full-text match over log fields and request/response payloads
+        match = log_search.build_match_query(search)
+        if match:
+            clauses.append('id IN (SELECT rowid FROM api_logs_fts WHERE api_logs_fts MATCH ?)')
+            params.append(match)
+    elif search:
+        clauses.append('(endpoint LIKE ? OR agent_name LIKE ? OR site LIKE ?)')
+        search_param = f'%{search}%'
+        params.extend([search_param, search_param, search_param])
     
-    conn.commit()
-    conn.close()
+    if status_filter == 'success':
+        clauses.append('response_code = 200')
+    elif status_filter == 'error':
+        clauses.append('response_code != 200')
+    
+    return ' AND '.join(clauses), params
+
+def count_logs(where, params):
+    def count():
+        cursor = db.get_connection().execute(f'SELECT COUNT(*) FROM api_logs WHERE {where}', params)
+        return cursor.fetchone()[0]
+    return log_count_cache.get_or_set((where, tuple(params)), count)
+
+def make_cursor(timestamp, row_id):
+    return f"{timestamp}|{row_id}"
+
+def parse_cursor(value):
+    timestamp, _, row_id = value.rpartition('|')
+    if not timestamp or not row_id.isdigit():
+        return None
+    return timestamp, int(row_id)
+
+def fetch_keyset_page(cursor, select, where, params, position, direction, per_page):
+    """Fetch one newest-first page keyed on (timestamp, id).
 
-# Generate document number
-def generate_document_no():
-    now = datetime.datetime.now()
-    date_str = now.strftime('%Y/%m/%d')
+    Returns ``(rows, has_prev, has_next)``; the index walk starts at the cursor
+    position instead of skipping over earlier pages.
+    """
+    query = f'{select} WHERE {where}'
+    page_params = list(params)
+    if position and direction == 'prev':
+        query += ' AND (timestamp, id) > (?, ?) ORDER BY timestamp ASC, id ASC LIMIT ?'
+        page_params.extend(position)
+    elif position:
+        query += ' AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?'
+        page_params.extend(position)
+    else:
+        query += ' ORDER BY timestamp DESC, id DESC LIMIT ?'
+    page_params.append(per_page + 1)
     
-    conn = sqlite3.connect('sagapi_database.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM receiving_tbs WHERE DATE(timestamp) = DATE(?)', (now.strftime('%Y-%m-%d'),))
-    count = cursor.fetchone()[0] + 1
-    conn.close()
+    cursor.execute(query, page_params)
+    rows = cursor.fetchall()
     
-    return f"TBS/{date_str}/{count:03d}"
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if position and direction == 'prev':
+        rows.reverse()
+        return rows, has_more, True
+    return rows, position is not None, has_more
 
 # Login required decorator
 def login_required(f):
@@ -153,8 +135,6 @@ def login_required(f):
 # Routes
 @app.route('/')
 def index():
-    # Ensure database exists on first access
-    ensure_db_exists()
     return redirect(url_for('dashboard'))
 
 # API Health Check Endpoints for Testing
@@ -189,17 +169,13 @@ def api_test():
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        # Ensure database exists before login attempt
-        ensure_db_exists()
-        
         username = request.form['username']
         password = request.form['password']
         
-        conn = sqlite3.connect('sagapi_database.db')
+        conn = db.get_connection()
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM users WHERE username = ? AND password = ?', (username, password))
         user = cursor.fetchone()
-        conn.close()
         
         if user:
             session['logged_in'] = True
@@ -219,173 +195,421 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    conn = sqlite3.connect('sagapi_database.db')
-    cursor = conn.cursor()
+    start = request.args.get('start', '')
+    end = request.args.get('end', '')
+    try:
+        dates.day_range(start, end)
+    except ValueError as e:
+        return str(e), 400
+    
+    stats = dashboard_cache.get_or_set(('dashboard', start, end), lambda: load_dashboard(start, end))
+    # Only a range that reaches today can still grow, so only then follow /logs/stream
+    live = not end or end >= datetime.date.today().isoformat()
+    return render_template('dashboard.html', start=start, end=end, live=live, **stats)
+
+# Short-lived cache of the assembled dashboard payload
+dashboard_cache = TTLCache(maxsize=32, ttl=float(os.environ.get('SAGAPI_DASHBOARD_TTL', 10)))
+
+def load_dashboard(start='', end=''):
+    # One snapshot, so the live stream resumes exactly after the rows the counters include
+    with db.snapshot() as conn:
+        cursor = conn.cursor()
+        
+        # Counters and chart data come from the incrementally maintained rollups
+        stats = rollups.dashboard_stats(conn, start, end)
+        
+        # Get recent transactions (walks the timestamp index, counts lines per header)
+        cursor.execute('''
+            SELECT r.document_no, r.partner_id, r.timestamp, r.driver_name, 
+                   (SELECT COUNT(*) FROM order_line ol WHERE ol.receiving_tbs_id = r.id) as line_count
+            FROM receiving_tbs r
+            ORDER BY r.timestamp DESC
+            LIMIT 10
+        ''')
+        stats['recent_transactions'] = cursor.fetchall()
+        
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM api_logs')
+        stats['last_log_id'] = cursor.fetchone()[0]
     
-    # Get statistics
-    cursor.execute('SELECT COUNT(*) FROM api_logs')
-    total_requests = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM api_logs WHERE response_code = 200')
-    success_requests = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM api_logs WHERE response_code != 200')
-    failed_requests = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM receiving_tbs')
-    total_tbs = cursor.fetchone()[0]
-    
-    # Get recent transactions
-    cursor.execute('''
-        SELECT r.document_no, r.partner_id, r.timestamp, r.driver_name, 
-               COUNT(ol.id) as line_count
-        FROM receiving_tbs r
-        LEFT JOIN order_line ol ON r.id = ol.receiving_tbs_id
-        GROUP BY r.id
-        ORDER BY r.timestamp DESC
-        LIMIT 10
-    ''')
-    recent_transactions = cursor.fetchall()
-    
-    # Get daily stats for chart
-    cursor.execute('''
-        SELECT DATE(timestamp) as date, COUNT(*) as count,
-               SUM(CASE WHEN response_code = 200 THEN 1 ELSE 0 END) as success
-        FROM api_logs
-        WHERE DATE(timestamp) >= DATE('now', '-7 days')
-        GROUP BY DATE(timestamp)
-        ORDER BY date
-    ''')
-    daily_stats = cursor.fetchall()
-    
-    conn.close()
-    
-    return render_template('dashboard.html', 
-                         total_requests=total_requests,
-                         success_requests=success_requests,
-                         failed_requests=failed_requests,
-                         total_tbs=total_tbs,
-                         recent_transactions=recent_transactions,
-                         daily_stats=daily_stats)
+    return stats
 
 @app.route('/logs')
 @login_required
 def logs():
-    page = request.args.get('page', 1, type=int)
     per_page = 20
     search = request.args.get('search', '')
     status_filter = request.args.get('status', '')
+    start = request.args.get('start', '')
+    end = request.args.get('end', '')
+    direction = request.args.get('dir', 'next')
+    position = parse_cursor(request.args.get('cursor', ''))
     
-    conn = sqlite3.connect('sagapi_database.db')
+    conn = db.get_connection()
     cursor = conn.cursor()
     
-    query = 'SELECT * FROM api_logs WHERE 1=1'
-    params = []
-    
-    if search:
-        query += ' AND (endpoint LIKE ? OR agent_name LIKE ? OR site LIKE ?)'
-        search_param = f'%{search}%'
-        params.extend([search_param, search_param, search_param])
-    
-    if status_filter:
-        if status_filter == 'success':
-            query += ' AND response_code = 200'
-        elif status_filter == 'error':
-            query += ' AND response_code != 200'
-    
-    query += ' ORDER BY timestamp DESC'
-    
-    cursor.execute(query, params)
-    all_logs = cursor.fetchall()
+    try:
+        where, params = build_log_filters(search, status_filter, start, end)
+    except ValueError as e:
+        return str(e), 400
     
-    total = len(all_logs)
-    start = (page - 1) * per_page
-    end = start + per_page
-    logs_page = all_logs[start:end]
+    logs_page, has_prev, has_next = fetch_keyset_page(
+        cursor, f'SELECT {LOG_LIST_COLUMNS} FROM api_logs', where, params, position, direction, per_page)
     
-    conn.close()
+    total = count_logs(where, params)
     
     return render_template('logs.html', 
                          logs=logs_page,
-                         page=page,
                          total=total,
                          per_page=per_page,
                          search=search,
-                         status_filter=status_filter)
+                         status_filter=status_filter,
+                         start=start,
+                         end=end,
+                         prev_cursor=make_cursor(logs_page[0][1], logs_page[0][0]) if has_prev and logs_page else None,
+                         next_cursor=make_cursor(logs_page[-1][1], logs_page[-1][0]) if has_next and logs_page else None)
+
+@app.route('/logs/stream')
+@login_required
+def logs_stream():
+    """Server-Sent Events of new api_logs rows, optionally filtered by endpoint, status and site.
+
+    Resumes after ``Last-Event-ID`` (sent by EventSource on reconnect) or ``?last_id=``.
+    """
+    filters = {key: request.args[key] for key in log_stream.FILTERS if request.args.get(key)}
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_id')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return jsonify({"code": 400, "message": f"Invalid last event id '{last_id}'"}), 400
+    
+    subscribed = log_stream.hub.subscribe(filters, last_id)
+    if subscribed is None:
+        response = jsonify({"code": 503, "message": "Too many live log subscribers, try again later"})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    
+    # Not stream_with_context: the request's database connection is released before streaming starts
+    return Response(log_stream.hub.events(*subscribed), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/logs/search')
+@login_required
+def api_logs_search():
+    """Ranked full-text search over api_logs (best match first)"""
+    q = request.args.get('q', '')
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    offset = request.args.get('offset', 0, type=int)
+    
+    if not log_search.is_enabled():
+        return jsonify({"code": 503, "message": "Full-text search is not available"}), 503
+    
+    hits = log_search.search(q, limit=limit, offset=offset)
+    keys = ('id', 'timestamp', 'endpoint', 'agent_name', 'site', 'status', 'response_code',
+            'ip_address', 'score', 'snippet')
+    return jsonify({
+        "code": 200,
+        "query": q,
+        "result": [dict(zip(keys, hit)) for hit in hits]
+    }), 200
+
+@app.route('/api/reports')
+@login_required
+def api_reports():
+    """Available reports with their group keys and columns"""
+    return jsonify({"code": 200, "result": reports.catalog()}), 200
+
+@app.route('/api/reports/<name>')
+@login_required
+def api_report(name):
+    """Grouped order line totals (?start=&end=&basis= as in the exports, ?format=json|csv)"""
+    if name not in reports.REPORTS:
+        return jsonify({"code": 404, "message": f"Unknown report: {name}"}), 404
+    fmt = request.args.get('format', 'json')
+    if fmt not in ('json', 'csv'):
+        return jsonify({"code": 400, "message": f"Unsupported report format: {fmt}"}), 400
+    basis = request.args.get('basis') or 'created'
+    start = request.args.get('start', '')
+    end = request.args.get('end', '')
+    
+    try:
+        with metrics.timer(f'report_{name}'):
+            frame = reports.run(db.get_connection(), name, basis, start, end)
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+    
+    columns = reports.columns(name)
+    if fmt == 'csv':
+        suffix = '_'.join(part for part in (start, end) if part) or 'all'
+        return Response(exports.stream_csv(columns, reports.rows(frame)), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename=report_{name}_{suffix}.csv'})
+    return jsonify({
+        "code": 200,
+        "report": name,
+        "basis": basis,
+        "start": start,
+        "end": end,
+        "columns": columns,
+        "result": [dict(zip(columns, row)) for row in reports.rows(frame)]
+    }), 200
 
 @app.route('/log/<int:log_id>')
 @login_required
 def log_detail(log_id):
-    conn = sqlite3.connect('sagapi_database.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM api_logs WHERE id = ?', (log_id,))
-    log = cursor.fetchone()
-    conn.close()
-    
-    if not log:
+    conn = db.get_connection()
+    row = conn.execute('SELECT timestamp FROM api_logs WHERE id = ?', (log_id,)).fetchone()
+    if not row:
         return "Log not found", 404
     
-    return render_template('log_detail.html', log=log)
+    def render():
+        # Bodies are decompressed here only, never for the list pages
+        log = conn.execute(f'''
+            SELECT id, timestamp, endpoint, agent_name, site, status, response_code,
+                   {payloads.sql_text('request_body', 'request_hash')},
+                   {payloads.sql_text('response_body', 'response_hash')},
+                   ip_address
+            FROM api_logs WHERE id = ?
+        ''', (log_id,)).fetchone()
+        return render_template('log_detail.html', log=log)
+    
+    # Log rows never change: revisits get a 304 or the cached page
+    return http_cache.record_response('log', log_id, row[0], render)
 
 @app.route('/transactions')
 @login_required
 def transactions():
-    conn = sqlite3.connect('sagapi_database.db')
+    per_page = 50
+    direction = request.args.get('dir', 'next')
+    position = parse_cursor(request.args.get('cursor', ''))
+    filters = {key: request.args.get(key, '').strip() for key in ('start', 'end', 'basis', 'partner', 'branch')}
+    
+    try:
+        where, params = build_transaction_filters(filters)
+    except ValueError as e:
+        return str(e), 400
+    
+    conn = db.get_connection()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT r.*, 
-               COALESCE(COUNT(ol.id), 0) as line_count,
-               COALESCE(SUM(ol.qty_netto2), 0) as total_netto,
-               COALESCE(SUM(ol.qty_netto2 * ol.price_unit), 0) as total_value
-        FROM receiving_tbs r
-        LEFT JOIN order_line ol ON r.id = ol.receiving_tbs_id
-        GROUP BY r.id
-        ORDER BY r.timestamp DESC
-    ''')
-    raw_transactions = cursor.fetchall()
-    
-    # Convert to list and ensure numeric values
-    transactions = []
-    for t in raw_transactions:
-        transaction = list(t)
-        # Make sure line_count (index 13), total_netto (index 14), total_value (index 15) are numeric
-        transaction[13] = int(transaction[13]) if transaction[13] is not None else 0
-        transaction[14] = float(transaction[14]) if transaction[14] is not None else 0.0
-        transaction[15] = float(transaction[15]) if transaction[15] is not None else 0.0
-        transactions.append(tuple(transaction))
-    
-    conn.close()
-    
-    return render_template('transactions.html', transactions=transactions)
+    # Totals are stored on the header at insert time, so no join with order_line
+    transactions, has_prev, has_next = fetch_keyset_page(
+        cursor, f'SELECT {TRANSACTION_LIST_COLUMNS} FROM receiving_tbs', where, params,
+        position, direction, per_page)
+    
+    totals = transaction_totals_cache.get_or_set((where, tuple(params)), lambda: transaction_totals(where, params))
+    
+    return render_template('transactions.html',
+                         transactions=transactions,
+                         totals=totals,
+                         filters=filters,
+                         reports=reports.catalog(),
+                         prev_cursor=make_cursor(transactions[0][2], transactions[0][0]) if has_prev and transactions else None,
+                         next_cursor=make_cursor(transactions[-1][2], transactions[-1][0]) if has_next and transactions else None)
+
+# Columns shown in the /transactions list (original_payload is left out)
+TRANSACTION_LIST_COLUMNS = ('id, document_no, timestamp, partner_id, driver_name, vehicle_no, branch_id, '
+                            'line_count, total_netto, total_value')
+
+# Grand totals per filter, refreshed every 30s
+transaction_totals_cache = TTLCache(maxsize=256, ttl=30)
+
+def build_transaction_filters(filters):
+    clauses = ['1=1']
+    params = []
+    
+    # Created date ranges scan the timestamp index, order date ranges the date_order_epoch index
+    date_clauses, date_params = exports.date_clause(
+        'receiving_tbs', filters['basis'] or 'created', filters['start'], filters['end'])
+    clauses.extend(date_clauses)
+    params.extend(date_params)
+    if filters['partner']:
+        clauses.append('partner_id = ?')
+        params.append(filters['partner'])
+    if filters['branch']:
+        clauses.append('branch_id = ?')
+        params.append(filters['branch'])
+    
+    return ' AND '.join(clauses), params
+
+def transaction_totals(where, params):
+    cursor = db.get_connection().execute(f'''
+        SELECT COUNT(*), COALESCE(SUM(line_count), 0), COALESCE(SUM(total_netto), 0), COALESCE(SUM(total_value), 0)
+        FROM receiving_tbs WHERE {where}
+    ''', params)
+    count, lines, netto, value = cursor.fetchone()
+    return {'transactions': count, 'lines': lines, 'netto': netto, 'value': value}
 
 @app.route('/transaction/<int:transaction_id>')
 @login_required
 def transaction_detail(transaction_id):
-    conn = sqlite3.connect('sagapi_database.db')
-    cursor = conn.cursor()
-    
-    # Get transaction header
-    cursor.execute('''
-        SELECT * FROM receiving_tbs WHERE id = ?
-    ''', (transaction_id,))
-    transaction = cursor.fetchone()
-    
-    if not transaction:
+    conn = db.get_connection()
+    row = conn.execute('SELECT timestamp FROM receiving_tbs WHERE id = ?', (transaction_id,)).fetchone()
+    if not row:
         return "Transaction not found", 404
     
-    # Get order lines
-    cursor.execute('''
-        SELECT * FROM order_line WHERE receiving_tbs_id = ?
-        ORDER BY id
-    ''', (transaction_id,))
-    order_lines = cursor.fetchall()
+    def render():
+        cursor = conn.cursor()
+        
+        # Get transaction header
+        cursor.execute('''
+            SELECT * FROM receiving_tbs WHERE id = ?
+        ''', (transaction_id,))
+        transaction = cursor.fetchone()
+        
+        # Get order lines
+        cursor.execute('''
+            SELECT * FROM order_line WHERE receiving_tbs_id = ?
+            ORDER BY id
+        ''', (transaction_id,))
+        order_lines = cursor.fetchall()
+        
+        return render_template('transaction_detail.html', 
+                             transaction=transaction, 
+                             order_lines=order_lines)
     
-    conn.close()
+    # Receiving TBS records are write-once: revisits get a 304 or the cached page
+    return http_cache.record_response('transaction', transaction_id, row[0], render)
+
+@app.route('/transaction/<int:transaction_id>/payload')
+@login_required
+def transaction_payload(transaction_id):
+    """Original agent payload, decompressed on demand from the detail page"""
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT original_payload, payload_hash FROM receiving_tbs WHERE id = ?', (transaction_id,))
+    row = cursor.fetchone()
     
-    return render_template('transaction_detail.html', 
-                         transaction=transaction, 
-                         order_lines=order_lines)
+    if not row:
+        return "Transaction not found", 404
+    
+    text = row[0] or payloads.load(conn, row[1])
+    if not text:
+        return "No payload stored for this transaction", 404
+    return Response(text, mimetype='application/json')
+
+@app.route('/transaction/<int:transaction_id>/pdf')
+@login_required
+def transaction_pdf(transaction_id):
+    """Printable slip, rendered once per document and served from the PDF cache"""
+    with metrics.timer('transaction_pdf'):
+        found = pdfs.slip_path(db.get_connection(), transaction_id)
+    if found is None:
+        return "Transaction not found", 404
+    document_no, path = found
+    return send_file(path, mimetype='application/pdf', download_name=pdfs.filename(document_no),
+                     as_attachment=request.args.get('download') == '1', max_age=86400)
+
+@app.route('/admin/db/stats')
+@login_required
+def db_stats():
+    """Connection pool and lock-wait statistics for this worker"""
+    return jsonify(db.stats()), 200
+
+@app.route('/admin/log-writer/stats')
+@login_required
+def log_writer_stats():
+    """Queue depth and flush latency of the background api_logs writer"""
+    return jsonify(log_writer.stats()), 200
+
+@app.route('/admin/ingest/stats')
+@login_required
+def ingest_stats():
+    """Pending tickets and batch latency of the asynchronous ingest queue"""
+    return jsonify(ingest.stats()), 200
+
+@app.route('/admin/log-stream/stats')
+@login_required
+def log_stream_stats():
+    """Subscribers and broadcast counts of this worker's live log tail"""
+    return jsonify(log_stream.hub.stats()), 200
+
+@app.route('/admin/reports/stats')
+@login_required
+def reports_stats():
+    """Report cache hit rate and computation times"""
+    return jsonify(reports.stats()), 200
+
+@app.route('/admin/page-cache/stats')
+@login_required
+def page_cache_stats():
+    """Rendered detail page cache statistics for this worker"""
+    return jsonify(dict(http_cache.pages.stats(), template_version=http_cache.TEMPLATE_VERSION)), 200
+
+@app.route('/admin/tokens/stats')
+@login_required
+def token_stats():
+    """Token validation cache statistics for this worker"""
+    return jsonify(tokens.stats()), 200
+
+@app.route('/admin/idempotency/stats')
+@login_required
+def idempotency_stats():
+    """Replay cache statistics for this worker"""
+    return jsonify(idempotency.stats()), 200
+
+@app.route('/admin/retention')
+@login_required
+def retention_admin():
+    """Hot api_logs partitions, database size and archive files"""
+    stats = retention.partition_stats()
+    if request.args.get('format') == 'json':
+        return jsonify(stats), 200
+    return render_template('retention.html', stats=stats)
+
+@app.route('/admin/slow-queries')
+@login_required
+def slow_queries_admin():
+    """Slowest SQL statements across all workers"""
+    order = request.args.get('order', 'max')
+    if order not in ('max', 'total', 'avg'):
+        order = 'max'
+    stats = metrics.slow_queries(order, request.args.get('limit', 50, type=int))
+    if request.args.get('format') == 'json':
+        return jsonify(stats), 200
+    return render_template('slow_queries.html', stats=stats)
+
+@app.route('/admin/import', methods=['GET', 'POST'])
+@login_required
+def import_receiving_tbs():
+    """Upload of receiving TBS tickets from XLSX or CSV; progress and errors are streamed as NDJSON"""
+    if request.method == 'GET':
+        return render_template('import.html', columns=validation.ORDER_COLUMNS + imports.LINE_FIELDS,
+                               required=imports.REQUIRED_COLUMNS, batch_size=imports.BATCH_SIZE)
+
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({"code": 400, "message": "No file uploaded"}), 400
+    filename = secure_filename(upload.filename)
+    try:
+        # Werkzeug spools large uploads to a temporary file, which is read as a stream
+        columns, rows = imports.open_rows(upload.stream, imports.detect_format(filename))
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+
+    username = session.get('username')
+
+    def events():
+        summary = None
+        for event in imports.run(columns, rows, filename):
+            if event['event'] == 'done':
+                summary = event
+            yield event
+        # Same codes as a batch create: 207 when only some orders were stored (now or by an earlier upload)
+        code = 200 if not summary['failed'] else 207 if summary['created'] or summary['skipped'] else 400
+        log_api_request('/admin/import', 'success' if code == 200 else 'error', code,
+                        {"file": filename}, summary, agent_name=username)
+
+    return Response(
+        stream_with_context(metrics.timed_stream('import_receiving_tbs', imports.stream_ndjson(events()))),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint, summed over all gunicorn workers"""
+    if not metrics.authorized(tokens.bearer_token(request.headers.get('Authorization'))):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # API Endpoints
 @app.route('/api/auth/login', methods=['POST'])
@@ -414,25 +638,24 @@ def api_login():
             return jsonify(response), 400
         
         # Check credentials
-        if login != 'admin' or password != 'SAGsecure#2025':
+        cursor = db.get_connection().execute('SELECT id FROM users WHERE username = ? AND password = ?',
+                                             (login, password))
+        if not cursor.fetchone():
             response = {"code": 400, "message": "Invalid Login: Incorrect user or password."}
             log_api_request('/api/auth/login', 'error', 400, data, response)
             return jsonify(response), 400
         
-        # Generate tokens
-        access_token = str(uuid.uuid4())
-        refresh_token = str(uuid.uuid4())
-        
+        # Issue and store tokens
         response = {
             "code": 200,
             "message": "Login Successful",
-            "token": {
-                "access_token": access_token,
-                "refresh_token": refresh_token
-            }
+            "token": tokens.issue(login, database)
         }
         
-        log_api_request('/api/auth/login', 'success', 200, data, response, login, database)
+        # Issued tokens are credentials: keep them out of api_logs
+        logged = dict(response, token={key: '***' if key.endswith('_token') else value
+                                       for key, value in response['token'].items()})
+        log_api_request('/api/auth/login', 'success', 200, data, logged, login, database)
         return jsonify(response), 200
         
     except Exception as e:
@@ -440,12 +663,52 @@ def api_login():
         log_api_request('/api/auth/login', 'error', 500, request.get_json(), response)
         return jsonify(response), 500
 
+@app.route('/api/auth/refresh', methods=['POST'])
+def api_refresh_token():
+    """Rotate a refresh token into a new access/refresh pair"""
+    data = request.get_json(silent=True) or {}
+    refresh_token = data.get('refresh_token')
+    
+    if not refresh_token:
+        response = {"code": 400, "message": "Missing required field: refresh_token"}
+        log_api_request('/api/auth/refresh', 'error', 400, None, response)
+        return jsonify(response), 400
+    
+    token = tokens.refresh(refresh_token)
+    if token is None:
+        response = {"code": 401, "message": "Invalid or expired refresh token"}
+        log_api_request('/api/auth/refresh', 'error', 401, None, response)
+        return jsonify(response), 401
+    
+    response = {"code": 200, "message": "Token Refreshed", "token": token}
+    log_api_request('/api/auth/refresh', 'success', 200, None, {"code": 200, "message": "Token Refreshed"})
+    return jsonify(response), 200
+
+@app.route('/api/auth/revoke', methods=['POST'])
+def api_revoke_token():
+    """Revoke the presented token together with the rest of its login session"""
+    data = request.get_json(silent=True) or {}
+    token = tokens.bearer_token(request.headers.get('Authorization')) or data.get('token') or data.get('refresh_token')
+    
+    if not token or not tokens.revoke(token=token):
+        response = {"code": 401, "message": "Invalid or expired token"}
+        log_api_request('/api/auth/revoke', 'error', 401, None, response)
+        return jsonify(response), 401
+    
+    response = {"code": 200, "message": "Token revoked"}
+    log_api_request('/api/auth/revoke', 'success', 200, None, response)
+    return jsonify(response), 200
+
+def authenticate(token_from_body=None):
+    """Claims of the request's access token (Authorization header, else body), or None"""
+    return tokens.validate(tokens.bearer_token(request.headers.get('Authorization')) or token_from_body)
+
 @app.route('/api/receiving-tbs/create', methods=['POST'])
 def api_create_receiving_tbs():
     try:
         data = request.get_json()
         
-        if not data:
+        if not data or not isinstance(data, dict):
             response = {"code": 400, "message": "Invalid JSON payload"}
             log_api_request('/api/receiving-tbs/create', 'error', 400, data, response)
             return jsonify(response), 400
@@ -459,129 +722,176 @@ def api_create_receiving_tbs():
             log_api_request('/api/receiving-tbs/create', 'error', 401, data, response)
             return jsonify(response), 401
         
-        # Extract order data
-        params = data.get('params', {})
-        order_data = params.get('order_data', [])
+        claims = authenticate(token_from_body)
+        if claims is None:
+            response = {"code": 401, "message": "Invalid or expired token"}
+            log_api_request('/api/receiving-tbs/create', 'error', 401, data, response)
+            return jsonify(response), 401
         
-        if not order_data:
-            response = {"code": 400, "message": "order_data is required"}
+        # Extract order data
+        order_data, errors = validation.order_data_of(data)
+        if errors:
+            response = {"code": 400, "message": errors[0]['message'], "errors": errors}
             log_api_request('/api/receiving-tbs/create', 'error', 400, data, response)
             return jsonify(response), 400
         
-        order = order_data[0]  # Take first order
-        
-        # Validate required fields
-        required_fields = ['partner_id', 'journal_id', 'date_order', 'officers', 
-                          'driver_name', 'vehicle_no', 'destination_warehouse_id', 'branch_id']
+        # A resent ticket gets the stored response instead of a second document
+        key = idempotency.request_key('/api/receiving-tbs/create', request.headers.get('Idempotency-Key'),
+                                      claims['login'], data)
+        order = order_data[0] if isinstance(order_data[0], dict) else {}
+        if ingest.wants_async(request.headers.get('Prefer')):
+            return queue_receiving_tbs(key, order_data, data, claims['login'], order)
         
-        for field in required_fields:
-            if not order.get(field):
-                if field == 'driver_name':
-                    response = {"code": 400, "message": "Missing Driver Name. Please fill in this information."}
-                elif field == 'partner_id':
-                    response = {"code": 400, "message": "Sorry, we couldn't find a valid partner with the information provided."}
-                else:
-                    response = {"code": 400, "message": f"Missing required field: {field}"}
-                log_api_request('/api/receiving-tbs/create', 'error', 400, data, response)
-                return jsonify(response), 400
+        response, code, replayed = idempotency.run(key, lambda: receiving.create_response(order_data, data))
+        log_create_request(order_data, order, data, response, code)
+        return jsonify(response), code, {'Idempotent-Replayed': 'true'} if replayed else {}
         
-        # Validate order lines
-        order_lines = order.get('order_line', [])
-        if not order_lines:
-            response = {"code": 400, "message": "At least one order line is required"}
-            log_api_request('/api/receiving-tbs/create', 'error', 400, data, response)
+    except Exception as e:
+        response = {"code": 500, "message": f"Internal server error: {str(e)}"}
+        log_api_request('/api/receiving-tbs/create', 'error', 500, request.get_json(), response)
+        return jsonify(response), 500
+
+def queue_receiving_tbs(key, order_data, data, login, order):
+    """Validate a create request and queue it for the ingest workers (202 + ticket)"""
+    def produce():
+        # A ticket without a single valid order gets its final answer right away
+        if all(validation.validate_order(item)[1] for item in order_data):
+            return receiving.create_response(order_data, data)
+        try:
+            ticket = ingest.enqueue(data, login, order.get('partner_id'), order.get('branch_id'), request.remote_addr)
+        except ingest_queue.QueueFull:
+            return {"code": 503, "message": "Too many tickets are waiting. Please retry later."}, 503
+        return {
+            "code": 202,
+            "message": "Receiving TBS queued.",
+            "result": {
+                "ticket": ticket,
+                "status_url": url_for('api_receiving_tbs_status', ticket=ticket)
+            }
+        }, 202
+    
+    response, code, replayed = idempotency.run(key, produce)
+    headers = {'Idempotent-Replayed': 'true'} if replayed else {}
+    if code == 202:
+        # The drain thread logs the ticket once its orders are created
+        ingest.notify()
+        headers.update({'Location': response['result']['status_url'], 'Retry-After': '1'})
+    else:
+        log_create_request(order_data, order, data, response, code)
+        if code == 503:
+            headers['Retry-After'] = '5'
+    return jsonify(response), code, headers
+
+def log_create_request(order_data, order, data, response, code):
+    if code == 200 or len(order_data) > 1:
+        log_api_request('/api/receiving-tbs/create', 'success' if code == 200 else 'error', code, data, response,
+                       order.get('partner_id'), order.get('branch_id'))
+    else:
+        log_api_request('/api/receiving-tbs/create', 'error', code, data, response)
+
+@app.route('/api/receiving-tbs/status/<ticket>', methods=['GET'])
+def api_receiving_tbs_status(ticket):
+    """Outcome of a queued create request; polls are not written to api_logs"""
+    if not request.headers.get('Authorization'):
+        return jsonify({"code": 401, "message": "Authorization header required"}), 401
+    claims = authenticate()
+    if claims is None:
+        return jsonify({"code": 401, "message": "Invalid or expired token"}), 401
+    
+    found = ingest.status(ticket, claims['login'])
+    if found is None:
+        return jsonify({"code": 404, "message": "Ticket not found"}), 404
+    status, code, response = found
+    if status == 'queued':
+        return jsonify({"code": 202, "message": "Receiving TBS is queued.", "ticket": ticket, "status": status}), 202, \
+            {'Retry-After': '1'}
+    return jsonify(dict(response, ticket=ticket, status=status)), code
+
+@app.route('/api/receiving-tbs/changes', methods=['GET'])
+def api_receiving_tbs_changes():
+    """NDJSON feed of receiving TBS created after ``?since=<cursor>``; polls are not written to api_logs"""
+    if not request.headers.get('Authorization'):
+        return jsonify({"code": 401, "message": "Authorization header required"}), 401
+    if authenticate() is None:
+        return jsonify({"code": 401, "message": "Invalid or expired token"}), 401
+    
+    try:
+        since = changes.parse_cursor(request.args.get('since', ''))
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+    limit = min(max(request.args.get('limit', changes.DEFAULT_LIMIT, type=int), 1), changes.MAX_LIMIT)
+    wait = min(max(request.args.get('wait', 0, type=int), 0), changes.MAX_WAIT)
+    
+    conn = db.get_connection()
+    changes.wait_for_changes(conn, since, wait)
+    last_id, has_more = changes.page(conn, since, limit)
+    
+    records = changes.iter_records(conn, since, last_id)
+    return Response(
+        stream_with_context(metrics.timed_stream('changes_receiving_tbs', changes.stream_ndjson(records))),
+        mimetype='application/x-ndjson',
+        headers={'X-Next-Cursor': str(last_id), 'X-Has-More': 'true' if has_more else 'false',
+                 'Cache-Control': 'no-store'}
+    )
+
+@app.route('/api/receiving-tbs/batch', methods=['POST'])
+def api_batch_receiving_tbs():
+    """Create many orders at once from a JSON array or NDJSON body"""
+    try:
+        try:
+            entries, token_from_body = receiving.parse_batch(request.get_data(as_text=True))
+        except ValueError as e:
+            response = {"code": 400, "message": f"Invalid batch payload: {e}"}
+            log_api_request('/api/receiving-tbs/batch', 'error', 400, None, response)
             return jsonify(response), 400
         
-        for line in order_lines:
-            if not line.get('incoming_date') or not line.get('outgoing_date'):
-                response = {"code": 400, "message": "Please provide the correct incoming date and outgoing date."}
-                log_api_request('/api/receiving-tbs/create', 'error', 400, data, response)
-                return jsonify(response), 400
-        
-        # Save to database
-        conn = sqlite3.connect('sagapi_database.db')
-        cursor = conn.cursor()
-        
-        document_no = generate_document_no()
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        ticket_payloads = [payload for _, payload in entries]
         
-        # Insert receiving_tbs
-        cursor.execute('''
-            INSERT INTO receiving_tbs 
-            (document_no, timestamp, partner_id, journal_id, date_order, officers, 
-             keterangan_description, driver_name, vehicle_no, destination_warehouse_id, branch_id, original_payload)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (document_no, timestamp, order['partner_id'], order['journal_id'],
-              order['date_order'], order['officers'], order.get('keterangan_description', ''),
-              order['driver_name'], order['vehicle_no'], order['destination_warehouse_id'],
-              order['branch_id'], json.dumps(data, indent=2)))
-        
-        receiving_tbs_id = cursor.lastrowid
-        
-        # Insert order lines
-        for line in order_lines:
-            cursor.execute('''
-                INSERT INTO order_line 
-                (receiving_tbs_id, product_code, qty_brutto, qty_tara, qty_netto, product_uom,
-                 sortation_percent, sortation_weight, qty_netto2, price_unit, product_qty,
-                 incoming_date, outgoing_date)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (receiving_tbs_id, line['product_code'], line['qty_brutto'], line['qty_tara'],
-                  line['qty_netto'], line['product_uom'], line.get('sortation_percent', 0),
-                  line.get('sortation_weight', 0), line.get('qty_netto2', line['qty_netto']),
-                  line['price_unit'], line['product_qty'], line['incoming_date'], line['outgoing_date']))
+        # Check authorization - either from header or body
+        if not request.headers.get('Authorization') and not token_from_body:
+            response = {"code": 401, "message": "Authorization header or token in body required"}
+            log_api_request('/api/receiving-tbs/batch', 'error', 401, ticket_payloads, response)
+            return jsonify(response), 401
         
-        conn.commit()
-        conn.close()
+        claims = authenticate(token_from_body)
+        if claims is None:
+            response = {"code": 401, "message": "Invalid or expired token"}
+            log_api_request('/api/receiving-tbs/batch', 'error', 401, ticket_payloads, response)
+            return jsonify(response), 401
         
-        response = {
-            "code": 200,
-            "message": "Receiving TBS created successfully.",
-            "result": {
-                "document_no": document_no
-            }
-        }
+        if not entries:
+            response = {"code": 400, "message": "order_data is required"}
+            log_api_request('/api/receiving-tbs/batch', 'error', 400, ticket_payloads, response)
+            return jsonify(response), 400
         
-        log_api_request('/api/receiving-tbs/create', 'success', 200, data, response, 
-                       order.get('partner_id'), order.get('branch_id'))
-        return jsonify(response), 200
+        key = idempotency.request_key('/api/receiving-tbs/batch', request.headers.get('Idempotency-Key'),
+                                      claims['login'], ticket_payloads)
+        response, code, replayed = idempotency.run(key, lambda: receiving.batch_response(receiving.create_orders(entries)))
+        log_api_request('/api/receiving-tbs/batch', 'success' if code == 200 else 'error', code,
+                       ticket_payloads, response)
+        return jsonify(response), code, {'Idempotent-Replayed': 'true'} if replayed else {}
         
     except Exception as e:
         response = {"code": 500, "message": f"Internal server error: {str(e)}"}
-        log_api_request('/api/receiving-tbs/create', 'error', 500, request.get_json(), response)
+        log_api_request('/api/receiving-tbs/batch', 'error', 500, None, response)
         return jsonify(response), 500
 
 # Export functions
 @app.route('/export/logs/excel')
 @login_required
 def export_logs_excel():
-    conn = sqlite3.connect('sagapi_database.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM api_logs ORDER BY timestamp DESC')
-    logs = cursor.fetchall()
-    
-    # Get column names
-    cursor.execute('PRAGMA table_info(api_logs)')
-    columns = [column[1] for column in cursor.fetchall()]
-    conn.close()
+    conn = db.get_connection()
     
-    # Create workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "API Logs"
-    
-    # Add headers
-    for col, header in enumerate(columns, 1):
-        ws.cell(row=1, column=col, value=header)
-    
-    # Add data
-    for row, data in enumerate(logs, 2):
-        for col, value in enumerate(data, 1):
-            ws.cell(row=row, column=col, value=value)
+    try:
+        query, params, columns = exports.build_query(conn, 'api_logs', request.args, 'timestamp DESC')
+    except ValueError as e:
+        return str(e), 400
     
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+    # Rows stream from the cursor into a write-only workbook spooled on disk
+    with metrics.timer('export_logs_xlsx'):
+        output = exports.write_workbook([
+            ("API Logs", columns, exports.iter_rows(conn, query, params))
+        ])
     
     return send_file(
         output,
@@ -593,54 +903,23 @@ def export_logs_excel():
 @app.route('/export/transactions/excel')
 @login_required
 def export_transactions_excel():
-    conn = sqlite3.connect('sagapi_database.db')
-    cursor = conn.cursor()
-    
-    # Get receiving_tbs data
-    cursor.execute('SELECT * FROM receiving_tbs ORDER BY timestamp DESC')
-    tbs_data = cursor.fetchall()
-    cursor.execute('PRAGMA table_info(receiving_tbs)')
-    tbs_columns = [column[1] for column in cursor.fetchall()]
-    
-    # Get order_line data
-    cursor.execute('SELECT * FROM order_line ORDER BY receiving_tbs_id')
-    lines_data = cursor.fetchall()
-    cursor.execute('PRAGMA table_info(order_line)')
-    lines_columns = [column[1] for column in cursor.fetchall()]
-    
-    conn.close()
+    conn = db.get_connection()
     
-    # Create workbook
-    wb = Workbook()
-    
-    # Create TBS sheet
-    ws1 = wb.active
-    ws1.title = "Receiving TBS"
-    
-    # Add TBS headers
-    for col, header in enumerate(tbs_columns, 1):
-        ws1.cell(row=1, column=col, value=header)
-    
-    # Add TBS data
-    for row, data in enumerate(tbs_data, 2):
-        for col, value in enumerate(data, 1):
-            ws1.cell(row=row, column=col, value=value)
-    
-    # Create Order Lines sheet
-    ws2 = wb.create_sheet("Order Lines")
-    
-    # Add Order Lines headers
-    for col, header in enumerate(lines_columns, 1):
-        ws2.cell(row=1, column=col, value=header)
-    
-    # Add Order Lines data
-    for row, data in enumerate(lines_data, 2):
-        for col, value in enumerate(data, 1):
-            ws2.cell(row=row, column=col, value=value)
+    try:
+        tbs_query, tbs_params, tbs_columns = exports.build_query(
+            conn, 'receiving_tbs', request.args, 'timestamp DESC')
+        # ?line_columns= selects the Order Lines sheet columns
+        line_args = dict(request.args.items(), columns=request.args.get('line_columns', ''))
+        lines_query, lines_params, lines_columns = exports.build_query(
+            conn, 'order_line', line_args, 'receiving_tbs_id')
+    except ValueError as e:
+        return str(e), 400
     
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+    with metrics.timer('export_transactions_xlsx'):
+        output = exports.write_workbook([
+            ("Receiving TBS", tbs_columns, exports.iter_rows(conn, tbs_query, tbs_params)),
+            ("Order Lines", lines_columns, exports.iter_rows(conn, lines_query, lines_params))
+        ])
     
     return send_file(
         output,
@@ -649,10 +928,142 @@ def export_transactions_excel():
         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     )
 
+@app.route('/export/transactions/pdf-pack')
+@login_required
+def export_transactions_pdf_pack():
+    """ZIP of the PDF slips of a date range (same start/end/basis filters as the other exports)"""
+    conn = db.get_connection()
+    try:
+        clauses, params = exports.date_clause('receiving_tbs', request.args.get('basis') or 'created',
+                                              request.args.get('start'), request.args.get('end'))
+        with metrics.timer('export_transactions_pdf_pack'):
+            output = pdfs.build_pack(conn, clauses, params)
+    except ValueError as e:
+        return str(e), 400
+    
+    return send_file(
+        output,
+        as_attachment=True,
+        download_name=f'transactions_pdf_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.zip',
+        mimetype='application/zip'
+    )
+
+def stream_export(table, order_by, fmt, filename):
+    if fmt not in exports.STREAM_FORMATS:
+        return f"Unsupported export format: {fmt}", 400
+    
+    conn = db.get_connection()
+    try:
+        query, params, columns = exports.build_query(conn, table, request.args, order_by)
+    except ValueError as e:
+        return str(e), 400
+    
+    stream, mimetype = exports.STREAM_FORMATS[fmt]
+    rows = exports.iter_rows(conn, query, params)
+    return Response(
+        stream_with_context(metrics.timed_stream(f'export_{filename}_{fmt}', stream(columns, rows))),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.{fmt}'}
+    )
+
+@app.route('/export/logs/<fmt>')
+@login_required
+def export_logs_stream(fmt):
+    return stream_export('api_logs', 'timestamp DESC', fmt, 'api_logs')
+
+@app.route('/export/transactions/<fmt>')
+@login_required
+def export_transactions_stream(fmt):
+    # ?table=order_line exports the lines instead of the headers
+    table = request.args.get('table', 'receiving_tbs')
+    if table == 'order_line':
+        return stream_export('order_line', 'receiving_tbs_id, id', fmt, 'order_lines')
+    return stream_export('receiving_tbs', 'timestamp DESC', fmt, 'transactions')
+
+# CLI commands
+@app.cli.command('apply-retention')
+@click.option('--days', type=int, default=None, help='Hot window in days (default SAGAPI_LOG_RETENTION_DAYS)')
+@click.option('--format', 'fmt', type=click.Choice(['sqlite', 'ndjson']), default=None,
+              help='Archive format (default SAGAPI_ARCHIVE_FORMAT)')
+@click.option('--vacuum/--no-vacuum', default=True, help='Release freed pages afterwards')
+def apply_retention_command(days, fmt, vacuum):
+    """Archive api_logs older than the hot window and delete them (run daily from cron)"""
+    report = retention.apply(days=days, fmt=fmt)
+    for month, moved in report['months'].items():
+        print(f"{month}: {moved['rows']} rows -> {moved['path']}")
+    print(f"{report['archived']} rows before {report['cutoff']} archived, "
+          f"{report['blobs_removed']} payload blobs released")
+    if vacuum:
+        released = retention.incremental_vacuum()
+        if released is None:
+            print("Incremental vacuum is off for this database; see enable-incremental-vacuum")
+        else:
+            print(f"{released} free pages released")
+
+@app.cli.command('enable-incremental-vacuum')
+def enable_incremental_vacuum_command():
+    """One-time full VACUUM switching the database to incremental auto-vacuum"""
+    print(f"auto_vacuum is now {retention.enable_incremental_vacuum()}")
+
+@app.cli.command('backfill-epochs')
+def backfill_epochs_command():
+    """Fill date_order/incoming/outgoing epoch columns for existing rows"""
+    print(f"{migrations.backfill_date_epochs()} rows backfilled")
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Apply pending schema migrations (also run by gunicorn before forking workers)"""
+    applied = migrations.migrate()
+    print(f"Schema at version {migrations.current_version()}" + ("" if applied else " (already up to date)"))
+
+@app.cli.command('repack-payloads')
+def repack_payloads_command():
+    """Move inline request/response/order payloads into compressed blobs"""
+    report = payloads.repack()
+    print(f"{report['rows']} rows repacked ({report['values']} payloads)")
+    print(f"{report['bytes_before']:,} bytes of JSON text now stored as {report['bytes_after']:,} bytes of blobs "
+          f"({report['bytes_saved']:,} bytes saved)")
+    print("Run VACUUM to return the freed pages to the filesystem")
+
+@app.cli.command('revoke-tokens')
+@click.argument('login')
+def revoke_tokens_command(login):
+    """Revoke every API token issued to LOGIN (all workers within a second)"""
+    print(f"{tokens.revoke(login=login)} tokens revoked")
+
+@app.cli.command('purge-expired')
+def purge_expired_command():
+    """Delete expired API tokens, idempotency keys and processed ingest tickets (run daily from cron)"""
+    print(f"{tokens.purge_expired()} expired tokens deleted")
+    print(f"{idempotency.purge_expired()} expired idempotency keys deleted")
+    print(f"{ingest.purge_finished()} processed ingest tickets deleted")
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute dashboard rollups from api_logs and receiving_tbs.
+
+    Days before the oldest row left in api_logs (archived by apply-retention)
+    cannot be recomputed and keep their counters.
+    """
+    since = rollups.rebuild()
+    if since:
+        print(f"Dashboard rollups rebuilt from {since}; earlier days kept as they were")
+    else:
+        print("api_logs is empty; receiving TBS rollups rebuilt, api_logs day counters kept")
+
+@app.cli.command('rebuild-log-search')
+def rebuild_log_search_command():
+    """Backfill or rebuild the api_logs full-text index"""
+    if log_search.rebuild():
+        print("api_logs full-text index rebuilt")
+    else:
+        print("FTS5 is not available in this SQLite build")
+
 if __name__ == '__main__':
-    init_db()
+    migrations.migrate()
+    ingest.resume()
     port = int(os.environ.get('PORT', 5000))
     app.run(debug=False, host='0.0.0.0', port=port)
 else:
-    # For production deployment (gunicorn), ensure database is initialized
-    init_db()
+    # Under gunicorn the on_starting hook has already migrated; workers only check
+    migrations.verify()
@@ -0,0 +1,7 @@
+"""Micro-benchmarks for SAGAPI-Proto hot paths.
+
+Run a module directly, e.g. ``python -m benchmarks.token_validation``. Each one
+works against a throwaway database in a temporary directory. ``seed`` fills a
+database with production-like volumes and ``load`` runs the concurrent load
+test with a JSON report that can be checked against a stored baseline.
+"""
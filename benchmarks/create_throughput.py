@@ -0,0 +1,101 @@
+"""Throughput of the receiving TBS create endpoint on one core.
+
+    python -m benchmarks.create_throughput [--requests 2000] [--lines 5] [--invalid 0.1]
+    SAGAPI_JSON=stdlib python -m benchmarks.create_throughput   # without orjson
+
+Posts create tickets through Flask's test client in a single thread, so the
+numbers cover request parsing, authentication, validation, the insert and the
+JSON response, without any network. ``--invalid`` makes a share of the
+tickets fail validation on several fields at once. Also reports the cost of
+validating one order and of the JSON round trip on their own.
+"""
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+
+def ticket(number, lines, invalid):
+    order = {"partner_id": "PT Sumber Sawit", "journal_id": "Bank Agro", "date_order": "31/07/2025 08:00:00",
+             "officers": "Joko", "keterangan_description": f"bench {number}", "driver_name": "Budi",
+             "vehicle_no": "BE 1234 XX", "destination_warehouse_id": "Gudang Lampung", "branch_id": "Lampung Site",
+             "order_line": [{"product_code": "TBS-AGRO-001", "qty_brutto": 10000, "qty_tara": 300, "qty_netto": 9700,
+                             "product_uom": "kg", "sortation_percent": 5, "sortation_weight": 485,
+                             "qty_netto2": 9215, "price_unit": "1500", "product_qty": 1,
+                             "incoming_date": "31/07/2025 08:10:00", "outgoing_date": "31/07/2025 08:30:00"}
+                            for _ in range(lines)]}
+    if invalid:
+        del order['driver_name']
+        order['order_line'][-1]['qty_tara'] = 'n/a'
+    return {"jsonrpc": "2.0", "params": {"order_data": [order]}}
+
+
+def per_call_us(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000, help='create requests to send')
+    parser.add_argument('--lines', type=int, default=5, help='order lines per ticket')
+    parser.add_argument('--invalid', type=float, default=0.1, help='share of tickets that fail validation')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='sagapi-bench-')
+    os.environ['SAGAPI_DB_PATH'] = os.path.join(workdir, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(workdir)
+
+    import app as appmod
+    import jsonutil
+    import tokens
+    import validation
+
+    client = appmod.app.test_client()
+    headers = {'Authorization': 'Bearer ' + tokens.issue('admin', 'sag_production')['access_token']}
+
+    every = int(1 / args.invalid) if args.invalid else 0
+    bodies = [jsonutil.dumps(ticket(n, args.lines, every and n % every == 0)) for n in range(args.requests)]
+    counter = itertools.count()
+
+    def post():
+        n = next(counter)
+        client.post('/api/receiving-tbs/create', data=bodies[n % len(bodies)], headers=headers,
+                    content_type='application/json')
+
+    # Warm up caches and the log writer thread outside the measurement
+    for _ in range(min(50, args.requests)):
+        post()
+    counter = itertools.count(min(50, args.requests))
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for _ in range(args.requests - min(50, args.requests)):
+        post()
+    appmod.log_writer.flush()
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    sent = args.requests - min(50, args.requests)
+
+    print(f"JSON backend {jsonutil.BACKEND}, {sent} requests, {args.lines} lines each, "
+          f"{args.invalid:.0%} invalid")
+    print(f"{'create endpoint':<34} {sent / wall:9.0f} req/s wall   {sent / cpu:9.0f} req/s per CPU second")
+
+    sample = ticket(0, args.lines, False)
+    order = sample['params']['order_data'][0]
+    broken = ticket(0, args.lines, True)['params']['order_data'][0]
+    text = bodies[1]
+    rounds = 20000
+    print(f"{'validate_order, valid':<34} {per_call_us(lambda: validation.validate_order(order), rounds):9.2f} us")
+    print(f"{'validate_order, 3 errors':<34} {per_call_us(lambda: validation.validate_order(broken), rounds):9.2f} us")
+    print(f"{'JSON parse of a ticket':<34} {per_call_us(lambda: jsonutil.loads(text), rounds):9.2f} us")
+    print(f"{'JSON dump of a ticket':<34} {per_call_us(lambda: jsonutil.dumps(sample), rounds):9.2f} us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Concurrency stress check of TBS document number allocation.
+
+    python -m benchmarks.document_numbers_stress [--processes 6] [--threads 4] [--rounds 50]
+
+Forks several processes, each running several threads that allocate single
+numbers and blocks through ``db.transaction()``, like the create and batch
+endpoints do. Some transactions are rolled back after allocating, as a failed
+insert would be. Allocations alternate between two days. Exits non-zero
+unless the committed ``TBS/YYYY/MM/DD/NNN`` numbers of each day are unique,
+run from 001 without gaps and end at the day's stored sequence value.
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+DAYS = (datetime.datetime(2025, 7, 31, 23, 59, 59), datetime.datetime(2025, 8, 1, 0, 0, 1))
+
+
+class Rollback(Exception):
+    pass
+
+
+def allocate_many(rounds, rollback_share, seed):
+    """Committed document numbers of ``rounds`` transactions on this thread."""
+    import db
+    import document_numbers
+
+    rng = random.Random(seed)
+    committed = []
+    for number in range(rounds):
+        count = 1 if rng.random() < 0.5 else rng.randint(2, 20)
+        try:
+            with db.transaction() as conn:
+                numbers = document_numbers.allocate(conn, count, now=DAYS[number % len(DAYS)])
+                if rng.random() < rollback_share:
+                    raise Rollback()
+        except Rollback:
+            continue
+        committed.extend(numbers)
+    return committed
+
+
+def run_process(args):
+    threads, rounds, rollback_share, seed = args
+    results = [None] * threads
+
+    def run(index):
+        results[index] = allocate_many(rounds, rollback_share, seed * 1000 + index)
+
+    workers = [threading.Thread(target=run, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if any(result is None for result in results):
+        raise RuntimeError("an allocating thread failed")
+    return [number for result in results for number in result]
+
+
+def check(numbers, sequences):
+    """Problems found in the committed numbers; empty when they are unique and gap-free."""
+    problems = []
+    by_day = {}
+    for document_no in numbers:
+        day, _, value = document_no.rpartition('/')
+        by_day.setdefault(day[len('TBS/'):], []).append(int(value))
+    for day, values in sorted(by_day.items()):
+        if len(values) != len(set(values)):
+            problems.append(f"{day}: {len(values) - len(set(values))} duplicate numbers")
+        expected = set(range(1, max(values) + 1))
+        missing = sorted(expected - set(values))
+        if missing:
+            problems.append(f"{day}: {len(missing)} missing numbers, first {missing[:5]}")
+        if sequences.get(day) != max(values):
+            problems.append(f"{day}: sequence at {sequences.get(day)}, highest committed {max(values)}")
+    return problems, by_day
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=6, help='forked writer processes')
+    parser.add_argument('--threads', type=int, default=4, help='allocating threads per process')
+    parser.add_argument('--rounds', type=int, default=50, help='transactions per thread')
+    parser.add_argument('--rollback', type=float, default=0.1, help='share of transactions rolled back')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='sagapi-bench-')
+    os.environ['SAGAPI_DB_PATH'] = os.path.join(workdir, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import db
+    import migrations
+
+    migrations.migrate(log=lambda message: None)
+    # Children open their own connections after the fork
+    db.close_all()
+
+    started = time.perf_counter()
+    jobs = [(args.threads, args.rounds, args.rollback, seed) for seed in range(args.processes)]
+    with multiprocessing.get_context('fork').Pool(args.processes) as pool:
+        numbers = [number for result in pool.map(run_process, jobs) for number in result]
+    elapsed = time.perf_counter() - started
+
+    sequences = dict(db.get_connection().execute('SELECT day, last_value FROM document_sequences'))
+    problems, by_day = check(numbers, sequences)
+    transactions = args.processes * args.threads * args.rounds
+    print(f"{args.processes} processes x {args.threads} threads x {args.rounds} transactions "
+          f"({transactions / elapsed:.0f} tx/s), {len(numbers)} numbers committed")
+    for day, values in sorted(by_day.items()):
+        print(f"  {day}: {len(values)} numbers, 001..{max(values):03d}")
+    if problems:
+        for problem in problems:
+            print(f"FAIL {problem}")
+        raise SystemExit(1)
+    print("OK: numbers are unique and gap-free per day")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+"""Concurrent load test of the middleware with a JSON report and baseline check.
+
+    python -m benchmarks.load                                  # seeds a small temp database
+    python -m benchmarks.load --db bench.db --driver gunicorn --workers 4 --concurrency 16
+    python -m benchmarks.load --output run.json --baseline benchmarks/baseline.json
+
+Each scenario (API create and batch, dashboard, logs, transactions, detail
+pages, CSV and Excel exports...) is sent ``--requests`` times from ``--concurrency`` threads,
+either through Flask's test client in this process (``client``) or over
+HTTP to a local gunicorn started on the same database (``gunicorn``).
+Throughput and p50/p95/p99 latencies are printed and written as JSON.
+
+With ``--baseline``, every scenario present in both runs is compared: p95
+latency above ``baseline * (1 + tolerance)`` or throughput below
+``baseline * (1 - tolerance)`` is a regression, and the exit status is 1.
+``--save-baseline`` writes the current run as the new baseline. Runs are only
+comparable on the same machine, database volumes and options.
+
+Scenarios that create tickets add rows to the database; seed a fresh copy
+when runs must start from identical data.
+"""
+import argparse
+import datetime
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERNAME = 'admin'
+PASSWORD = 'SAGsecure#2025'
+# Tickets per /api/receiving-tbs/batch request
+BATCH_TICKETS = 20
+
+
+class Context:
+    """Data shared by scenario request builders."""
+
+    def __init__(self, conn, token, rng):
+        self.token = token
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.run_id = f'{time.time():.0f}'
+        self.sequence = itertools.count()
+        self.max_log_id = conn.execute('SELECT COALESCE(MAX(id), 1) FROM api_logs').fetchone()[0]
+        self.max_tbs_id = conn.execute('SELECT COALESCE(MAX(id), 1) FROM receiving_tbs').fetchone()[0]
+        newest = conn.execute('SELECT MAX(timestamp) FROM api_logs').fetchone()[0]
+        self.last_day = (newest or datetime.datetime.now().strftime('%Y-%m-%d'))[:10]
+
+    def randint(self, low, high):
+        with self.lock:
+            return self.rng.randint(low, high)
+
+    def ticket(self):
+        from benchmarks.seed import make_order
+        number = next(self.sequence)
+        rng = random.Random(number)
+        order = make_order(rng, datetime.datetime.now().replace(microsecond=0), rng.randint(1, 5))
+        order['keterangan_description'] = f'load {self.run_id} #{number}'
+        return {"jsonrpc": "2.0", "params": {"order_data": [order]}}
+
+    def batch(self):
+        return '\n'.join(json.dumps(self.ticket()) for _ in range(BATCH_TICKETS))
+
+
+def _api_headers(ctx):
+    return {'Authorization': f'Bearer {ctx.token}', 'Content-Type': 'application/json'}
+
+
+# name -> (needs web login, builder(ctx) -> (method, path, body, headers))
+SCENARIOS = {
+    'health': (False, lambda ctx: ('GET', '/api/health', None, {})),
+    'create': (False, lambda ctx: ('POST', '/api/receiving-tbs/create', json.dumps(ctx.ticket()), _api_headers(ctx))),
+    'create_async': (False, lambda ctx: ('POST', '/api/receiving-tbs/create', json.dumps(ctx.ticket()),
+                                          dict(_api_headers(ctx), Prefer='respond-async'))),
+    'batch': (False, lambda ctx: ('POST', '/api/receiving-tbs/batch', ctx.batch(),
+                                  dict(_api_headers(ctx), **{'Content-Type': 'application/x-ndjson'}))),
+    'dashboard': (True, lambda ctx: ('GET', '/dashboard', None, {})),
+    'logs': (True, lambda ctx: ('GET', '/logs', None, {})),
+    'logs_search': (True, lambda ctx: ('GET', '/logs?search=Lampung', None, {})),
+    'logs_errors': (True, lambda ctx: ('GET', '/logs?status=error', None, {})),
+    'log_detail': (True, lambda ctx: ('GET', f'/log/{ctx.randint(1, ctx.max_log_id)}', None, {})),
+    'transactions': (True, lambda ctx: ('GET', '/transactions', None, {})),
+    'transaction_detail': (True, lambda ctx: ('GET', f'/transaction/{ctx.randint(1, ctx.max_tbs_id)}', None, {})),
+    'export_transactions_csv': (True, lambda ctx: (
+        'GET', f'/export/transactions/csv?start={ctx.last_day}&end={ctx.last_day}', None, {})),
+    'export_transactions_excel': (True, lambda ctx: (
+        'GET', f'/export/transactions/excel?start={ctx.last_day}&end={ctx.last_day}', None, {})),
+    'export_logs_ndjson': (True, lambda ctx: (
+        'GET', f'/export/logs/ndjson?start={ctx.last_day}&end={ctx.last_day}', None, {})),
+    'changes': (False, lambda ctx: ('GET', f'/api/receiving-tbs/changes?since={max(ctx.max_tbs_id - 500, 0)}',
+                                    None, _api_headers(ctx))),
+    'report_daily_netto_partner': (True, lambda ctx: ('GET', '/api/reports/daily-netto-partner', None, {})),
+}
+
+DEFAULT_SCENARIOS = list(SCENARIOS)
+
+
+class ClientDriver:
+    """Flask test client in this process, one client per thread."""
+
+    name = 'client'
+
+    def __init__(self):
+        import app as appmod
+        self.app = appmod.app
+        self._local = threading.local()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        import app as appmod
+        appmod.log_writer.flush()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+            client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+        return client
+
+    def request(self, method, path, body, headers):
+        response = self._client().open(path, method=method, data=body, headers=headers)
+        response.get_data()
+        return response.status_code
+
+
+class GunicornDriver:
+    """HTTP against a local gunicorn serving the same database."""
+
+    name = 'gunicorn'
+
+    def __init__(self, db_path, workers):
+        self.db_path = db_path
+        self.workers = workers
+        self.port = None
+        self.process = None
+        self.cookie = None
+
+    def start(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        env = dict(os.environ, SAGAPI_DB_PATH=self.db_path,
+                   SAGAPI_METRICS_DIR=tempfile.mkdtemp(prefix='sagapi-metrics-'))
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'app:app', '--config', 'gunicorn.conf.py',
+             '--workers', str(self.workers), '--bind', f'127.0.0.1:{self.port}', '--log-level', 'warning'],
+            cwd=ROOT, env=env)
+        deadline = time.time() + 60
+        while True:
+            try:
+                if self._send('GET', '/api/health', None, {})[0] == 200:
+                    break
+            except OSError:
+                pass
+            if time.time() > deadline or self.process.poll() is not None:
+                self.stop()
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.2)
+        body = urllib.parse.urlencode({'username': USERNAME, 'password': PASSWORD})
+        _, response = self._send('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+        self.cookie = (response.getheader('Set-Cookie') or '').split(';')[0]
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(30)
+
+    def _send(self, method, path, body, headers):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status, response
+        finally:
+            conn.close()
+
+    def request(self, method, path, body, headers):
+        if self.cookie:
+            headers = dict(headers, Cookie=self.cookie)
+        return self._send(method, path, body, headers)[0]
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an ascending list."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def run_scenario(driver, ctx, name, requests, concurrency):
+    build = SCENARIOS[name][1]
+    counter = itertools.count()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        local_latencies, local_errors = [], 0
+        while next(counter) < requests:
+            method, path, body, headers = build(ctx)
+            start = time.perf_counter()
+            try:
+                status = driver.request(method, path, body, headers)
+            except OSError:
+                status = 599
+            local_latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+    }
+
+
+def compare(current, baseline, tolerance):
+    """Regressions of ``current`` against ``baseline`` as readable strings."""
+    regressions = []
+    for key, base in baseline.get('results', {}).items():
+        result = current['results'].get(key)
+        if result is None:
+            continue
+        if base['p95_ms'] and result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {result['p95_ms']} ms > baseline {base['p95_ms']} ms")
+        if result['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{key}: {result['throughput_rps']} req/s < baseline {base['throughput_rps']} req/s")
+        if result['errors'] > base['errors']:
+            regressions.append(f"{key}: {result['errors']} errors > baseline {base['errors']}")
+    return regressions
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', help='seeded database (default: seed a temporary one)')
+    parser.add_argument('--api-logs', type=int, default=50000, help='rows when seeding a temporary database')
+    parser.add_argument('--receiving-tbs', type=int, default=5000, help='orders when seeding a temporary database')
+    parser.add_argument('--copy', action='store_true', help='run against a copy of --db, leaving it untouched')
+    parser.add_argument('--driver', choices=['client', 'gunicorn', 'both'], default='client')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS),
+                        help=f"comma separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--save-baseline', help='also write the report as the new baseline')
+    args = parser.parse_args(argv)
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    workdir = tempfile.mkdtemp(prefix='sagapi-load-')
+    if args.db and args.copy:
+        db_path = os.path.join(workdir, 'load.db')
+        shutil.copyfile(args.db, db_path)
+    else:
+        db_path = os.path.abspath(args.db) if args.db else os.path.join(workdir, 'load.db')
+    os.environ['SAGAPI_DB_PATH'] = db_path
+    os.environ.setdefault('SAGAPI_METRICS_DIR', os.path.join(workdir, 'metrics'))
+    sys.path.insert(0, ROOT)
+
+    import db
+    import tokens
+    from benchmarks import seed
+
+    if not args.db:
+        seed.seed(args.api_logs, args.receiving_tbs, random_seed=args.seed, log=lambda message: None)
+    else:
+        import migrations
+        migrations.migrate(log=lambda message: None)
+
+    token = tokens.issue(USERNAME, 'sag_production')['access_token']
+    ctx = Context(db.get_connection(), token, random.Random(args.seed))
+    counts = {table: db.get_connection().execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('api_logs', 'receiving_tbs', 'order_line')}
+    db.close_all()
+
+    drivers = {'client': [ClientDriver], 'gunicorn': [GunicornDriver], 'both': [ClientDriver, GunicornDriver]}
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'git_revision': _git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'cpus': os.cpu_count(),
+            'rows': counts,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'workers': args.workers,
+        },
+        'results': {},
+    }
+
+    print(f"{'scenario':<36} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for driver_class in drivers[args.driver]:
+        driver = driver_class() if driver_class is ClientDriver else driver_class(db_path, args.workers)
+        try:
+            driver.start()
+            for name in names:
+                result = run_scenario(driver, ctx, name, args.requests, args.concurrency)
+                key = f'{driver.name}:{name}'
+                report['results'][key] = result
+                print(f"{key:<36} {result['throughput_rps']:>9} {result['p50_ms']:>9} {result['p95_ms']:>9} "
+                      f"{result['p99_ms']:>9} {result['errors']:>7}")
+        finally:
+            driver.stop()
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} of the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""Fill a database with realistic volumes for benchmarks.
+
+    python -m benchmarks.seed --db bench.db --api-logs 5000000 --receiving-tbs 500000
+
+Rows are spread over the last ``--days`` days, in id order like production.
+Receiving TBS orders go through the same validation and ``insert_orders()``
+as the API, so headers, totals, epochs, document numbers and payload blobs
+are exactly what the create endpoint would write. Each order has 1 to
+``2 * --lines - 1`` lines (``--lines`` on average). api_logs rows take their
+bodies from a pool of ``--payload-pool`` distinct payloads.
+
+The full-text and rollup triggers are dropped while rows are inserted, then
+recreated and rebuilt in one pass, which is much faster than maintaining them
+row by row. The run is deterministic for a given ``--seed``.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+BRANCHES = ['Lampung Site', 'Palembang Site', 'Jambi Site', 'Riau Site', 'Bengkulu Site']
+PARTNERS = [f'PT Mitra Sawit {n:03d}' for n in range(1, 201)]
+DRIVERS = ['Budi', 'Agus', 'Joko', 'Slamet', 'Rudi', 'Hendra', 'Yusuf', 'Dedi']
+PRODUCTS = ['TBS-AGRO-001', 'TBS-AGRO-002', 'TBS-PLASMA-001', 'TBS-MANDIRI-001']
+
+# (endpoint, share of api_logs rows)
+ENDPOINTS = [
+    ('/api/receiving-tbs/create', 0.72),
+    ('/api/auth/login', 0.15),
+    ('/api/receiving-tbs/batch', 0.05),
+    ('/api/auth/refresh', 0.06),
+    ('/api/test', 0.02),
+]
+ERROR_RATE = 0.04
+
+TRIGGERS = ('api_logs_fts_ai', 'api_logs_rollup_ai', 'receiving_tbs_rollup_ai')
+
+
+def agent_date(moment):
+    return moment.strftime('%d/%m/%Y %H:%M:%S')
+
+
+def make_order(rng, moment, lines):
+    """One create ``order_data`` item as the agents send it."""
+    order_lines = []
+    for _ in range(lines):
+        brutto = rng.randint(4000, 16000)
+        tara = rng.randint(200, 600)
+        netto = brutto - tara
+        percent = rng.choice((0, 2, 3, 5))
+        weight = round(netto * percent / 100)
+        order_lines.append({
+            "product_code": rng.choice(PRODUCTS),
+            "qty_brutto": brutto,
+            "qty_tara": tara,
+            "qty_netto": netto,
+            "product_uom": "kg",
+            "sortation_percent": percent,
+            "sortation_weight": weight,
+            "qty_netto2": netto - weight,
+            "price_unit": rng.choice((1450, 1500, 1525, 1550)),
+            "product_qty": 1,
+            "incoming_date": agent_date(moment + datetime.timedelta(minutes=10)),
+            "outgoing_date": agent_date(moment + datetime.timedelta(minutes=30)),
+        })
+    branch = rng.choice(BRANCHES)
+    return {
+        "partner_id": rng.choice(PARTNERS),
+        "journal_id": "Bank Agro",
+        "date_order": agent_date(moment),
+        "officers": rng.choice(DRIVERS),
+        "keterangan_description": f"Penerimaan TBS {moment:%d/%m} #{rng.randint(1, 10 ** 9)}",
+        "driver_name": rng.choice(DRIVERS),
+        "vehicle_no": f"BE {rng.randint(1000, 9999)} {rng.choice('ABCDEFGH')}{rng.choice('WXYZ')}",
+        "destination_warehouse_id": f"Gudang {branch.split()[0]}",
+        "branch_id": branch,
+        "order_line": order_lines,
+    }
+
+
+def _spread(count, days, now):
+    """``count`` ascending datetimes over the last ``days`` days."""
+    if not count:
+        return []
+    start = now - datetime.timedelta(days=days)
+    step = days * 86400.0 / count
+    return [start + datetime.timedelta(seconds=i * step) for i in range(count)]
+
+
+def seed_receiving_tbs(rng, count, lines, days, now, batch_size, log):
+    import db
+    import payloads
+    import receiving
+    import validation
+
+    inserted = 0
+    moments = _spread(count, days, now)
+    for start in range(0, count, batch_size):
+        # insert_orders() stamps a whole call with one time, so group by hour
+        groups = {}
+        for moment in moments[start:start + batch_size]:
+            groups.setdefault(moment.replace(minute=0, second=0, microsecond=0), []).append(moment)
+        with db.transaction() as conn:
+            for hour, group in groups.items():
+                prepared = []
+                for moment in group:
+                    order = make_order(rng, moment, rng.randint(1, 2 * lines - 1))
+                    values, _ = validation.validate_order(order)
+                    prepared.append((values, payloads.dumps({"jsonrpc": "2.0", "params": {"order_data": [order]}})))
+                receiving.insert_orders(conn, prepared, hour)
+        inserted += min(batch_size, count - start)
+        log(f"receiving_tbs {inserted:,}/{count:,}")
+
+
+def seed_api_logs(rng, count, days, now, pool_size, batch_size, log):
+    import db
+    import log_writer
+    import payloads
+
+    pool = []
+    for n in range(pool_size):
+        order = make_order(rng, now - datetime.timedelta(days=rng.random() * days), rng.randint(1, 5))
+        pool.append((payloads.dumps({"jsonrpc": "2.0", "params": {"order_data": [order]}}),
+                     payloads.dumps({"code": 200, "message": "Receiving TBS created successfully.",
+                                     "result": {"document_no": f"TBS/{now:%Y/%m/%d}/{n + 1:03d}"}})))
+    errors = [payloads.dumps({"code": 400, "message": message}) for message in (
+        "Missing Driver Name. Please fill in this information.",
+        "Invalid or expired token",
+        "Please provide the correct incoming date and outgoing date.")]
+    with db.transaction() as conn:
+        hashes = payloads.store(conn, [text for pair in pool for text in pair] + errors)
+    request_hashes, response_hashes, error_hashes = hashes[:-len(errors):2], hashes[1:-len(errors):2], hashes[-len(errors):]
+
+    endpoints = [endpoint for endpoint, _ in ENDPOINTS]
+    weights = [share for _, share in ENDPOINTS]
+    moments = _spread(count, days, now)
+    for start in range(0, count, batch_size):
+        rows = []
+        for moment in moments[start:start + batch_size]:
+            endpoint = rng.choices(endpoints, weights)[0]
+            item = rng.randrange(pool_size)
+            failed = rng.random() < ERROR_RATE
+            rows.append((moment.strftime('%Y-%m-%d %H:%M:%S'), endpoint, rng.choice(PARTNERS), rng.choice(BRANCHES),
+                         'error' if failed else 'success', 400 if failed else 200,
+                         request_hashes[item], rng.choice(error_hashes) if failed else response_hashes[item],
+                         f'10.20.{rng.randint(0, 255)}.{rng.randint(1, 254)}'))
+        with db.transaction() as conn:
+            conn.executemany(log_writer.INSERT_SQL, rows)
+        log(f"api_logs {min(start + batch_size, count):,}/{count:,}")
+
+
+def seed(api_logs=100000, receiving_tbs=10000, lines=3, days=90, payload_pool=2000,
+         batch_size=10000, random_seed=42, log=print):
+    """Seed the database at ``db.DB_PATH``; returns the row counts afterwards."""
+    import db
+    import log_search
+    import migrations
+    import rollups
+
+    rng = random.Random(random_seed)
+    now = datetime.datetime.now().replace(microsecond=0)
+    started = time.perf_counter()
+    migrations.migrate(log=log)
+
+    with db.transaction() as conn:
+        for name in TRIGGERS:
+            conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    try:
+        seed_receiving_tbs(rng, receiving_tbs, lines, days, now, max(1, batch_size // lines), log)
+        seed_api_logs(rng, api_logs, days, now, payload_pool, batch_size, log)
+    finally:
+        with db.transaction() as conn:
+            rollups.create_schema(conn.cursor())
+        rollups.rebuild()
+        log_search.rebuild()
+
+    conn = db.get_connection()
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('api_logs', 'receiving_tbs', 'order_line', 'payload_blobs')}
+    conn.execute('ANALYZE')
+    log(f"Seeded in {time.perf_counter() - started:.1f}s: {counts}")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help='database file to fill (created if missing)')
+    parser.add_argument('--api-logs', type=int, default=100000)
+    parser.add_argument('--receiving-tbs', type=int, default=10000)
+    parser.add_argument('--lines', type=int, default=3, help='average order lines per order')
+    parser.add_argument('--days', type=int, default=90, help='spread rows over this many days')
+    parser.add_argument('--payload-pool', type=int, default=2000, help='distinct api_logs bodies')
+    parser.add_argument('--batch-size', type=int, default=10000, help='rows per transaction')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+
+    os.environ['SAGAPI_DB_PATH'] = os.path.abspath(args.db)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    seed(args.api_logs, args.receiving_tbs, args.lines, args.days, args.payload_pool,
+         args.batch_size, args.seed)
+
+
+if __name__ == '__main__':
+    main()
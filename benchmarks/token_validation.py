@@ -0,0 +1,64 @@
+"""Cost of validating an API token per request.
+
+    python -m benchmarks.token_validation [--tokens 1000] [--rounds 20000]
+
+Measures the pieces ``authenticate()`` pays on every API call: hashing the
+token, a cold lookup in SQLite, a cached lookup, and a cached lookup that also
+rereads the revocation generation on every call (the worst case of the
+cross-worker check).
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def measure(label, func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    per_call_us = (time.perf_counter() - start) / rounds * 1e6
+    print(f"{label:<42} {per_call_us:9.2f} us/request")
+    return per_call_us
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tokens', type=int, default=1000, help='live tokens in the store')
+    parser.add_argument('--rounds', type=int, default=20000, help='validations per measurement')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='sagapi-bench-')
+    os.environ['SAGAPI_DB_PATH'] = os.path.join(workdir, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import db
+    import tokens
+
+    with db.transaction() as conn:
+        tokens.create_schema(conn.cursor())
+    issued = [tokens.issue('admin', 'sag_production')['access_token'] for _ in range(args.tokens)]
+    pick = lambda: random.choice(issued)
+
+    print(f"{args.tokens} live tokens, {args.rounds} rounds, database {db.DB_PATH}")
+    measure('sha256 digest only', lambda: tokens.digest(pick()), args.rounds)
+
+    def cold():
+        tokens._cache.clear()
+        tokens.validate(pick())
+    measure('validate, cache miss (SQLite lookup)', cold, args.rounds)
+
+    for token in issued:
+        tokens.validate(token)
+    measure('validate, cache hit', lambda: tokens.validate(pick()), args.rounds)
+    measure('validate, unknown token (negative cache)', lambda: tokens.validate('not-a-token'), args.rounds)
+
+    tokens.GENERATION_CHECK_SECONDS = 0.0
+    measure('validate, cache hit + generation reread', lambda: tokens.validate(pick()), args.rounds)
+    print(tokens.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""How a held SQLite write lock affects one gunicorn worker, per worker class.
+
+    python -m benchmarks.write_lock_stall [--worker-class gthread,gevent] [--streams 3] [--hold 2]
+
+Starts one gunicorn worker per worker class with ``--streams`` open
+``/logs/stream`` subscribers, then takes the write lock from this process for
+``--hold`` seconds while a create request in the worker waits on
+``busy_timeout``. ``/api/health`` is requested every 50 ms meanwhile; its
+maximum latency shows whether the rest of the worker kept running. sqlite3
+does not yield to the gevent hub, so under gevent the whole worker stalls for
+the busy wait.
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.load import ROOT, GunicornDriver, percentile
+
+
+def _open_stream(driver, opened):
+    conn = http.client.HTTPConnection('127.0.0.1', driver.port, timeout=60)
+    conn.request('GET', '/logs/stream', headers={'Cookie': driver.cookie})
+    response = conn.getresponse()
+    if response.status != 200:
+        return
+    opened.append(conn)
+    while response.fp.readline():
+        pass
+
+
+def measure(worker_class, streams, hold):
+    import db
+    import tokens
+    from benchmarks.seed import make_order
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix='sagapi-bench-'), 'bench.db')
+    os.environ['SAGAPI_WORKER_CLASS'] = worker_class
+    driver = GunicornDriver(db_path, 1)
+    driver.start()
+    opened = []
+    try:
+        # gunicorn has migrated the new database by now
+        db.set_db_path(db_path)
+        headers = {'Content-Type': 'application/json',
+                   'Authorization': f"Bearer {tokens.issue('admin', 'sag_production')['access_token']}"}
+        body = json.dumps({"params": {"order_data": [make_order(random.Random(1), datetime.datetime.now(), 1)]}})
+
+        for _ in range(streams):
+            threading.Thread(target=_open_stream, args=(driver, opened), daemon=True).start()
+        time.sleep(1.5)
+
+        latencies = []
+        done = threading.Event()
+
+        def poll_health():
+            while not done.is_set():
+                started = time.perf_counter()
+                driver.request('GET', '/api/health', None, {})
+                latencies.append((time.perf_counter() - started) * 1000.0)
+                time.sleep(0.05)
+
+        poller = threading.Thread(target=poll_health, daemon=True)
+        poller.start()
+        time.sleep(0.5)
+
+        lock = sqlite3.connect(db_path, isolation_level=None)
+        lock.execute('BEGIN IMMEDIATE')
+        creator = threading.Thread(target=driver.request,
+                                   args=('POST', '/api/receiving-tbs/create', body, headers))
+        creator.start()
+        time.sleep(hold)
+        lock.execute('COMMIT')
+        creator.join()
+        time.sleep(0.5)
+        done.set()
+        poller.join()
+        latencies.sort()
+        return len(opened), latencies
+    finally:
+        # Open streams would hold up gunicorn's graceful shutdown until their next heartbeat
+        for conn in opened:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        driver.process.send_signal(signal.SIGQUIT)
+        driver.process.wait(30)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--worker-class', default='gthread,gevent', help='comma separated worker classes')
+    parser.add_argument('--streams', type=int, default=3, help='open /logs/stream subscribers')
+    parser.add_argument('--hold', type=float, default=2.0, help='seconds the write lock is held')
+    args = parser.parse_args(argv)
+    sys.path.insert(0, ROOT)
+
+    print(f"{'worker class':<14} {'streams':>8} {'requests':>9} {'p50 ms':>8} {'max ms':>9}")
+    for worker_class in [name.strip() for name in args.worker_class.split(',') if name.strip()]:
+        opened, latencies = measure(worker_class, args.streams, args.hold)
+        print(f"{worker_class:<14} {opened:>8} {len(latencies):>9} "
+              f"{percentile(latencies, 0.5):>8.1f} {latencies[-1]:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
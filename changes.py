@@ -0,0 +1,120 @@
+"""Incremental feed of receiving TBS records for downstream synchronization.
+
+Receiving TBS records are never updated or deleted once created, so their id
+is the change sequence: AUTOINCREMENT never reuses an id, and SQLite's single
+writer commits ids in order, so a reader never sees id N+1 before id N. A
+client keeps the cursor of the last record it processed and asks for what
+came after it; each page costs an index range scan over the new rows only.
+
+Records are streamed as NDJSON, one header per line with its order lines
+nested, in cursor order. The next cursor is known before streaming starts
+(it is sent as ``X-Next-Cursor``) and every record carries its own ``cursor``,
+so a client cut off mid-page can resume from the last record it stored.
+
+When there is nothing new a request may wait up to ``SAGAPI_CHANGES_MAX_WAIT``
+seconds for the next record (long-poll). Waiting checks ``MAX(id)`` every
+``SAGAPI_CHANGES_POLL_MS``, which also sees records created by other workers.
+At most ``SAGAPI_CHANGES_MAX_WAITERS`` requests per process wait at a time;
+the rest answer right away.
+"""
+import os
+import threading
+import time
+
+import jsonutil
+
+DEFAULT_LIMIT = 500
+MAX_LIMIT = int(os.environ.get('SAGAPI_CHANGES_MAX_LIMIT', 5000))
+MAX_WAIT = int(os.environ.get('SAGAPI_CHANGES_MAX_WAIT', 30))
+POLL_INTERVAL = int(os.environ.get('SAGAPI_CHANGES_POLL_MS', 500)) / 1000.0
+MAX_WAITERS = int(os.environ.get('SAGAPI_CHANGES_MAX_WAITERS', 4))
+
+HEADER_COLUMNS = ('id', 'document_no', 'timestamp', 'partner_id', 'journal_id', 'date_order', 'officers',
+                  'keterangan_description', 'driver_name', 'vehicle_no', 'destination_warehouse_id', 'branch_id',
+                  'line_count', 'total_netto', 'total_value')
+LINE_COLUMNS = ('receiving_tbs_id', 'id', 'product_code', 'qty_brutto', 'qty_tara', 'qty_netto', 'product_uom',
+                'sortation_percent', 'sortation_weight', 'qty_netto2', 'price_unit', 'product_qty',
+                'incoming_date', 'outgoing_date')
+
+# Headers per query while streaming a page
+_CHUNK = 200
+
+_waiters = 0
+_waiters_lock = threading.Lock()
+
+
+def parse_cursor(value):
+    """Sequence number of a cursor (empty means from the beginning); raises ValueError."""
+    if not value:
+        return 0
+    if not value.isdigit():
+        raise ValueError(f"Invalid cursor '{value}'")
+    return int(value)
+
+
+def latest(conn):
+    return conn.execute('SELECT COALESCE(MAX(id), 0) FROM receiving_tbs').fetchone()[0]
+
+
+def wait_for_changes(conn, since, timeout):
+    """Block until a record after ``since`` exists or ``timeout`` seconds pass; returns whether one does."""
+    global _waiters
+    if latest(conn) > since:
+        return True
+    if timeout <= 0:
+        return False
+    with _waiters_lock:
+        if _waiters >= MAX_WAITERS:
+            return False
+        _waiters += 1
+    try:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(min(POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+            if latest(conn) > since:
+                return True
+        return False
+    finally:
+        with _waiters_lock:
+            _waiters -= 1
+
+
+def page(conn, since, limit):
+    """``(last_id, has_more)`` of the page after ``since``; last_id is ``since`` when it is empty."""
+    ids = [row[0] for row in conn.execute('SELECT id FROM receiving_tbs WHERE id > ? ORDER BY id LIMIT ?',
+                                          (since, limit + 1))]
+    if not ids:
+        return since, False
+    return ids[:limit][-1], len(ids) > limit
+
+
+def iter_records(conn, since, last_id):
+    """Headers with ids in ``(since, last_id]``, each with its ``order_line`` list."""
+    header_sql = f"SELECT {', '.join(HEADER_COLUMNS)} FROM receiving_tbs WHERE id > ? AND id <= ? ORDER BY id LIMIT ?"
+    line_sql = (f"SELECT {', '.join(LINE_COLUMNS)} FROM order_line "
+                f"WHERE receiving_tbs_id >= ? AND receiving_tbs_id <= ? ORDER BY receiving_tbs_id, id")
+    position = since
+    while position < last_id:
+        headers = conn.execute(header_sql, (position, last_id, _CHUNK)).fetchall()
+        if not headers:
+            break
+        lines = {}
+        for row in conn.execute(line_sql, (headers[0][0], headers[-1][0])):
+            lines.setdefault(row[0], []).append(dict(zip(LINE_COLUMNS[1:], row[1:])))
+        for row in headers:
+            record = {'cursor': str(row[0])}
+            record.update(zip(HEADER_COLUMNS, row))
+            record['order_line'] = lines.get(row[0], [])
+            yield record
+        position = headers[-1][0]
+
+
+def stream_ndjson(records):
+    chunk = []
+    for record in records:
+        chunk.append(jsonutil.dumps(record))
+        if len(chunk) >= _CHUNK:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
@@ -0,0 +1,85 @@
+"""Date parsing and range helpers.
+
+``timestamp`` columns are written by the middleware as 'YYYY-MM-DD HH:MM:SS',
+which sorts chronologically as text, so range filters on them compare strings
+and use the timestamp indexes directly.
+
+Dates sent by the agents (date_order, incoming_date, outgoing_date) arrive as
+'DD/MM/YYYY HH:MM:SS' and do not sort as text. They get companion integer
+``*_epoch`` columns holding wall-clock seconds: the same local time the agent
+sent, counted as if it were UTC, so no timezone conversion is ever applied.
+"""
+import calendar
+import datetime
+import functools
+
+AGENT_DATE_FORMATS = (
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y %H:%M',
+    '%d/%m/%Y',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d',
+)
+
+
+def to_epoch(value):
+    """Wall-clock epoch seconds for an agent date string, or None if unparseable."""
+    if not isinstance(value, str):
+        return None
+    return _parse_epoch(value.strip())
+
+
+# A ticket repeats the same few dates across its lines, and strptime is slow
+@functools.lru_cache(maxsize=4096)
+def _parse_epoch(value):
+    for fmt in AGENT_DATE_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return calendar.timegm(parsed.timetuple())
+    return None
+
+
+def parse_day(value, name):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"Invalid {name} date '{value}', expected YYYY-MM-DD")
+
+
+def day_range(start, end):
+    """Half-open ``[start, end + 1 day)`` bounds for inclusive YYYY-MM-DD filters.
+
+    Either side may be empty. Returns ``(lower, upper)`` datetimes or None.
+    """
+    lower = parse_day(start, 'start') if start else None
+    upper = parse_day(end, 'end') + datetime.timedelta(days=1) if end else None
+    return lower, upper
+
+
+def text_range_clause(column, start, end):
+    """SQL and params limiting a 'YYYY-MM-DD HH:MM:SS' text column to a day range."""
+    lower, upper = day_range(start, end)
+    clauses, params = [], []
+    if lower:
+        clauses.append(f'{column} >= ?')
+        params.append(lower.strftime('%Y-%m-%d'))
+    if upper:
+        clauses.append(f'{column} < ?')
+        params.append(upper.strftime('%Y-%m-%d'))
+    return clauses, params
+
+
+def epoch_range_clause(column, start, end):
+    """SQL and params limiting an ``*_epoch`` column to a day range."""
+    lower, upper = day_range(start, end)
+    clauses, params = [], []
+    if lower:
+        clauses.append(f'{column} >= ?')
+        params.append(calendar.timegm(lower.timetuple()))
+    if upper:
+        clauses.append(f'{column} < ?')
+        params.append(calendar.timegm(upper.timetuple()))
+    return clauses, params
@@ -0,0 +1,352 @@
+"""Shared SQLite data-access layer for SAGAPI-Proto.
+
+Every worker thread keeps one tuned connection to the database file instead of
+opening a fresh one per call. At the end of a request the connection goes back
+to a small per-process pool: under gevent workers each request is a new
+greenlet with its own greenlet-local state, and would otherwise open (and
+keep) a connection of its own. Connections run in autocommit mode; writes go
+through ``transaction()`` which takes the write lock up front with
+``BEGIN IMMEDIATE`` so lock waits are bounded by ``busy_timeout`` and measured.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _resolve_db_path():
+    path = os.environ.get('SAGAPI_DB_PATH')
+    if path:
+        return path
+    url = os.environ.get('DATABASE_URL', '')
+    if url.startswith('sqlite:///'):
+        return url[len('sqlite:///'):]
+    return 'sagapi_database.db'
+
+
+# Configuration (overridable through the environment)
+DB_PATH = _resolve_db_path()
+BUSY_TIMEOUT_MS = int(os.environ.get('SAGAPI_DB_BUSY_TIMEOUT_MS', 5000))
+CACHE_SIZE_KB = int(os.environ.get('SAGAPI_DB_CACHE_KB', 20000))
+MMAP_SIZE = int(os.environ.get('SAGAPI_DB_MMAP_SIZE', 256 * 1024 * 1024))
+SYNCHRONOUS = os.environ.get('SAGAPI_DB_SYNCHRONOUS', 'NORMAL')
+STATEMENT_CACHE_SIZE = int(os.environ.get('SAGAPI_DB_STATEMENT_CACHE', 256))
+# Idle connections kept per process for the next request
+POOL_SIZE = int(os.environ.get('SAGAPI_DB_POOL_SIZE', 16))
+
+# Waits on BEGIN IMMEDIATE longer than this count as contended
+LOCK_WAIT_THRESHOLD_MS = 1.0
+
+_local = threading.local()
+_lock = threading.Lock()
+_connections = {}
+_idle = []
+_functions = []
+_tracer = None
+_statement_hook = None
+_generation = 0
+_stats = {
+    'connections_opened': 0,
+    'connections_reused': 0,
+    'connections_pooled': 0,
+    'connections_closed': 0,
+    'transactions': 0,
+    'rollbacks': 0,
+    'lock_waits': 0,
+    'lock_wait_ms_total': 0.0,
+    'lock_wait_ms_max': 0.0,
+    'lock_errors': 0,
+}
+
+
+def _incr(key, amount=1):
+    with _lock:
+        _stats[key] += amount
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor reporting each statement's time and row count to the tracer.
+
+    Time covers ``execute`` and the ``fetch*`` calls. Rows consumed by
+    iterating the cursor are not timed; they are counted locally and reported
+    once, when the cursor is exhausted, closed or runs its next statement.
+    """
+
+    _sql = None
+    _iterated = 0
+
+    def execute(self, sql, parameters=()):
+        self._report_iterated()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._sql = sql
+            _tracer(sql, time.perf_counter() - start, max(self.rowcount, 0))
+
+    def executemany(self, sql, seq_of_parameters):
+        self._report_iterated()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._sql = None
+            _tracer(sql, time.perf_counter() - start, max(self.rowcount, 0))
+
+    def _fetched(self, start, rows):
+        if self._sql is not None:
+            _tracer(self._sql, time.perf_counter() - start, rows, fetch=True)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def __next__(self):
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._report_iterated()
+            raise
+        self._iterated += 1
+        return row
+
+    def close(self):
+        self._report_iterated()
+        super().close()
+
+    def _report_iterated(self):
+        if self._iterated and self._sql is not None:
+            _tracer(self._sql, 0.0, self._iterated, fetch=True)
+        self._iterated = 0
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection whose cursors, including those of the ``execute`` shortcuts, are traced."""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def set_tracer(tracer, statement_hook=None):
+    """Report every statement to ``tracer(sql, seconds, rows, fetch=False)``; None turns it off.
+
+    ``statement_hook(sql)`` is installed with ``set_trace_callback`` and also
+    sees the statements SQLite runs inside triggers. Applies to connections
+    opened from now on, so open ones are closed.
+    """
+    global _tracer, _statement_hook
+    _tracer = tracer
+    _statement_hook = statement_hook
+    close_all()
+
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000.0,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=TracedConnection if _tracer else sqlite3.Connection,
+    )
+    # Only takes effect on a new, empty file; see retention.enable_incremental_vacuum()
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA synchronous={SYNCHRONOUS}')
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    for name, num_params, func in _functions:
+        conn.create_function(name, num_params, func, deterministic=True)
+    if _statement_hook:
+        conn.set_trace_callback(_statement_hook)
+    return conn
+
+
+def register_function(name, num_params, func):
+    """Make a deterministic Python function callable from SQL on every connection."""
+    pid = os.getpid()
+    with _lock:
+        _functions.append((name, num_params, func))
+        for key, conn in _connections.items():
+            if key[0] == pid:
+                conn.create_function(name, num_params, func, deterministic=True)
+
+
+def get_connection():
+    """Return this thread's connection, taking an idle one or opening it on first use.
+
+    Connections are tagged with the process id so a gunicorn worker never
+    reuses a handle inherited from the master across ``fork()``.
+    """
+    pid = os.getpid()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == pid and _local.generation == _generation:
+        _incr('connections_reused')
+        return conn
+
+    conn = _checkout(pid)
+    if conn is None:
+        conn = _open_connection()
+        with _lock:
+            _connections[(pid, id(conn))] = conn
+            _stats['connections_opened'] += 1
+    _local.conn = conn
+    _local.pid = pid
+    _local.generation = _generation
+    return conn
+
+
+def _checkout(pid):
+    with _lock:
+        while _idle:
+            idle_pid, generation, conn = _idle.pop()
+            # Entries inherited across fork() belong to the parent and are only forgotten
+            if idle_pid == pid and generation == _generation:
+                _stats['connections_pooled'] += 1
+                return conn
+    return None
+
+
+@contextmanager
+def transaction():
+    """Run a block inside a write transaction on this thread's connection.
+
+    Nested use joins the outer transaction, so helpers can be called both on
+    their own and as part of a larger unit of work.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    start = time.perf_counter()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+    except sqlite3.OperationalError:
+        _incr('lock_errors')
+        raise
+    waited_ms = (time.perf_counter() - start) * 1000.0
+    with _lock:
+        _stats['transactions'] += 1
+        _stats['lock_wait_ms_total'] += waited_ms
+        if waited_ms > _stats['lock_wait_ms_max']:
+            _stats['lock_wait_ms_max'] = waited_ms
+        if waited_ms > LOCK_WAIT_THRESHOLD_MS:
+            _stats['lock_waits'] += 1
+
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        _incr('rollbacks')
+        raise
+    else:
+        conn.commit()
+
+
+@contextmanager
+def snapshot():
+    """Run a block of reads against one consistent snapshot of the database.
+
+    A deferred read transaction: no write lock is taken, and in WAL mode
+    writers carry on while it is open. Nested use joins the outer transaction.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN')
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+
+
+def release(exc=None):
+    """Request teardown hook: roll back anything left open and return the connection to the pool."""
+    pid = os.getpid()
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != pid:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+        _incr('rollbacks')
+    _local.conn = None
+    with _lock:
+        if _local.generation != _generation:
+            # Already closed by close_all()
+            return
+        if len(_idle) < POOL_SIZE:
+            _idle.append((pid, _generation, conn))
+            return
+        _connections.pop((pid, id(conn)), None)
+        _stats['connections_closed'] += 1
+    conn.close()
+
+
+def close_all():
+    """Close every connection opened by this process."""
+    global _generation
+    pid = os.getpid()
+    with _lock:
+        _generation += 1
+        for key in [k for k in _connections if k[0] == pid]:
+            try:
+                _connections.pop(key).close()
+            except sqlite3.Error:
+                pass
+            _stats['connections_closed'] += 1
+        _idle[:] = [entry for entry in _idle if entry[0] != pid]
+    _local.conn = None
+
+
+def set_db_path(path):
+    """Point the layer at another database file (tests, tools, archives)."""
+    global DB_PATH
+    close_all()
+    DB_PATH = path
+
+
+def counters():
+    """Raw transaction and lock-wait counters of this process (no queries)."""
+    with _lock:
+        return dict(_stats)
+
+
+def stats():
+    """Pool and lock-wait statistics for this worker process."""
+    pid = os.getpid()
+    with _lock:
+        result = dict(_stats)
+        result['open_connections'] = sum(1 for k in _connections if k[0] == pid)
+        result['idle_connections'] = sum(1 for entry in _idle if entry[0] == pid)
+    transactions = result['transactions']
+    result['lock_wait_ms_avg'] = (result['lock_wait_ms_total'] / transactions) if transactions else 0.0
+    result['pid'] = pid
+    result['db_path'] = DB_PATH
+    result['journal_mode'] = get_connection().execute('PRAGMA journal_mode').fetchone()[0]
+    result['busy_timeout_ms'] = BUSY_TIMEOUT_MS
+    return result
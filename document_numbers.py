@@ -0,0 +1,58 @@
+"""Receiving TBS document number allocation.
+
+Numbers have the form ``TBS/YYYY/MM/DD/NNN`` and restart every day. The last
+issued value per day lives in ``document_sequences`` and is bumped inside the
+caller's write transaction, so allocation is O(1), cannot race between
+gunicorn workers and is rolled back together with a failed insert (no gaps).
+"""
+import datetime
+
+
+def create_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS document_sequences (
+            day TEXT PRIMARY KEY,
+            last_value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+def format_document_no(day, value):
+    return f"TBS/{day}/{value:03d}"
+
+
+def _seed_value(cursor, day):
+    # First allocation of the day on a database that predates the sequence
+    # table: continue after the highest number already issued for that day.
+    prefix = format_document_no(day, 0)[:-3]
+    cursor.execute('''
+        SELECT COALESCE(MAX(CAST(substr(document_no, ?) AS INTEGER)), 0)
+        FROM receiving_tbs
+        WHERE document_no >= ? AND document_no < ?
+    ''', (len(prefix) + 1, prefix + '0', prefix + ':'))
+    return cursor.fetchone()[0]
+
+
+def allocate(conn, count=1, now=None):
+    """Reserve ``count`` consecutive document numbers for today.
+
+    Must run inside ``db.transaction()``; the reservation commits or rolls
+    back with the rows that use it.
+    """
+    if count < 1:
+        return []
+    if not conn.in_transaction:
+        raise RuntimeError("document numbers must be allocated inside a write transaction")
+
+    now = now or datetime.datetime.now()
+    day = now.strftime('%Y/%m/%d')
+    cursor = conn.cursor()
+
+    cursor.execute('UPDATE document_sequences SET last_value = last_value + ? WHERE day = ?', (count, day))
+    if cursor.rowcount == 0:
+        cursor.execute('INSERT INTO document_sequences (day, last_value) VALUES (?, ?)',
+                       (day, _seed_value(cursor, day) + count))
+    cursor.execute('SELECT last_value FROM document_sequences WHERE day = ?', (day,))
+    last = cursor.fetchone()[0]
+
+    return [format_document_no(day, value) for value in range(last - count + 1, last + 1)]
@@ -0,0 +1,153 @@
+"""Streaming exports of api_logs and receiving TBS data.
+
+Rows are read from an iterating cursor in chunks and never collected into a
+list. Excel files are written with openpyxl's write-only mode into a temporary
+file on disk; CSV and NDJSON are sent to the client chunk by chunk.
+
+Every export accepts the same query string filters:
+
+* ``start`` / ``end``  inclusive date range (YYYY-MM-DD)
+* ``basis``            which date the range applies to: ``created`` (default,
+                       the middleware timestamp), ``order`` (date_order) and,
+                       for order lines, ``incoming`` or ``outgoing``
+* ``columns``          comma separated subset of the table's columns
+
+Payload columns are exported as text, read back from payload_blobs.
+"""
+import csv
+import io
+import tempfile
+
+from openpyxl import Workbook
+
+import dates
+import jsonutil
+import payloads
+
+FETCH_SIZE = 1000
+
+# Excel's hard limit is 1,048,576 rows including the header
+MAX_SHEET_ROWS = 1048575
+
+# Date bases per table: (column, optional wrapper applying the range through the header)
+_VIA_HEADER = 'receiving_tbs_id IN (SELECT id FROM receiving_tbs WHERE {})'
+DATE_BASES = {
+    'api_logs': {'created': ('timestamp', None)},
+    'receiving_tbs': {'created': ('timestamp', None), 'order': ('date_order_epoch', None)},
+    'order_line': {'created': ('timestamp', _VIA_HEADER), 'order': ('date_order_epoch', _VIA_HEADER),
+                   'incoming': ('incoming_epoch', None), 'outgoing': ('outgoing_epoch', None)},
+}
+
+
+def table_columns(conn, table):
+    hashes = {key for _, key in payloads.PAYLOAD_COLUMNS.get(table, [])}
+    return [column[1] for column in conn.execute(f'PRAGMA table_info({table})') if column[1] not in hashes]
+
+
+def select_expression(table, column):
+    for text, key in payloads.PAYLOAD_COLUMNS.get(table, []):
+        if column == text:
+            return f'{payloads.sql_text(text, key)} AS {text}'
+    return column
+
+
+def date_clause(table, basis, start, end):
+    """Index-friendly range clauses for ``table`` on the chosen date basis."""
+    if basis not in DATE_BASES[table]:
+        raise ValueError(f"Unknown date basis for {table}: {basis}")
+    column, wrapper = DATE_BASES[table][basis]
+    if column.endswith('_epoch'):
+        clauses, params = dates.epoch_range_clause(column, start, end)
+    else:
+        clauses, params = dates.text_range_clause(column, start, end)
+    if clauses and wrapper:
+        clauses = [wrapper.format(' AND '.join(clauses))]
+    return clauses, params
+
+
+def build_query(conn, table, args, order_by):
+    """Build the SELECT for ``table`` from request filters.
+
+    Returns ``(sql, params, columns)``; raises ValueError on bad filters.
+    """
+    available = table_columns(conn, table)
+    requested = [c.strip() for c in args.get('columns', '').split(',') if c.strip()]
+    unknown = [c for c in requested if c not in available]
+    if unknown:
+        raise ValueError(f"Unknown columns for {table}: {', '.join(unknown)}")
+    columns = requested or available
+
+    clauses, params = date_clause(table, args.get('basis') or 'created', args.get('start'), args.get('end'))
+
+    sql = f"SELECT {', '.join(select_expression(table, c) for c in columns)} FROM {table}"
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += f' ORDER BY {order_by}'
+    return sql, params, columns
+
+
+def iter_rows(conn, sql, params):
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        yield from rows
+
+
+def write_workbook(sheets):
+    """Write ``(title, columns, rows)`` sheets to a temporary .xlsx file.
+
+    Returns the open file positioned at the start; it is deleted on close.
+    """
+    wb = Workbook(write_only=True)
+    for title, columns, rows in sheets:
+        ws = None
+        part = 0
+        written = MAX_SHEET_ROWS
+        for row in rows:
+            if written >= MAX_SHEET_ROWS:
+                part += 1
+                ws = wb.create_sheet(title if part == 1 else f"{title} ({part})")
+                ws.append(columns)
+                written = 0
+            ws.append(row)
+            written += 1
+        if ws is None:
+            wb.create_sheet(title).append(columns)
+
+    output = tempfile.TemporaryFile(suffix='.xlsx')
+    wb.save(output)
+    output.seek(0)
+    return output
+
+
+def stream_csv(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % FETCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_ndjson(columns, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(jsonutil.dumps(dict(zip(columns, row))))
+        if len(chunk) >= FETCH_SIZE:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
+
+
+STREAM_FORMATS = {
+    'csv': (stream_csv, 'text/csv'),
+    'ndjson': (stream_ndjson, 'application/x-ndjson'),
+}
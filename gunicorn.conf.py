@@ -0,0 +1,37 @@
+"""gunicorn settings for SAGAPI-Proto (loaded from the working directory)."""
+import os
+
+# Each open /logs/stream holds one of ``threads`` under gthread, and only half of
+# them may stream (4 with the default 8). gevent holds hundreds of streams, but
+# sqlite3 does not yield to its hub: a statement or a busy_timeout wait freezes
+# every greenlet of the worker (see benchmarks/write_lock_stall.py). Plain sync
+# workers cannot stream at all (see log_stream.py).
+worker_class = os.environ.get('SAGAPI_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('SAGAPI_WORKER_THREADS', 8))
+worker_connections = int(os.environ.get('SAGAPI_WORKER_CONNECTIONS', 1000))
+
+if worker_class == 'gevent':
+    # Patch before db and the app create their thread-locals and locks
+    from gevent import monkey
+    monkey.patch_all()
+
+import db
+import metrics
+import migrations
+
+
+def on_starting(server):
+    # Runs once in the master before any worker is forked; workers only verify the version
+    applied = migrations.migrate(log=server.log.info)
+    server.log.info(f"Database schema at version {migrations.current_version()}"
+                    + ("" if applied else " (up to date)"))
+    db.close_all()
+    # Counters restart with the server; exited workers' snapshots are kept until then
+    metrics.reset()
+
+
+def post_worker_init(worker):
+    # Drain threads start on the first enqueue; at boot only for tickets left by a crashed worker
+    from ingest_queue import ingest
+    ingest.resume()
+    db.release()
@@ -0,0 +1,164 @@
+"""Conditional GET and response compression.
+
+``install(app)`` adds an ``after_request`` hook that, for GET requests:
+
+* gives every buffered 200 response without validators a weak ETag hashed
+  from its body and answers a matching ``If-None-Match`` with 304, so a
+  refreshed dashboard or JSON admin page costs headers only;
+* compresses HTML, JSON, CSV, NDJSON and plain text with brotli (when the
+  ``brotli`` package is installed) or gzip, as negotiated through
+  ``Accept-Encoding``. Streamed exports are compressed chunk by chunk.
+
+Write-once records (``/transaction/<id>``, ``/log/<id>``) can do better: their
+ETag is known from the row id before anything is rendered, so
+``record_response()`` answers 304 without rendering, and ``pages`` keeps the
+most recently rendered detail pages per worker. Both are keyed by
+``TEMPLATE_VERSION``, a hash of the templates, so a deploy that changes a
+template invalidates them.
+"""
+import datetime
+import hashlib
+import os
+import zlib
+
+from flask import Response, request, session
+
+from cache import TTLCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENABLED = os.environ.get('SAGAPI_COMPRESSION', 'on') != 'off'
+MIN_SIZE = int(os.environ.get('SAGAPI_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('SAGAPI_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('SAGAPI_BROTLI_QUALITY', 5))
+
+COMPRESSIBLE = ('text/html', 'application/json', 'text/csv', 'application/x-ndjson', 'text/plain',
+                'application/javascript', 'text/css')
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+
+def _template_version():
+    digest = hashlib.sha1()
+    for root, _, names in sorted(os.walk(TEMPLATES_DIR)):
+        for name in sorted(names):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(name.encode('utf-8'))
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+TEMPLATE_VERSION = _template_version()
+
+# Rendered detail pages: (kind, id, username) -> html
+pages = TTLCache(maxsize=int(os.environ.get('SAGAPI_PAGE_CACHE_SIZE', 256)),
+                 ttl=float(os.environ.get('SAGAPI_PAGE_CACHE_TTL', 3600)))
+
+
+def _etag(kind, record_id):
+    # The page shows the username, so each login gets its own validator
+    user = session.get('username', '')
+    return hashlib.sha1(f'{kind}|{record_id}|{user}|{TEMPLATE_VERSION}'.encode('utf-8')).hexdigest()[:20]
+
+
+def record_response(kind, record_id, timestamp, render):
+    """Response for the page of a write-once record created at ``timestamp``.
+
+    Answers 304 without calling ``render`` when the client's copy is
+    current, otherwise serves the page from ``pages``.
+    """
+    etag = _etag(kind, record_id)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    elif '_flashes' in session:
+        # Flashed messages are consumed by rendering, so this page must not be cached
+        response = Response(render(), mimetype='text/html')
+    else:
+        response = Response(pages.get_or_set((kind, record_id, session.get('username', '')), render),
+                            mimetype='text/html')
+    response.set_etag(etag, weak=True)
+    if timestamp:
+        # Stored timestamps are local time
+        response.last_modified = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').astimezone()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _negotiate():
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def _compress_stream(chunks, encoding):
+    try:
+        yield from _compressed_chunks(chunks, encoding)
+    finally:
+        # Lets stream_with_context and timed exports clean up when the client goes away
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _compressed_chunks(chunks, encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            data = compressor.process(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            data += compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            # Sync flush keeps rows flowing to the client instead of buffering
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def _compress(response):
+    if (not ENABLED or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE or response.status_code != 200
+            or 'no-transform' in (response.headers.get('Cache-Control') or '')):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _negotiate()
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < MIN_SIZE:
+            return response
+        if encoding == 'br':
+            response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+        else:
+            response.set_data(zlib.compress(body, GZIP_LEVEL, wbits=31))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def after_request(response):
+    if request.method not in ('GET', 'HEAD'):
+        return response
+    if response.status_code == 200 and not response.is_streamed and not response.direct_passthrough:
+        if 'ETag' not in response.headers:
+            response.add_etag(weak=True)
+            if not response.cache_control.public:
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+        response.make_conditional(request)
+    return _compress(response)
+
+
+def install(app):
+    app.after_request(after_request)
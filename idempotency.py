@@ -0,0 +1,162 @@
+"""Replay protection for receiving TBS creation.
+
+A request is identified by its ``Idempotency-Key`` header or, without one, by
+a hash of its normalized payload (keys sorted, ``token`` left out), scoped to
+the endpoint and the authenticated login. The first request with a key runs
+normally and its response is stored in ``idempotency_keys`` for
+``IDEMPOTENCY_TTL`` seconds; repeats get that response back without
+validation, document numbers or inserts.
+
+The stored-key check and the work it guards run in the same ``BEGIN
+IMMEDIATE`` transaction, so concurrent duplicates in any gunicorn worker queue
+on the write lock and the second one finds the first one's response. Stored
+responses never change, so workers cache them in memory.
+"""
+import hashlib
+import os
+import time
+
+import db
+import jsonutil
+from cache import TTLCache
+
+IDEMPOTENCY_TTL = int(os.environ.get('SAGAPI_IDEMPOTENCY_TTL', 24 * 3600))
+HASH_PAYLOADS = os.environ.get('SAGAPI_IDEMPOTENCY_PAYLOAD_HASH', 'on') != 'off'
+
+# key -> (response_code, response)
+_cache = TTLCache(maxsize=int(os.environ.get('SAGAPI_IDEMPOTENCY_CACHE_SIZE', 10000)),
+                  ttl=min(300, IDEMPOTENCY_TTL))
+
+
+def create_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            response_code INTEGER NOT NULL,
+            response_body TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)')
+
+
+def normalize(payload):
+    """Canonical JSON of a request payload without its credentials."""
+    if isinstance(payload, dict):
+        payload = {k: v for k, v in payload.items() if k != 'token'}
+    elif isinstance(payload, list):
+        payload = [{k: v for k, v in item.items() if k != 'token'} if isinstance(item, dict) else item
+                   for item in payload]
+    return jsonutil.dumps(payload, sort_keys=True)
+
+
+def request_key(endpoint, header_value, login, payload):
+    """Storage key for a request, or None when it cannot be deduplicated."""
+    if header_value:
+        source = f'key:{header_value.strip()}'
+    elif HASH_PAYLOADS:
+        source = 'payload:' + hashlib.sha256(normalize(payload).encode('utf-8')).hexdigest()
+    else:
+        return None
+    return hashlib.sha256(f'{endpoint}|{login}|{source}'.encode('utf-8')).hexdigest()
+
+
+def _stored(conn, key, now):
+    row = conn.execute('SELECT response_code, response_body FROM idempotency_keys WHERE key = ? AND expires_at > ?',
+                       (key, now)).fetchone()
+    return (row[0], jsonutil.loads(row[1])) if row else None
+
+
+def run(key, produce):
+    """Return ``(response, code, replayed)`` for ``key``, calling ``produce`` at most once.
+
+    ``produce()`` returns ``(response, code)`` and runs inside the write
+    transaction; responses with a 5xx code are not stored, so those retry.
+    """
+    if key is None:
+        response, code = produce()
+        return response, code, False
+
+    entry = _cache.get(key)
+    if entry is None:
+        entry = _stored(db.get_connection(), key, int(time.time()))
+    if entry is not None:
+        _cache.set(key, entry)
+        return entry[1], entry[0], True
+
+    with db.transaction() as conn:
+        now = int(time.time())
+        # A concurrent duplicate may have committed while we waited for the lock
+        entry = _stored(conn, key, now)
+        if entry is not None:
+            _cache.set(key, entry)
+            return entry[1], entry[0], True
+
+        response, code = produce()
+        if code >= 500:
+            return response, code, False
+        conn.execute('''
+            INSERT OR REPLACE INTO idempotency_keys (key, created_at, expires_at, response_code, response_body)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (key, now, now + IDEMPOTENCY_TTL, code, jsonutil.dumps(response)))
+
+    _cache.set(key, (code, response))
+    return response, code, False
+
+
+def run_many(keys, produce):
+    """Batch form of ``run()``: one write transaction for several keys.
+
+    ``produce(indexes)`` gets the positions whose key has no stored response
+    and returns one ``(response, code)`` per position. Returns one
+    ``(response, code, replayed)`` per key. Only successful responses are
+    stored, so a rejected entry can be corrected and sent again under the
+    same key.
+    """
+    results = [None] * len(keys)
+    with db.transaction() as conn:
+        now = int(time.time())
+        fresh = []
+        # A key repeated within the batch gets the outcome of its first occurrence
+        first = {}
+        repeats = []
+        for index, key in enumerate(keys):
+            if key is not None and key in first:
+                repeats.append((index, first[key]))
+                continue
+            entry = _stored(conn, key, now) if key is not None else None
+            if entry is not None:
+                results[index] = (entry[1], entry[0], True)
+            else:
+                first[key] = index
+                fresh.append(index)
+        if fresh:
+            produced = produce(fresh)
+            stored = []
+            for index, (response, code) in zip(fresh, produced):
+                results[index] = (response, code, False)
+                if keys[index] is not None and code < 300:
+                    stored.append((keys[index], now, now + IDEMPOTENCY_TTL, code, jsonutil.dumps(response)))
+            conn.executemany('''
+                INSERT OR REPLACE INTO idempotency_keys (key, created_at, expires_at, response_code, response_body)
+                VALUES (?, ?, ?, ?, ?)
+            ''', stored)
+    for index, source in repeats:
+        response, code, _ = results[source]
+        results[index] = (response, code, code < 300)
+    return results
+
+
+def purge_expired(now=None):
+    """Delete keys past their TTL; returns how many rows went."""
+    now = int(now or time.time())
+    with db.transaction() as conn:
+        return conn.execute('DELETE FROM idempotency_keys WHERE expires_at <= ?', (now,)).rowcount
+
+
+def stats():
+    result = _cache.stats()
+    result['key_ttl'] = IDEMPOTENCY_TTL
+    result['hash_payloads'] = HASH_PAYLOADS
+    return result
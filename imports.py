@@ -0,0 +1,218 @@
+"""Bulk import of receiving TBS tickets from an Excel or CSV file.
+
+Meant for tickets a mill collected while its agent was offline. The sheet has
+one row per order line, with the header fields repeated on every row and
+columns named like the create payload fields (``partner_id``, ...,
+``product_code``, ``qty_brutto``, ...). Consecutive rows with the same
+``ticket`` value (an optional column) form one order; without that column,
+consecutive rows with identical header fields do. Header values are taken
+from the first row of each order.
+
+Rows are read as a stream: CSV through a text wrapper over the uploaded
+file, XLSX with openpyxl's read-only mode, which parses the sheet XML
+incrementally. Orders are collected into batches of ``SAGAPI_IMPORT_BATCH_SIZE``
+and stored with ``receiving.create_orders()``, so they are validated like
+``/api/receiving-tbs/create`` and each batch is one transaction with one block
+of document numbers. Only the current batch is held in memory, however large
+the file.
+
+Each order is keyed in the idempotency store (see idempotency.py) by its
+``ticket`` value or, without that column, by a hash of its fields, so
+uploading a file again skips the orders already created from it within
+``SAGAPI_IDEMPOTENCY_TTL``. Keys are shared by every operator. Rejected orders
+are not remembered and can be corrected and uploaded again.
+
+``run()`` yields events for the client: ``progress`` after every committed
+batch, one ``error`` per rejected order (with its sheet row numbers), and a
+final ``done`` summary; ``skipped`` counts orders already imported. An import
+cut short keeps every batch reported as committed.
+"""
+import csv
+import datetime
+import io
+import os
+import re
+
+from openpyxl import load_workbook
+
+import idempotency
+import jsonutil
+import receiving
+import validation
+
+FORMATS = ('csv', 'xlsx')
+BATCH_SIZE = int(os.environ.get('SAGAPI_IMPORT_BATCH_SIZE', 500))
+
+ENDPOINT = '/admin/import'
+TICKET_COLUMN = 'ticket'
+HEADER_FIELDS = validation.ORDER_COLUMNS
+LINE_FIELDS = tuple(name for name, _ in validation.LINE_SCHEMA)
+REQUIRED_COLUMNS = tuple(name for name, field in validation.ORDER_SCHEMA + validation.LINE_SCHEMA
+                         if field.required)
+
+# Agents send dates in this format (see dates.AGENT_DATE_FORMATS)
+DATE_FORMAT = '%d/%m/%Y %H:%M:%S'
+
+_LINE_PATH = re.compile(r'\.order_line\[(\d+)\]')
+
+
+def detect_format(filename):
+    extension = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    if extension not in FORMATS:
+        raise ValueError(f"Unsupported file type '{extension or filename}', expected .xlsx or .csv")
+    return extension
+
+
+def _column_name(value):
+    return str(value or '').strip().lower().replace(' ', '_')
+
+
+def _cell(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATE_FORMAT)
+    if isinstance(value, datetime.date):
+        return value.strftime('%d/%m/%Y')
+    if isinstance(value, float) and value.is_integer():
+        # Excel stores every number as a float; keeps codes like vehicle numbers free of '.0'
+        return int(value)
+    if isinstance(value, str):
+        return value.strip() or None
+    return value
+
+
+def _csv_rows(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    sample = text.read(8192)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    return csv.reader(text, dialect)
+
+
+def _xlsx_rows(stream):
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    return workbook.active.iter_rows(values_only=True)
+
+
+def open_rows(stream, fmt):
+    """``(columns, rows)`` of a file; rows yields ``(row_number, {column: value})``.
+
+    Reads the header row right away and raises ValueError when it lacks a
+    required column.
+    """
+    try:
+        raw = _xlsx_rows(stream) if fmt == 'xlsx' else _csv_rows(stream)
+        header = next(iter(raw), None)
+    except Exception as e:
+        # csv decode errors, or zipfile and XML errors from openpyxl for anything that is not a workbook
+        raise ValueError(f"Cannot read the {fmt} file: {e}")
+    if header is None:
+        raise ValueError("The file is empty")
+    columns = [_column_name(value) for value in header]
+    missing = [name for name in REQUIRED_COLUMNS if name not in columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    def rows():
+        for number, values in enumerate(raw, 2):
+            row = {name: _cell(value) for name, value in zip(columns, values) if name}
+            if any(value is not None for value in row.values()):
+                yield number, row
+    return columns, rows()
+
+
+def iter_orders(rows, by_ticket):
+    """Group rows into ``(row_numbers, ticket, order)``, in file order; ticket is None without that column."""
+    key = None
+    numbers, order = [], None
+    for number, row in rows:
+        row_key = row.get(TICKET_COLUMN) if by_ticket else tuple(row.get(name) for name in HEADER_FIELDS)
+        if order is not None and row_key == key and (row_key is not None or not by_ticket):
+            numbers.append(number)
+            order['order_line'].append({name: row.get(name) for name in LINE_FIELDS})
+            continue
+        if order is not None:
+            yield numbers, key if by_ticket else None, order
+        key = row_key
+        numbers = [number]
+        order = {name: row.get(name) for name in HEADER_FIELDS}
+        order['order_line'] = [{name: row.get(name) for name in LINE_FIELDS}]
+    if order is not None:
+        yield numbers, key if by_ticket else None, order
+
+
+def _error_rows(numbers, path):
+    match = _LINE_PATH.search(path)
+    if match and int(match.group(1)) < len(numbers):
+        return numbers[int(match.group(1))]
+    return numbers[0]
+
+
+def _key(ticket, order):
+    if ticket is not None:
+        return idempotency.request_key(ENDPOINT, f'ticket:{ticket}', '', None)
+    return idempotency.request_key(ENDPOINT, None, '', order)
+
+
+def _store(batch, source, totals):
+    entries = [(order, {"jsonrpc": "2.0", "params": {"order_data": [order]},
+                        "import": {"file": source, "rows": [numbers[0], numbers[-1]]}})
+               for numbers, _, order in batch]
+
+    def produce(indexes):
+        results = receiving.create_orders([entries[index] for index in indexes])
+        return [({key: value for key, value in result.items() if key != 'index'}, result['code'])
+                for result in results]
+
+    events = []
+    keys = [_key(ticket, order) for _, ticket, order in batch]
+    for (numbers, _, _), (result, _, replayed) in zip(batch, idempotency.run_many(keys, produce)):
+        if replayed:
+            totals['skipped'] += 1
+            continue
+        if result['code'] == 200:
+            totals['created'] += 1
+            continue
+        totals['failed'] += 1
+        events.append({
+            "event": "error",
+            "rows": [numbers[0], numbers[-1]],
+            "message": result['message'],
+            "errors": [{"row": _error_rows(numbers, error['path']),
+                        "field": error['path'].rpartition('.')[2],
+                        "message": error['message']} for error in result['errors']],
+        })
+    return events
+
+
+def run(columns, rows, source, batch_size=None):
+    """Import the grouped rows in batches; yields event dicts (see module docstring)."""
+    batch_size = batch_size or BATCH_SIZE
+    totals = {'rows': 0, 'orders': 0, 'created': 0, 'skipped': 0, 'failed': 0, 'batches': 0}
+    by_ticket = TICKET_COLUMN in columns
+    batch = []
+    last_row = 1
+
+    def flush():
+        events = _store(batch, source, totals)
+        totals['batches'] += 1
+        batch.clear()
+        return events + [dict(event='progress', last_row=last_row, **totals)]
+
+    for numbers, ticket, order in iter_orders(rows, by_ticket):
+        totals['rows'] += len(numbers)
+        totals['orders'] += 1
+        last_row = numbers[-1]
+        batch.append((numbers, ticket, order))
+        if len(batch) >= batch_size:
+            yield from flush()
+    if batch:
+        yield from flush()
+    yield dict(event='done', file=source, **totals)
+
+
+def stream_ndjson(events):
+    for event in events:
+        yield jsonutil.dumps(event) + '\n'
@@ -0,0 +1,298 @@
+"""Durable queue for asynchronous receiving TBS creation.
+
+With ``SAGAPI_INGEST_MODE=async`` (or a ``Prefer: respond-async`` header) the
+create endpoint validates the ticket, appends it to the ``ingest_queue`` table
+and answers 202 with a ticket id right away. Background threads drain the
+queue; a worker process starts them on its first enqueued ticket, or at boot
+when tickets are already waiting, so sync-mode workers run none. Each pass
+claims up to ``batch_size`` queued
+tickets, creates their orders and stores the final responses in one write
+transaction, so a burst of tickets costs one lock acquisition and one commit
+instead of one per request. Agents poll
+``GET /api/receiving-tbs/status/<ticket>`` for the document number or error.
+
+Crash recovery needs no extra bookkeeping: claiming, inserting and marking a
+ticket done commit together, so a worker that dies mid-batch leaves its
+tickets queued for the next pass of any running drain thread, or of the
+replacement worker at boot. A ticket whose creation
+raises is retried up to ``max_attempts`` times, then fails with a 500
+response. Each retry waits for ``retry_backoff`` seconds, doubled per failed
+attempt, in ``not_before``. Enqueueing refuses new tickets once ``max_pending`` are waiting.
+"""
+import atexit
+import datetime
+import os
+import threading
+import time
+import uuid
+
+import db
+import jsonutil
+import metrics
+import receiving
+from log_writer import writer as log_writer
+
+MODES = ('sync', 'async')
+
+ENDPOINT = '/api/receiving-tbs/create'
+
+
+class QueueFull(Exception):
+    """Raised by ``enqueue()`` when ``max_pending`` tickets are waiting."""
+
+
+def create_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket TEXT UNIQUE NOT NULL,
+            login TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER,
+            agent_name TEXT,
+            site TEXT,
+            ip_address TEXT,
+            payload TEXT,
+            response_code INTEGER,
+            response_body TEXT,
+            last_error TEXT
+        )
+    ''')
+    # Workers only ever look for the oldest queued tickets
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ingest_queue_pending ON ingest_queue (id) WHERE status = 'queued'")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ingest_queue_finished ON ingest_queue (finished_at)')
+
+
+class IngestQueue:
+    def __init__(self, mode='sync', workers=1, batch_size=100, poll_interval_ms=500,
+                 max_pending=10000, max_attempts=3, retry_backoff_s=2, retention_days=7):
+        if mode not in MODES:
+            raise ValueError(f"Unknown ingest mode: {mode}")
+        self.mode = mode
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval_ms / 1000.0
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff_s
+        self.retention_days = retention_days
+
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'enqueued': 0,
+            'rejected': 0,
+            'processed': 0,
+            'failed': 0,
+            'retries': 0,
+            'batches': 0,
+            'batch_ms_last': 0.0,
+            'batch_ms_max': 0.0,
+            'batch_ms_total': 0.0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            mode=os.environ.get('SAGAPI_INGEST_MODE', 'sync'),
+            workers=int(os.environ.get('SAGAPI_INGEST_WORKERS', 1)),
+            batch_size=int(os.environ.get('SAGAPI_INGEST_BATCH_SIZE', 100)),
+            poll_interval_ms=int(os.environ.get('SAGAPI_INGEST_POLL_MS', 500)),
+            max_pending=int(os.environ.get('SAGAPI_INGEST_MAX_PENDING', 10000)),
+            max_attempts=int(os.environ.get('SAGAPI_INGEST_MAX_ATTEMPTS', 3)),
+            retry_backoff_s=int(os.environ.get('SAGAPI_INGEST_RETRY_BACKOFF_S', 2)),
+            retention_days=int(os.environ.get('SAGAPI_INGEST_RETENTION_DAYS', 7)),
+        )
+
+    def _incr(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def wants_async(self, prefer_header):
+        """Whether a create request should be queued (mode or ``Prefer: respond-async``)."""
+        return self.mode == 'async' or 'respond-async' in (prefer_header or '').lower()
+
+    # Producer side
+    def start(self):
+        """Start this process's drain threads (again after fork); also picks up tickets left by a crash."""
+        pid = os.getpid()
+        if self._pid == pid and all(thread.is_alive() for thread in self._threads):
+            return
+        with self._start_lock:
+            if self._pid == pid and all(thread.is_alive() for thread in self._threads):
+                return
+            if self._pid != pid:
+                self._threads = []
+                self._wake = threading.Event()
+                self._stopping = threading.Event()
+            self._pid = pid
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f'ingest-worker-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def resume(self):
+        """Start the drain threads at boot only when tickets are waiting; returns whether it did."""
+        if db.get_connection().execute(
+                "SELECT 1 FROM ingest_queue WHERE status = 'queued' LIMIT 1").fetchone() is None:
+            return False
+        self.start()
+        return True
+
+    def enqueue(self, data, login, agent_name=None, site=None, ip_address=None):
+        """Append a validated create payload; returns its ticket id.
+
+        Joins the caller's transaction when there is one, so the pending
+        count and the insert see the same queue. Call ``notify()`` once that
+        transaction has committed.
+        """
+        ticket = uuid.uuid4().hex
+        with db.transaction() as conn:
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM (SELECT 1 FROM ingest_queue WHERE status = 'queued' LIMIT ?)",
+                (self.max_pending,)).fetchone()[0]
+            if pending >= self.max_pending:
+                self._incr('rejected')
+                raise QueueFull(f"{pending} tickets are already waiting")
+            conn.execute('''
+                INSERT INTO ingest_queue (ticket, login, created_at, agent_name, site, ip_address, payload)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (ticket, login, int(time.time()), agent_name, site, ip_address, jsonutil.dumps(data)))
+        self._incr('enqueued')
+        return ticket
+
+    def notify(self):
+        """Wake this process's drain threads for newly committed tickets, starting them if needed."""
+        self.start()
+        self._wake.set()
+
+    def status(self, ticket, login):
+        """``(status, response_code, response)`` of a ticket owned by ``login``, or None."""
+        row = db.get_connection().execute(
+            'SELECT status, response_code, response_body FROM ingest_queue WHERE ticket = ? AND login = ?',
+            (ticket, login)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], jsonutil.loads(row[2]) if row[2] else None
+
+    def stop(self, timeout=10.0):
+        """Let the drain threads finish their current batch and exit."""
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    # Consumer side
+    def _run(self):
+        while not self._stopping.is_set():
+            # Cleared before draining so a ticket queued meanwhile wakes the next pass
+            self._wake.clear()
+            try:
+                processed = self.drain_once()
+            except Exception as e:
+                print(f"ingest queue worker error: {e}")
+                processed = 0
+            if not processed:
+                self._wake.wait(self.poll_interval)
+
+    def drain_once(self):
+        """Process one batch of due tickets; returns how many were finished (not retried)."""
+        now = int(time.time())
+        # Cheap read first so idle workers do not take the write lock
+        if db.get_connection().execute(
+                "SELECT 1 FROM ingest_queue WHERE status = 'queued' AND not_before <= ? LIMIT 1",
+                (now,)).fetchone() is None:
+            return 0
+
+        start = time.perf_counter()
+        logs = []
+        with metrics.timer('ingest_batch'), db.transaction() as conn:
+            rows = conn.execute('''
+                SELECT id, ticket, attempts, created_at, agent_name, site, ip_address, payload
+                FROM ingest_queue WHERE status = 'queued' AND not_before <= ? ORDER BY id LIMIT ?
+            ''', (now, self.batch_size)).fetchall()
+            for row_id, ticket, attempts, created_at, agent_name, site, ip_address, payload in rows:
+                data = payload
+                conn.execute('SAVEPOINT ingest_ticket')
+                try:
+                    data = jsonutil.loads(payload)
+                    response, code = receiving.create_response(data['params']['order_data'], data)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO ingest_ticket')
+                    conn.execute('RELEASE ingest_ticket')
+                    print(f"ingest queue ticket {ticket} error: {e}")
+                    if attempts + 1 < self.max_attempts:
+                        conn.execute('UPDATE ingest_queue SET attempts = ?, not_before = ?, last_error = ? WHERE id = ?',
+                                     (attempts + 1, now + self.retry_backoff * 2 ** attempts, str(e), row_id))
+                        self._incr('retries')
+                        continue
+                    response, code = {"code": 500, "message": f"Internal server error: {e}"}, 500
+                    self._incr('failed')
+                else:
+                    conn.execute('RELEASE ingest_ticket')
+                conn.execute('''
+                    UPDATE ingest_queue
+                    SET status = ?, attempts = ?, finished_at = ?, payload = NULL,
+                        response_code = ?, response_body = ?
+                    WHERE id = ?
+                ''', ('failed' if code >= 500 else 'done', attempts + 1, now, code, jsonutil.dumps(response), row_id))
+                logs.append(self._log_record(created_at, agent_name, site, ip_address, data, response, code))
+
+        # Only committed outcomes reach api_logs
+        for record in logs:
+            log_writer.submit(record)
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        with self._stats_lock:
+            self._stats['processed'] += len(logs)
+            self._stats['batches'] += 1
+            self._stats['batch_ms_last'] = elapsed_ms
+            self._stats['batch_ms_total'] += elapsed_ms
+            if elapsed_ms > self._stats['batch_ms_max']:
+                self._stats['batch_ms_max'] = elapsed_ms
+        # Retried tickets are not progress; the caller waits before the next pass
+        return len(logs)
+
+    def _log_record(self, created_at, agent_name, site, ip_address, data, response, code):
+        # Same row the synchronous endpoint writes, stamped with the time the ticket arrived
+        timestamp = datetime.datetime.fromtimestamp(created_at).strftime('%Y-%m-%d %H:%M:%S')
+        orders = (data.get('params') or {}).get('order_data') or [] if isinstance(data, dict) else []
+        if code == 200 or len(orders) > 1:
+            return (timestamp, ENDPOINT, agent_name, site, 'success' if code == 200 else 'error', code,
+                    data, response, ip_address)
+        return (timestamp, ENDPOINT, None, None, 'error', code, data, response, ip_address)
+
+    def purge_finished(self, now=None):
+        """Delete processed tickets older than the retention window; returns how many went."""
+        cutoff = int(now or time.time()) - self.retention_days * 86400
+        with db.transaction() as conn:
+            return conn.execute('DELETE FROM ingest_queue WHERE finished_at <= ?', (cutoff,)).rowcount
+
+    def stats(self):
+        with self._stats_lock:
+            result = dict(self._stats)
+        conn = db.get_connection()
+        result['pending'], oldest = conn.execute(
+            "SELECT COUNT(*), MIN(created_at) FROM ingest_queue WHERE status = 'queued'").fetchone()
+        result['oldest_pending_seconds'] = int(time.time()) - oldest if oldest else 0
+        result['batch_ms_avg'] = (result['batch_ms_total'] / result['batches']) if result['batches'] else 0.0
+        result['mode'] = self.mode
+        result['workers'] = self.workers
+        result['batch_size'] = self.batch_size
+        result['max_pending'] = self.max_pending
+        result['running'] = self._pid == os.getpid() and any(thread.is_alive() for thread in self._threads)
+        return result
+
+
+ingest = IngestQueue.from_env()
+atexit.register(ingest.stop)
@@ -0,0 +1,66 @@
+"""JSON parsing and serialization, with orjson when it is installed.
+
+orjson is several times faster than the standard library for the payloads
+the agents send. Without it every function here falls back to ``json`` with
+the same compact, UTF-8 output (so payload hashes do not depend on which
+one is installed), and orjson stays an optional speed-up. Set
+``SAGAPI_JSON=stdlib`` to force the fallback (benchmarks, debugging).
+"""
+import json
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if os.environ.get('SAGAPI_JSON') == 'stdlib':
+    orjson = None
+
+BACKEND = 'orjson' if orjson else 'json'
+
+_COMPACT = {'separators': (',', ':')}
+
+
+def loads(data):
+    """Parse JSON from ``str`` or ``bytes``."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, sort_keys=False):
+    """Compact JSON text; raises TypeError for objects JSON cannot represent."""
+    if orjson:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode('utf-8')
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits; the stdlib decides whether it is representable
+            pass
+    return json.dumps(obj, separators=(',', ':'), sort_keys=sort_keys, ensure_ascii=False)
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask JSON provider: ``request.get_json()`` and ``jsonify`` through orjson.
+
+    Anything beyond compact output (indentation in debug mode, custom
+    arguments, types orjson does not know) goes through Flask's default.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson and (not kwargs or kwargs == _COMPACT):
+            option = orjson.OPT_PASSTHROUGH_DATETIME
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            try:
+                return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+            except orjson.JSONEncodeError:
+                pass
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
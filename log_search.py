@@ -0,0 +1,142 @@
+"""Full-text search over api_logs, including request and response payloads.
+
+``api_logs_fts`` is an external-content FTS5 table, kept in sync by triggers,
+so every write path (the background log writer, retention deletes, repairs)
+updates the index without extra code. Its content is the
+``api_logs_fts_source`` view, which reads request and response bodies back
+out of payload_blobs (see payloads.py).
+
+Search syntax accepted from operators:
+
+* ``BE 1234``             every term must appear
+* ``"TBS/2025/07/31/001"`` phrase query
+* ``sawit*``              prefix query
+"""
+import re
+import sqlite3
+
+import db
+import payloads
+
+FTS_COLUMNS = ('endpoint', 'agent_name', 'site', 'ip_address', 'request_body', 'response_body')
+
+_TERM_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+_enabled = None
+
+
+def _values(row=None):
+    """FTS column values of an api_logs row, with payload text resolved."""
+    prefix = f'{row}.' if row else ''
+    bodies = dict(payloads.PAYLOAD_COLUMNS['api_logs'])
+    return [payloads.sql_text(prefix + c, prefix + bodies[c]) if c in bodies else prefix + c
+            for c in FTS_COLUMNS]
+
+
+def create_schema(cursor):
+    """Create the FTS table and its triggers; backfill when the table is new."""
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='api_logs_fts'")
+    row = cursor.fetchone()
+    if row and "content='api_logs'" in row[0]:
+        # Index created before payload blobs: it read bodies straight from api_logs
+        for trigger in ('api_logs_fts_ai', 'api_logs_fts_ad', 'api_logs_fts_au'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        cursor.execute('DROP TABLE api_logs_fts')
+        row = None
+    existed = row is not None
+
+    columns = ', '.join(FTS_COLUMNS)
+    new_values = ', '.join(_values('new'))
+    old_values = ', '.join(_values('old'))
+    source = ', '.join(f'{value} AS {c}' for value, c in zip(_values(), FTS_COLUMNS))
+    cursor.execute(f'''
+        CREATE VIEW IF NOT EXISTS api_logs_fts_source AS
+        SELECT id, {source} FROM api_logs
+    ''')
+    try:
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS api_logs_fts USING fts5(
+                {columns}, content='api_logs_fts_source', content_rowid='id'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5: /logs falls back to LIKE search
+        print(f"Full-text search unavailable: {e}")
+        return
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS api_logs_fts_ai AFTER INSERT ON api_logs BEGIN
+            INSERT INTO api_logs_fts (rowid, {columns}) VALUES (new.id, {new_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS api_logs_fts_ad AFTER DELETE ON api_logs BEGIN
+            INSERT INTO api_logs_fts (api_logs_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS api_logs_fts_au AFTER UPDATE ON api_logs BEGIN
+            INSERT INTO api_logs_fts (api_logs_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO api_logs_fts (rowid, {columns}) VALUES (new.id, {new_values});
+        END
+    ''')
+
+    if not existed:
+        cursor.execute("INSERT INTO api_logs_fts (api_logs_fts) VALUES ('rebuild')")
+
+
+def is_enabled():
+    global _enabled
+    if _enabled is None:
+        cursor = db.get_connection().execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='api_logs_fts'")
+        _enabled = cursor.fetchone() is not None
+    return _enabled
+
+
+def build_match_query(text):
+    """Translate operator input into a safe FTS5 MATCH expression.
+
+    Every term is quoted so punctuation in vehicle or document numbers is
+    never parsed as FTS5 syntax; a trailing ``*`` keeps prefix matching.
+    """
+    parts = []
+    for phrase, term in _TERM_RE.findall(text):
+        if phrase:
+            parts.append('"' + phrase.replace('"', '""') + '"')
+            continue
+        prefix = term.endswith('*')
+        term = term.rstrip('*').replace('"', '""')
+        if term:
+            parts.append(f'"{term}"' + ('*' if prefix else ''))
+    return ' '.join(parts)
+
+
+def search(text, limit=50, offset=0):
+    """Ranked search (best bm25 match first) returning list columns and a snippet."""
+    match = build_match_query(text)
+    if not match:
+        return []
+    cursor = db.get_connection().execute('''
+        SELECT l.id, l.timestamp, l.endpoint, l.agent_name, l.site, l.status, l.response_code,
+               l.ip_address, bm25(api_logs_fts) AS score,
+               snippet(api_logs_fts, -1, '[', ']', '...', 12) AS snippet
+        FROM api_logs_fts
+        JOIN api_logs l ON l.id = api_logs_fts.rowid
+        WHERE api_logs_fts MATCH ?
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+    ''', (match, limit, offset))
+    return cursor.fetchall()
+
+
+def rebuild():
+    """Rebuild the full-text index from api_logs (backfill for existing databases)."""
+    global _enabled
+    _enabled = None
+    with db.transaction() as conn:
+        create_schema(conn.cursor())
+        if is_enabled():
+            conn.execute("INSERT INTO api_logs_fts (api_logs_fts) VALUES ('rebuild')")
+            conn.execute("INSERT INTO api_logs_fts (api_logs_fts) VALUES ('optimize')")
+    return is_enabled()
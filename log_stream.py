@@ -0,0 +1,249 @@
+"""Live tail of api_logs for Server-Sent Events subscribers.
+
+One hub per worker process fans new rows out to every ``/logs/stream``
+subscriber of that process. A single tailer thread reads
+``id > high-water mark`` in one query per wake-up, however many clients are
+connected, and only while any are. The local log writer wakes it right after
+each commit; rows written by other gunicorn workers are picked up within
+``poll_interval_ms``. Row ids are assigned under SQLite's write lock, so a
+growing high-water mark never skips a committed row.
+
+Subscribers are plain objects with a bounded buffer and an Event; they hold
+no thread of their own, so with gevent workers (see gunicorn.conf.py) a
+worker can keep hundreds of idle streams open. A client that reconnects with
+``Last-Event-ID`` gets the rows it missed from the database first. A
+subscriber that falls ``buffer_size`` rows behind is disconnected and catches
+up the same way.
+"""
+import os
+import threading
+import time
+
+import db
+import jsonutil
+from log_writer import writer as log_writer
+
+# Must match gunicorn.conf.py: a stream occupies a thread under gthread, only a greenlet under gevent
+WORKER_CLASS = os.environ.get('SAGAPI_WORKER_CLASS', 'gthread')
+WORKER_THREADS = int(os.environ.get('SAGAPI_WORKER_THREADS', 8))
+HEARTBEAT_SECONDS = 15
+RETRY_MS = 3000
+
+COLUMNS = ('id', 'timestamp', 'endpoint', 'agent_name', 'site', 'status', 'response_code', 'ip_address')
+FILTERS = ('endpoint', 'status', 'site')
+
+_SELECT = f"SELECT {', '.join(COLUMNS)} FROM api_logs"
+
+
+class Subscription:
+    def __init__(self, filters, buffer_size):
+        self.filters = filters
+        self.buffer_size = buffer_size
+        self.rows = []
+        self.lagging = False
+        self.closed = False
+        self.touched = time.monotonic()
+        self.event = threading.Event()
+        self._lock = threading.Lock()
+
+    def matches(self, row):
+        return all(row[key] == value for key, value in self.filters.items())
+
+    def push(self, rows):
+        rows = [row for row in rows if self.matches(row)]
+        if not rows:
+            return
+        with self._lock:
+            if len(self.rows) + len(rows) > self.buffer_size:
+                self.lagging = True
+            else:
+                self.rows.extend(rows)
+        self.event.set()
+
+    def wait(self, timeout):
+        """Rows delivered since the last call (empty after ``timeout`` seconds)."""
+        self.event.wait(timeout)
+        self.event.clear()
+        self.touched = time.monotonic()
+        with self._lock:
+            rows, self.rows = self.rows, []
+        return rows
+
+
+class LogHub:
+    def __init__(self, poll_interval_ms=1000, backlog=500, buffer_size=1000, max_subscribers=4,
+                 max_seconds=300):
+        self.poll_interval = poll_interval_ms / 1000.0
+        self.backlog = backlog
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self.max_seconds = max_seconds
+        self.high_water = None
+
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'broadcasts': 0, 'rows': 0, 'disconnected_lagging': 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            poll_interval_ms=int(os.environ.get('SAGAPI_STREAM_POLL_MS', 1000)),
+            backlog=int(os.environ.get('SAGAPI_STREAM_BACKLOG', 500)),
+            buffer_size=int(os.environ.get('SAGAPI_STREAM_BUFFER', 1000)),
+            # Leave most gthread threads to ordinary requests; sync workers cannot stream at all
+            max_subscribers=int(os.environ.get('SAGAPI_STREAM_MAX_SUBSCRIBERS',
+                                               1000 if WORKER_CLASS in ('gevent', 'eventlet') else WORKER_THREADS // 2)),
+            max_seconds=int(os.environ.get('SAGAPI_STREAM_MAX_SECONDS', 300)),
+        )
+
+    def _ensure_started(self):
+        # The tailer does not survive fork(), so each gunicorn worker starts its own
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == pid and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                self._subscribers = set()
+                self.high_water = None
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='api-log-tailer', daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """New rows were committed by this process."""
+        self._wake.set()
+
+    def subscribe(self, filters, last_id=None):
+        """Register a subscriber; returns ``(subscription, missed_rows, truncated)``.
+
+        With ``last_id`` the rows after it (at most ``backlog``, the newest
+        ones) are returned for replay; ``truncated`` says older ones were left
+        out. Returns None when ``max_subscribers`` streams are already open.
+        """
+        self._ensure_started()
+        subscription = Subscription(filters, self.buffer_size)
+        conn = db.get_connection()
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            if self.high_water is None:
+                self.high_water = conn.execute('SELECT COALESCE(MAX(id), 0) FROM api_logs').fetchone()[0]
+            self._subscribers.add(subscription)
+            high_water = self.high_water
+        self._wake.set()
+
+        missed, truncated = [], False
+        if last_id is not None and last_id < high_water:
+            clauses = ['id > ?', 'id <= ?'] + [f'{key} = ?' for key in filters]
+            params = [last_id, high_water] + list(filters.values())
+            rows = conn.execute(f"{_SELECT} WHERE {' AND '.join(clauses)} ORDER BY id DESC LIMIT ?",
+                                params + [self.backlog + 1]).fetchall()
+            truncated = len(rows) > self.backlog
+            missed = [dict(zip(COLUMNS, row)) for row in reversed(rows[:self.backlog])]
+        return subscription, missed, truncated
+
+    def unsubscribe(self, subscription):
+        subscription.closed = True
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def events(self, subscription, missed, truncated):
+        """SSE text for a subscription: missed rows, then live ones, until ``max_seconds``.
+
+        Ending the stream is harmless: EventSource reconnects after ``retry``
+        with Last-Event-ID and resumes, and the worker gets its slot back.
+        """
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+            if truncated:
+                # Too much was missed to replay; counters built from the stream must reload
+                yield 'event: reset\ndata: {}\n\n'
+            last_id = 0
+            for row in missed:
+                yield _event(row)
+                last_id = row['id']
+            deadline = time.monotonic() + self.max_seconds
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                rows = subscription.wait(min(HEARTBEAT_SECONDS, remaining))
+                if subscription.lagging or subscription.closed:
+                    # Dropped by the tailer; the client resumes from its last id
+                    return
+                if not rows:
+                    yield ': keepalive\n\n'
+                    continue
+                for row in rows:
+                    if row['id'] > last_id:
+                        yield _event(row)
+                        last_id = row['id']
+        finally:
+            self.unsubscribe(subscription)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval if self._subscribers else None)
+            self._wake.clear()
+            if not self._subscribers:
+                continue
+            try:
+                self._reap()
+                self._tail()
+            except Exception as e:
+                print(f"api_logs tailer error: {e}")
+                time.sleep(self.poll_interval)
+
+    def _reap(self):
+        # A client that leaves before its stream starts never runs events()' cleanup
+        cutoff = time.monotonic() - HEARTBEAT_SECONDS * 4
+        with self._lock:
+            stale = [subscription for subscription in self._subscribers if subscription.touched < cutoff]
+        for subscription in stale:
+            self.unsubscribe(subscription)
+
+    def _tail(self):
+        conn = db.get_connection()
+        while True:
+            rows = conn.execute(f'{_SELECT} WHERE id > ? ORDER BY id LIMIT 500', (self.high_water,)).fetchall()
+            if not rows:
+                return
+            rows = [dict(zip(COLUMNS, row)) for row in rows]
+            with self._lock:
+                self.high_water = rows[-1]['id']
+                subscribers = list(self._subscribers)
+            lagging = 0
+            for subscription in subscribers:
+                subscription.push(rows)
+                if subscription.lagging:
+                    lagging += 1
+                    self.unsubscribe(subscription)
+            with self._stats_lock:
+                self._stats['disconnected_lagging'] += lagging
+                self._stats['broadcasts'] += 1
+                self._stats['rows'] += len(rows)
+            if len(rows) < 500:
+                return
+
+    def stats(self):
+        with self._stats_lock:
+            result = dict(self._stats)
+        result['subscribers'] = len(self._subscribers)
+        result['max_subscribers'] = self.max_subscribers
+        result['high_water'] = self.high_water
+        result['running'] = self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+        return result
+
+
+def _event(row):
+    return f"id: {row['id']}\nevent: log\ndata: {jsonutil.dumps(row)}\n\n"
+
+
+hub = LogHub.from_env()
+log_writer.listeners.append(hub.notify)
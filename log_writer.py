@@ -0,0 +1,325 @@
+"""Background group-commit writer for api_logs.
+
+Request handlers hand finished log records to ``submit()`` and return
+immediately. A dedicated thread per worker process drains the bounded queue
+and writes records with one ``executemany`` per transaction, either every
+``batch_size`` records or every ``flush_interval_ms`` milliseconds, whichever
+comes first. Set ``SAGAPI_LOG_WRITER=sync`` to write each record inline instead.
+
+When the queue is full the configured overflow policy applies:
+
+* ``block``       wait (up to ``block_timeout`` seconds) for room
+* ``drop_oldest`` discard the oldest queued record to make room
+* ``spill``       append the record to a local NDJSON file that is replayed
+                  into the database once the writer is idle again
+
+A writer replays the spill file under a ``<spill_path>.<pid>.replay`` name.
+When it starts, it also replays files of that form left by processes that
+died mid-replay.
+"""
+import atexit
+import glob
+import os
+import queue
+import threading
+import time
+
+import db
+import jsonutil
+import payloads
+
+# Records carry the bodies at positions 6 and 7 (JSON text, or objects serialized
+# here, off the request path); rows store their blob hashes
+INSERT_SQL = '''
+    INSERT INTO api_logs (timestamp, endpoint, agent_name, site, status, response_code, request_hash, response_hash, ip_address)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'spill')
+
+_STOP = object()
+
+
+class LogWriter:
+    def __init__(self, batch_size=200, flush_interval_ms=250, max_queue=10000,
+                 overflow='block', spill_path='api_logs_spill.ndjson', block_timeout=5.0,
+                 enabled=True):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.block_timeout = block_timeout
+        self.enabled = enabled
+        # Called without arguments after each committed batch (see log_stream.py)
+        self.listeners = []
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'enqueued': 0,
+            'written': 0,
+            'dropped': 0,
+            'spilled': 0,
+            'replayed': 0,
+            'write_errors': 0,
+            'listener_errors': 0,
+            'flushes': 0,
+            'queue_depth_max': 0,
+            'flush_ms_last': 0.0,
+            'flush_ms_max': 0.0,
+            'flush_ms_total': 0.0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            batch_size=int(os.environ.get('SAGAPI_LOG_BATCH_SIZE', 200)),
+            flush_interval_ms=int(os.environ.get('SAGAPI_LOG_FLUSH_MS', 250)),
+            max_queue=int(os.environ.get('SAGAPI_LOG_QUEUE_SIZE', 10000)),
+            overflow=os.environ.get('SAGAPI_LOG_OVERFLOW', 'block'),
+            spill_path=os.environ.get('SAGAPI_LOG_SPILL_PATH', 'api_logs_spill.ndjson'),
+            enabled=os.environ.get('SAGAPI_LOG_WRITER', 'async') != 'sync',
+        )
+
+    def _incr(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    # Producer side
+    def _ensure_started(self):
+        # The writer thread does not survive fork(), so each gunicorn worker starts its own
+        pid = os.getpid()
+        if self._pid == pid and self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == pid and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                self._queue = queue.Queue(maxsize=self.max_queue)
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name='api-log-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, record):
+        """Queue one api_logs row (a tuple in INSERT_SQL column order)."""
+        if not self.enabled:
+            self._write([record])
+            return
+        self._ensure_started()
+        if self.overflow == 'block':
+            try:
+                self._queue.put(record, timeout=self.block_timeout)
+            except queue.Full:
+                self._incr('dropped')
+                return
+        elif self.overflow == 'drop_oldest':
+            while True:
+                try:
+                    self._queue.put_nowait(record)
+                    break
+                except queue.Full:
+                    self._incr('dropped')
+                    if not self._drop_oldest_record():
+                        # Nothing but flush() markers queued; drop the new record instead
+                        return
+        else:
+            try:
+                self._queue.put_nowait(record)
+            except queue.Full:
+                self._spill([record])
+                return
+
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self._stats['enqueued'] += 1
+            if depth > self._stats['queue_depth_max']:
+                self._stats['queue_depth_max'] = depth
+
+    def _drop_oldest_record(self):
+        """Remove the oldest queued record; flush() markers and the stop sentinel stay queued."""
+        with self._queue.mutex:
+            for item in self._queue.queue:
+                if isinstance(item, tuple):
+                    self._queue.queue.remove(item)
+                    self._queue.not_full.notify()
+                    return True
+        return False
+
+    def flush(self, timeout=10.0):
+        """Block until everything queued before this call has been written."""
+        if self._thread is None or self._pid != os.getpid():
+            return True
+        done = threading.Event()
+        deadline = time.monotonic() + timeout
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(max(deadline - time.monotonic(), 0))
+
+    def stop(self, timeout=10.0):
+        """Flush pending records and stop the writer thread."""
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(max(deadline - time.monotonic(), 0))
+        self._thread = None
+
+    # Consumer side
+    def _run(self):
+        self._replay_orphans()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._replay_spill()
+                continue
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            records = [r for r in batch if isinstance(r, tuple)]
+            try:
+                if records:
+                    self._write(records)
+            finally:
+                for r in batch:
+                    if isinstance(r, threading.Event):
+                        r.set()
+            if batch[-1] is _STOP:
+                self._replay_spill()
+                return
+
+    def _write(self, records, spill_on_error=True):
+        start = time.perf_counter()
+        try:
+            with db.transaction() as conn:
+                self.write_batch(conn, records)
+        except Exception as e:
+            print(f"api_logs writer error: {e}")
+            self._incr('write_errors')
+            if spill_on_error:
+                if self.overflow == 'spill':
+                    self._spill(records)
+                else:
+                    self._incr('dropped', len(records))
+            return False
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        with self._stats_lock:
+            self._stats['written'] += len(records)
+            self._stats['flushes'] += 1
+            self._stats['flush_ms_last'] = elapsed_ms
+            self._stats['flush_ms_total'] += elapsed_ms
+            if elapsed_ms > self._stats['flush_ms_max']:
+                self._stats['flush_ms_max'] = elapsed_ms
+        for listener in self.listeners:
+            # The batch is committed; a failing listener must not take the writer thread down
+            try:
+                listener()
+            except Exception as e:
+                print(f"api_logs writer listener error: {e}")
+                self._incr('listener_errors')
+        return True
+
+    def write_batch(self, conn, records):
+        """Insert a batch of records inside the caller's transaction."""
+        hashes = payloads.store(conn, [body if body is None or isinstance(body, str) else payloads.dumps(body)
+                                       for r in records for body in (r[6], r[7])])
+        conn.executemany(INSERT_SQL, [
+            r[:6] + (hashes[2 * i], hashes[2 * i + 1]) + r[8:]
+            for i, r in enumerate(records)
+        ])
+
+    # Spill file
+    def _spill(self, records):
+        with self._spill_lock:
+            with open(self.spill_path, 'a', encoding='utf-8') as f:
+                for r in records:
+                    f.write(jsonutil.dumps(list(r)) + '\n')
+        self._incr('spilled', len(records))
+
+    def _replay_spill(self):
+        if os.path.exists(self.spill_path):
+            self._replay(self.spill_path)
+
+    def _replay_orphans(self):
+        """Replay ``.replay`` files whose process is gone (or is a former process with our pid)."""
+        own = os.getpid()
+        for path in glob.glob(glob.escape(self.spill_path) + '.*.replay'):
+            try:
+                pid = int(path[len(self.spill_path) + 1:-len('.replay')])
+            except ValueError:
+                continue
+            if pid == own or not _pid_alive(pid):
+                self._replay(path)
+
+    def _replay(self, source):
+        draining = f"{self.spill_path}.{os.getpid()}.replay"
+        with self._spill_lock:
+            try:
+                # Also claims an orphaned file, so only one process replays it
+                os.replace(source, draining)
+            except FileNotFoundError:
+                return
+        records = []
+        with open(draining, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(tuple(jsonutil.loads(line)))
+                except ValueError:
+                    # A line cut short when its writer died
+                    self._incr('dropped')
+        for start in range(0, len(records), self.batch_size):
+            chunk = records[start:start + self.batch_size]
+            if not self._write(chunk, spill_on_error=False):
+                # Put the unwritten tail back for the next idle period
+                self._spill(records[start:])
+                break
+            self._incr('replayed', len(chunk))
+        os.remove(draining)
+
+    def stats(self):
+        with self._stats_lock:
+            result = dict(self._stats)
+        result['queue_depth'] = self._queue.qsize()
+        result['flush_ms_avg'] = (result['flush_ms_total'] / result['flushes']) if result['flushes'] else 0.0
+        result['overflow'] = self.overflow
+        result['batch_size'] = self.batch_size
+        result['flush_interval_ms'] = self.flush_interval * 1000.0
+        result['running'] = self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+        return result
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+writer = LogWriter.from_env()
+atexit.register(writer.stop)
@@ -0,0 +1,320 @@
+"""Request timing, SQL profiling and Prometheus exposition.
+
+``install(app)`` adds hooks that time every request into a latency histogram
+per route, method and status, and points db.py's tracer at this module so
+every SQL statement's time and row count is attributed to the route that ran
+it (``background`` for the log writer and other threads). The
+``set_trace_callback`` count also includes the steps SQLite runs inside
+triggers (FTS and rollups), so its gap to the query count is trigger work.
+``timer()`` / ``timed_stream()`` time named pieces of work such as
+``log_api_request`` and exports.
+
+Metrics live in the memory of each process. Every worker writes a snapshot to
+``METRICS_DIR`` at most every ``SNAPSHOT_SECONDS`` (and at exit), and
+``render()`` / ``slow_queries()`` sum the snapshots of all workers, so any
+worker answering ``/metrics`` reports the whole gunicorn server. Snapshots
+of exited workers are kept so counters never go backwards; gunicorn's
+``on_starting`` hook clears the directory.
+"""
+import atexit
+import bisect
+import functools
+import glob
+import hmac
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+import db
+
+ENABLED = os.environ.get('SAGAPI_METRICS', 'on') != 'off'
+SQL_TRACE = os.environ.get('SAGAPI_SQL_TRACE', 'off') == 'on'
+METRICS_DIR = os.environ.get('SAGAPI_METRICS_DIR', 'metrics')
+SNAPSHOT_SECONDS = float(os.environ.get('SAGAPI_METRICS_SNAPSHOT_SECONDS', 2))
+# Bearer token required by /metrics; empty leaves it open to the scraper
+METRICS_TOKEN = os.environ.get('SAGAPI_METRICS_TOKEN', '')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Distinct statements tracked for the slow query page
+MAX_QUERIES = 500
+
+HELP = {
+    'sagapi_http_request_duration_seconds': ('histogram', 'Request latency by route, method and status'),
+    'sagapi_function_duration_seconds': ('histogram', 'Duration of named work: log_api_request, exports'),
+    'sagapi_sql_queries_total': ('counter', 'SQL statements executed, by route'),
+    'sagapi_sql_statements_total': ('counter', 'Statements reported by the SQLite trace callback, trigger steps included'),
+    'sagapi_sql_seconds_total': ('counter', 'Time spent executing and fetching SQL, by route'),
+    'sagapi_sql_rows_total': ('counter', 'Rows fetched or changed by SQL, by route'),
+    'sagapi_db_transactions_total': ('counter', 'Write transactions started'),
+    'sagapi_db_rollbacks_total': ('counter', 'Write transactions rolled back'),
+    'sagapi_db_lock_waits_total': ('counter', 'Write transactions that waited for the lock'),
+    'sagapi_db_lock_wait_seconds_total': ('counter', 'Time spent waiting for the write lock'),
+    'sagapi_db_lock_errors_total': ('counter', 'Write transactions that timed out on the lock'),
+    'sagapi_metrics_workers': ('gauge', 'Worker snapshots merged into this output'),
+}
+
+# db.counters() key -> (metric, scale)
+DB_COUNTERS = {
+    'transactions': ('sagapi_db_transactions_total', 1),
+    'rollbacks': ('sagapi_db_rollbacks_total', 1),
+    'lock_waits': ('sagapi_db_lock_waits_total', 1),
+    'lock_wait_ms_total': ('sagapi_db_lock_wait_seconds_total', 0.001),
+    'lock_errors': ('sagapi_db_lock_errors_total', 1),
+}
+
+_lock = threading.Lock()
+_local = threading.local()
+# (name, labels) -> [count per bucket..., count above the last bucket, sum]
+_histograms = {}
+# (name, labels) -> value
+_counters = {}
+# normalized SQL -> [calls, seconds, max_seconds, rows, route of the slowest call]
+_queries = {}
+_last_snapshot = 0.0
+
+
+def observe(name, labels, seconds):
+    key = (name, labels)
+    with _lock:
+        values = _histograms.get(key)
+        if values is None:
+            values = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        values[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        values[-1] += seconds
+
+
+def inc(name, labels, amount=1):
+    key = (name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+@contextmanager
+def timer(name):
+    """Time the block into ``sagapi_function_duration_seconds{name=...}``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('sagapi_function_duration_seconds', (('name', name),), time.perf_counter() - start)
+
+
+def timed_stream(name, iterable):
+    """Yield from ``iterable``, timing it until it is exhausted or closed."""
+    start = time.perf_counter()
+    try:
+        yield from iterable
+    finally:
+        observe('sagapi_function_duration_seconds', (('name', name),), time.perf_counter() - start)
+
+
+def authorized(token):
+    """Whether ``token`` may read /metrics."""
+    return not METRICS_TOKEN or hmac.compare_digest(token or '', METRICS_TOKEN)
+
+
+def current_route():
+    return getattr(_local, 'route', None) or 'background'
+
+
+@functools.lru_cache(maxsize=2048)
+def normalize_sql(sql):
+    """One-line statement text with placeholder lists and literals folded."""
+    sql = ' '.join(sql.split())
+    sql = re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', sql)
+    sql = re.sub(r"'[^']*'", "'?'", sql)
+    sql = re.sub(r'\b\d+\b', '?', sql)
+    return sql[:500]
+
+
+def _trace(sql, seconds, rows, fetch=False):
+    route = current_route()
+    labels = (('route', route),)
+    text = normalize_sql(sql)
+    with _lock:
+        if not fetch:
+            _counters[('sagapi_sql_queries_total', labels)] = _counters.get(('sagapi_sql_queries_total', labels), 0) + 1
+        _counters[('sagapi_sql_seconds_total', labels)] = _counters.get(('sagapi_sql_seconds_total', labels), 0) + seconds
+        if rows:
+            _counters[('sagapi_sql_rows_total', labels)] = _counters.get(('sagapi_sql_rows_total', labels), 0) + rows
+        entry = _queries.get(text)
+        if entry is None:
+            if len(_queries) >= MAX_QUERIES:
+                return
+            entry = _queries[text] = [0, 0.0, 0.0, 0, route]
+        if not fetch:
+            entry[0] += 1
+        entry[1] += seconds
+        entry[3] += rows
+        if seconds > entry[2]:
+            entry[2] = seconds
+            entry[4] = route
+
+
+def _statement(sql):
+    inc('sagapi_sql_statements_total', (('route', current_route()),))
+
+
+# Request hooks
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    _local.route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        observe('sagapi_http_request_duration_seconds',
+                (('route', current_route()), ('method', request.method), ('status', str(response.status_code))),
+                time.perf_counter() - start)
+    return response
+
+
+def _teardown_request(exc=None):
+    _local.route = None
+    if time.time() - _last_snapshot >= SNAPSHOT_SECONDS:
+        write_snapshot()
+
+
+def install(app):
+    """Time ``app``'s requests and trace SQL, unless SAGAPI_METRICS=off."""
+    if not ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    if SQL_TRACE:
+        db.set_tracer(_trace, _statement)
+    atexit.register(write_snapshot)
+
+
+# Snapshots and aggregation
+def _snapshot():
+    with _lock:
+        snapshot = {
+            'pid': os.getpid(),
+            'time': time.time(),
+            'histograms': [[name, list(labels), list(values)] for (name, labels), values in _histograms.items()],
+            'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            'queries': {text: list(entry) for text, entry in _queries.items()},
+        }
+    counters = db.counters()
+    for key, (name, scale) in DB_COUNTERS.items():
+        snapshot['counters'].append([name, [], counters[key] * scale])
+    return snapshot
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f'worker-{pid}.json')
+
+
+def write_snapshot():
+    """Publish this process's metrics for the other workers."""
+    global _last_snapshot
+    _last_snapshot = time.time()
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = _snapshot_path(os.getpid())
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(_snapshot(), f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"Metrics snapshot error: {e}")
+
+
+def reset():
+    """Forget every worker's snapshot (server start)."""
+    for path in glob.glob(os.path.join(METRICS_DIR, 'worker-*.json')):
+        os.remove(path)
+
+
+def _collect():
+    """Every worker's snapshot, this process's taken live."""
+    own = _snapshot()
+    snapshots = [own]
+    for path in glob.glob(os.path.join(METRICS_DIR, 'worker-*.json')):
+        if path == _snapshot_path(own['pid']):
+            continue
+        try:
+            with open(path, encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def merged():
+    """Histograms, counters and queries summed over all workers."""
+    snapshots = _collect()
+    histograms, counters, queries = {}, {}, {}
+    for snapshot in snapshots:
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for text, (calls, seconds, max_seconds, rows, route) in snapshot['queries'].items():
+            entry = queries.setdefault(text, [0, 0.0, 0.0, 0, route])
+            entry[0] += calls
+            entry[1] += seconds
+            entry[3] += rows
+            if max_seconds > entry[2]:
+                entry[2] = max_seconds
+                entry[4] = route
+    return histograms, counters, queries, len(snapshots)
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def render():
+    """All workers' metrics in the Prometheus text exposition format."""
+    histograms, counters, _, workers = merged()
+    counters[('sagapi_metrics_workers', ())] = workers
+    lines = []
+    for name in sorted({key[0] for key in histograms} | {key[0] for key in counters}):
+        kind, help_text = HELP.get(name, ('untyped', ''))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'histogram':
+            for (_, labels), values in sorted(item for item in histograms.items() if item[0][0] == name):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {values[-1]:.6f}')
+                lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+        else:
+            for (_, labels), value in sorted(item for item in counters.items() if item[0][0] == name):
+                lines.append(f'{name}{_labels(labels)} {value:g}' if isinstance(value, float)
+                             else f'{name}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def slow_queries(order='max', limit=50):
+    """Statements across all workers, slowest first (by ``max``, ``total`` or ``avg`` time)."""
+    _, _, queries, workers = merged()
+    rows = [{
+        'sql': text,
+        'calls': calls,
+        'total_ms': seconds * 1000,
+        'avg_ms': seconds * 1000 / calls if calls else 0.0,
+        'max_ms': max_seconds * 1000,
+        'rows': rows,
+        'route': route,
+    } for text, (calls, seconds, max_seconds, rows, route) in queries.items()]
+    rows.sort(key=lambda r: r[f'{order}_ms'], reverse=True)
+    return {'workers': workers, 'order': order, 'sql_trace': SQL_TRACE and ENABLED, 'queries': rows[:limit]}
@@ -0,0 +1,337 @@
+"""Numbered schema migrations tracked in ``PRAGMA user_version``.
+
+Each entry of ``MIGRATIONS`` runs once, in its own transaction together with
+the ``user_version`` bump, so a database is always at a well-defined version.
+``migrate()`` applies the pending ones under an exclusive file lock next to
+the database, so concurrent starters (gunicorn's master, a deploy running
+``python migrations.py`` or ``flask migrate-db``) never interleave. It runs
+from the ``on_starting`` hook in gunicorn.conf.py before any worker is
+forked; workers only call ``verify()``, a single PRAGMA read.
+
+To change the schema, append a function to ``MIGRATIONS``; never edit one that
+has shipped.
+"""
+import os
+import time
+
+import db
+import dates
+import document_numbers
+import idempotency
+import ingest_queue
+import log_search
+import payloads
+import rollups
+import tokens
+
+try:
+    import fcntl
+except ImportError:
+    # Windows development setups: single process, BEGIN IMMEDIATE still serializes
+    fcntl = None
+
+# Defaults to '<database>.migrate.lock'
+LOCK_PATH = os.environ.get('SAGAPI_MIGRATION_LOCK')
+# Workers that find the database behind migrate it themselves (flask run, tests);
+# set to off to make them fail instead
+AUTO_MIGRATE = os.environ.get('SAGAPI_AUTO_MIGRATE', 'on') != 'off'
+
+
+def add_column_if_missing(cursor, table, column, definition):
+    """Add a column to an existing table; returns True if it was missing"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column in [row[1] for row in cursor.fetchall()]:
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+
+def _baseline(cursor):
+    """1: every table and index up to the introduction of migrations.
+
+    Written with IF NOT EXISTS and add_column_if_missing(), so it also brings
+    databases created by earlier releases (user_version 0) up to date.
+    """
+    # Create api_logs table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            agent_name TEXT,
+            site TEXT,
+            status TEXT NOT NULL,
+            response_code INTEGER NOT NULL,
+            request_body TEXT,
+            response_body TEXT,
+            ip_address TEXT,
+            request_hash TEXT,
+            response_hash TEXT
+        )
+    ''')
+
+    # Create receiving_tbs table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS receiving_tbs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            document_no TEXT UNIQUE NOT NULL,
+            timestamp TEXT NOT NULL,
+            partner_id TEXT NOT NULL,
+            journal_id TEXT NOT NULL,
+            date_order TEXT NOT NULL,
+            officers TEXT NOT NULL,
+            keterangan_description TEXT,
+            driver_name TEXT NOT NULL,
+            vehicle_no TEXT NOT NULL,
+            destination_warehouse_id TEXT NOT NULL,
+            branch_id TEXT NOT NULL,
+            original_payload TEXT,
+            line_count INTEGER NOT NULL DEFAULT 0,
+            total_netto REAL NOT NULL DEFAULT 0,
+            total_value REAL NOT NULL DEFAULT 0,
+            date_order_epoch INTEGER,
+            payload_hash TEXT
+        )
+    ''')
+
+    # Create order_line table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_line (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            receiving_tbs_id INTEGER NOT NULL,
+            product_code TEXT NOT NULL,
+            qty_brutto REAL NOT NULL,
+            qty_tara REAL NOT NULL,
+            qty_netto REAL NOT NULL,
+            product_uom TEXT NOT NULL,
+            sortation_percent REAL,
+            sortation_weight REAL,
+            qty_netto2 REAL,
+            price_unit REAL NOT NULL,
+            product_qty INTEGER NOT NULL,
+            incoming_date TEXT NOT NULL,
+            outgoing_date TEXT NOT NULL,
+            incoming_epoch INTEGER,
+            outgoing_epoch INTEGER,
+            FOREIGN KEY (receiving_tbs_id) REFERENCES receiving_tbs (id)
+        )
+    ''')
+
+    # Indexes for the /logs list, its status filter and per-endpoint lookups
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_logs_timestamp '
+                   'ON api_logs (timestamp, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_logs_response_code '
+                   'ON api_logs (response_code, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_logs_endpoint '
+                   'ON api_logs (endpoint, timestamp)')
+
+    # Compressed payload blobs referenced by hash (see payloads.py)
+    payloads.create_schema(cursor)
+    add_column_if_missing(cursor, 'api_logs', 'request_hash', 'TEXT')
+    add_column_if_missing(cursor, 'api_logs', 'response_hash', 'TEXT')
+    add_column_if_missing(cursor, 'receiving_tbs', 'payload_hash', 'TEXT')
+    # Reference checks when retention releases blobs
+    for table, pairs in payloads.PAYLOAD_COLUMNS.items():
+        for _, key in pairs:
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{key} '
+                           f'ON {table} ({key}) WHERE {key} IS NOT NULL')
+
+    # Full-text index over api_logs fields and payloads
+    log_search.create_schema(cursor)
+
+    # Header totals stored at insert time (added to databases created before them)
+    if add_column_if_missing(cursor, 'receiving_tbs', 'line_count', 'INTEGER NOT NULL DEFAULT 0'):
+        add_column_if_missing(cursor, 'receiving_tbs', 'total_netto', 'REAL NOT NULL DEFAULT 0')
+        add_column_if_missing(cursor, 'receiving_tbs', 'total_value', 'REAL NOT NULL DEFAULT 0')
+        cursor.execute('''
+            UPDATE receiving_tbs SET
+                line_count = (SELECT COUNT(*) FROM order_line ol
+                              WHERE ol.receiving_tbs_id = receiving_tbs.id),
+                total_netto = (SELECT COALESCE(SUM(ol.qty_netto2), 0)
+                               FROM order_line ol WHERE ol.receiving_tbs_id = receiving_tbs.id),
+                total_value = (SELECT COALESCE(SUM(ol.qty_netto2 * ol.price_unit), 0)
+                               FROM order_line ol WHERE ol.receiving_tbs_id = receiving_tbs.id)
+        ''')
+
+    # Sortable companions of the agent's DD/MM/YYYY dates (see dates.py)
+    add_column_if_missing(cursor, 'receiving_tbs', 'date_order_epoch', 'INTEGER')
+    add_column_if_missing(cursor, 'order_line', 'incoming_epoch', 'INTEGER')
+    add_column_if_missing(cursor, 'order_line', 'outgoing_epoch', 'INTEGER')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_receiving_tbs_date_order '
+                   'ON receiving_tbs (date_order_epoch)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_order_line_incoming '
+                   'ON order_line (incoming_epoch)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_order_line_outgoing '
+                   'ON order_line (outgoing_epoch)')
+
+    # Indexes for exports, transaction detail and date-range filters
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_receiving_tbs_timestamp '
+                   'ON receiving_tbs (timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_receiving_tbs_partner '
+                   'ON receiving_tbs (partner_id, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_receiving_tbs_branch '
+                   'ON receiving_tbs (branch_id, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_order_line_receiving_tbs_id '
+                   'ON order_line (receiving_tbs_id)')
+
+    # Dashboard rollup counters
+    rollups.create_schema(cursor)
+
+    # Per-day document number sequences
+    document_numbers.create_schema(cursor)
+
+    # Issued API tokens and the revocation generation
+    tokens.create_schema(cursor)
+
+    # Stored responses of processed create requests
+    idempotency.create_schema(cursor)
+
+    # Create users table for login
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT DEFAULT 'operator'
+        )
+    ''')
+
+    # Insert default admin user
+    cursor.execute('''
+        INSERT OR IGNORE INTO users (username, password, role) 
+        VALUES (?, ?, ?)
+    ''', ('admin', 'SAGsecure#2025', 'admin'))
+
+
+# (table, source text column, epoch column) pairs kept in sync on insert
+EPOCH_COLUMNS = [
+    ('receiving_tbs', 'date_order', 'date_order_epoch'),
+    ('order_line', 'incoming_date', 'incoming_epoch'),
+    ('order_line', 'outgoing_date', 'outgoing_epoch'),
+]
+
+
+def _fill_epoch_batch(conn, table, source, target, last_id, batch_size):
+    """Fill one batch of epochs after ``last_id``.
+
+    Returns ``(filled, last_id)``; last_id is None when the column is done.
+    """
+    # (target IS NULL, id > ?) is a range on the epoch index, so rows
+    # that are already filled are never visited
+    rows = conn.execute(f'''
+        SELECT id, {source} FROM {table}
+        WHERE {target} IS NULL AND id > ?
+        ORDER BY id LIMIT ?
+    ''', (last_id, batch_size)).fetchall()
+    if not rows:
+        return 0, None
+    updates = [(epoch, row_id)
+               for epoch, row_id in ((dates.to_epoch(value), row_id) for row_id, value in rows)
+               if epoch is not None]
+    conn.executemany(f'UPDATE {table} SET {target} = ? WHERE id = ?', updates)
+    return len(updates), rows[-1][0]
+
+
+def backfill_date_epochs(batch_size=5000):
+    """Fill epoch columns for rows written before they existed, one short transaction per batch"""
+    filled = 0
+    for table, source, target in EPOCH_COLUMNS:
+        last_id = 0
+        while last_id is not None:
+            with db.transaction() as conn:
+                count, last_id = _fill_epoch_batch(conn, table, source, target, last_id, batch_size)
+            filled += count
+    return filled
+
+
+def _date_epochs(cursor):
+    """2: epochs for agent dates stored before the epoch columns existed."""
+    for table, source, target in EPOCH_COLUMNS:
+        last_id = 0
+        while last_id is not None:
+            _, last_id = _fill_epoch_batch(cursor.connection, table, source, target, last_id, 5000)
+
+
+def _ingest_queue(cursor):
+    """3: durable queue of asynchronously created receiving TBS tickets."""
+    ingest_queue.create_schema(cursor)
+
+
+def _ingest_retry_backoff(cursor):
+    """4: earliest retry time of queued tickets whose creation failed."""
+    add_column_if_missing(cursor, 'ingest_queue', 'not_before', 'INTEGER NOT NULL DEFAULT 0')
+
+
+MIGRATIONS = [
+    _baseline,
+    _date_epochs,
+    _ingest_queue,
+    _ingest_retry_backoff,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def current_version(conn=None):
+    conn = conn or db.get_connection()
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        if fcntl:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def migrate(log=print):
+    """Apply pending migrations; returns the list of versions applied."""
+    applied = []
+    with _FileLock(LOCK_PATH or f'{db.DB_PATH}.migrate.lock'):
+        for version, step in enumerate(MIGRATIONS, 1):
+            with db.transaction() as conn:
+                # Re-read under the write lock: another process may have moved on
+                if current_version(conn) >= version:
+                    continue
+                started = time.perf_counter()
+                step(conn.cursor())
+                conn.execute(f'PRAGMA user_version = {version}')
+            applied.append(version)
+            log(f"Applied migration {version} ({step.__name__.strip('_')}) "
+                f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return applied
+
+
+def verify():
+    """Check the database is at ``LATEST_VERSION``; the per-worker startup check.
+
+    A database behind the code is migrated here when ``AUTO_MIGRATE`` is on
+    (development servers and scripts that never ran the gunicorn hook) and
+    raises RuntimeError otherwise. A database ahead of the code, during a
+    rolling deploy, only prints a warning: migrations are additive.
+    """
+    version = current_version()
+    if version < LATEST_VERSION:
+        if not AUTO_MIGRATE:
+            raise RuntimeError(f"Database schema is at version {version}, expected {LATEST_VERSION}; "
+                               f"run 'python migrations.py'")
+        migrate()
+        version = current_version()
+    elif version > LATEST_VERSION:
+        print(f"Database schema version {version} is newer than this code ({LATEST_VERSION})")
+    return version
+
+
+if __name__ == '__main__':
+    migrate()
+    print(f"Schema at version {current_version()}")
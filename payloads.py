@@ -0,0 +1,188 @@
+"""Compressed, content-addressed storage for request, response and order payloads.
+
+Payloads are serialized as compact JSON, hashed and stored once in
+``payload_blobs``; api_logs and receiving_tbs only keep the hash. The create
+request logged in api_logs and the order's original_payload are the same JSON,
+so they share a single blob.
+
+Blobs are compressed with zstd when the ``zstandard`` package is installed and
+with zlib otherwise. The codec is recorded per blob, so switching codecs never
+makes older blobs unreadable. Text is decompressed only where it is shown:
+detail pages, exports and the full-text index.
+
+Rows written before blobs existed keep their inline text until ``repack()``
+moves it into blobs; readers go through ``sql_text()`` and accept both.
+"""
+import hashlib
+import os
+import zlib
+
+import db
+import jsonutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Inline text column -> hash column, per table
+PAYLOAD_COLUMNS = {
+    'api_logs': [('request_body', 'request_hash'), ('response_body', 'response_hash')],
+    'receiving_tbs': [('original_payload', 'payload_hash')],
+}
+
+CODEC = os.environ.get('SAGAPI_PAYLOAD_CODEC', 'zstd' if zstandard else 'zlib')
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def create_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payload_blobs (
+            hash TEXT PRIMARY KEY,
+            codec TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )
+    ''')
+
+
+def dumps(obj):
+    """Compact JSON used for every stored payload, so equal payloads hash equally."""
+    return jsonutil.dumps(obj)
+
+
+def normalize(text):
+    """Re-serialize stored JSON text compactly; non-JSON text is kept as is."""
+    try:
+        return dumps(jsonutil.loads(text))
+    except ValueError:
+        return text
+
+
+def digest(raw):
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def encode(raw):
+    """Compress UTF-8 bytes; returns ``(codec, data)``, raw when compression does not pay."""
+    if CODEC == 'zstd':
+        data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    else:
+        data = zlib.compress(raw, ZLIB_LEVEL)
+    if len(data) >= len(raw):
+        return 'raw', raw
+    return CODEC, data
+
+
+def decode(codec, data):
+    if data is None:
+        return None
+    if codec == 'zlib':
+        data = zlib.decompress(data)
+    elif codec == 'zstd':
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return bytes(data).decode('utf-8')
+
+
+# SQL access to blob contents (search index, exports, detail pages)
+db.register_function('payload_decode', 2, decode)
+
+
+def sql_text(text_column, hash_column):
+    """SQL expression yielding a payload's text from either storage form."""
+    return (f'COALESCE({text_column}, (SELECT payload_decode(pb.codec, pb.data) '
+            f'FROM payload_blobs pb WHERE pb.hash = {hash_column}))')
+
+
+def store(conn, texts):
+    """Store payload texts inside the caller's transaction; returns their hashes.
+
+    ``None`` entries stay ``None``. Each distinct text is compressed once and
+    blobs that already exist are left untouched.
+    """
+    hashes = []
+    blobs = {}
+    known = {}
+    for text in texts:
+        if text is None:
+            hashes.append(None)
+            continue
+        if text not in known:
+            raw = text.encode('utf-8')
+            key = digest(raw)
+            known[text] = key
+            if key not in blobs:
+                codec, data = encode(raw)
+                blobs[key] = (key, codec, len(raw), data)
+        hashes.append(known[text])
+    if blobs:
+        conn.executemany('INSERT OR IGNORE INTO payload_blobs (hash, codec, size, data) VALUES (?, ?, ?, ?)',
+                         list(blobs.values()))
+    return hashes
+
+
+def release(conn, hashes):
+    """Delete the given blobs where no row refers to them any more; returns how many went."""
+    unreferenced = ' AND '.join(
+        f'NOT EXISTS (SELECT 1 FROM {table} WHERE {key} = :hash)'
+        for table, pairs in PAYLOAD_COLUMNS.items() for _, key in pairs)
+    cursor = conn.executemany(f'DELETE FROM payload_blobs WHERE hash = :hash AND {unreferenced}',
+                              [{'hash': key} for key in hashes])
+    return max(cursor.rowcount, 0)
+
+
+def load(conn, key):
+    """Decompressed text of one blob, or None."""
+    if key is None:
+        return None
+    row = conn.execute('SELECT codec, data FROM payload_blobs WHERE hash = ?', (key,)).fetchone()
+    return decode(*row) if row else None
+
+
+def blob_bytes(conn):
+    return conn.execute('SELECT COALESCE(SUM(length(data)), 0) FROM payload_blobs').fetchone()[0]
+
+
+def repack(batch_size=500):
+    """Move inline payload text of existing rows into blobs.
+
+    Runs one short transaction per batch so the API keeps writing meanwhile.
+    Returns a report of rows converted and bytes of text versus blob storage.
+    """
+    report = {'rows': 0, 'values': 0, 'bytes_before': 0, 'bytes_after': 0}
+    blobs_before = blob_bytes(db.get_connection())
+
+    for table, pairs in PAYLOAD_COLUMNS.items():
+        text_columns = [text for text, _ in pairs]
+        pending = ' OR '.join(f'{text} IS NOT NULL' for text in text_columns)
+        assignments = ', '.join(f'{text} = NULL, {key} = COALESCE(?, {key})' for text, key in pairs)
+        last_id = 0
+        while True:
+            with db.transaction() as conn:
+                rows = conn.execute(f'''
+                    SELECT id, {', '.join(text_columns)} FROM {table}
+                    WHERE id > ? AND ({pending})
+                    ORDER BY id LIMIT ?
+                ''', (last_id, batch_size)).fetchall()
+                if not rows:
+                    break
+                texts = []
+                for row in rows:
+                    for text in row[1:]:
+                        if text is not None:
+                            report['values'] += 1
+                            report['bytes_before'] += len(text.encode('utf-8'))
+                        texts.append(normalize(text) if text is not None else None)
+                hashes = store(conn, texts)
+                width = len(pairs)
+                conn.executemany(f'UPDATE {table} SET {assignments} WHERE id = ?', [
+                    tuple(hashes[i * width:(i + 1) * width]) + (row[0],)
+                    for i, row in enumerate(rows)
+                ])
+                report['rows'] += len(rows)
+                last_id = rows[-1][0]
+
+    report['bytes_after'] = blob_bytes(db.get_connection()) - blobs_before
+    report['bytes_saved'] = report['bytes_before'] - report['bytes_after']
+    return report
@@ -0,0 +1,262 @@
+"""Receiving TBS slips rendered as PDF with fpdf2, cached on disk.
+
+Receiving TBS records are never updated after the create endpoint writes
+them, so a rendered slip stays valid for as long as its ``document_no`` and
+``timestamp`` do. Slips are stored under ``SAGAPI_PDF_CACHE_DIR`` keyed by
+both plus ``RENDER_VERSION`` (bump it when the layout changes) and are only
+rendered once; the detail page, its print button and the PDF packs all share
+them.
+
+A PDF pack is a ZIP of the slips of a date range. Slips missing from the cache
+are rendered across a process pool (``SAGAPI_PDF_WORKERS`` processes, started
+once per worker on first use) so large packs use every core.
+"""
+import atexit
+import concurrent.futures
+import datetime
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+import zipfile
+
+from fpdf import FPDF
+
+RENDER_VERSION = 1
+CACHE_DIR = os.path.abspath(os.environ.get('SAGAPI_PDF_CACHE_DIR', 'pdf_cache'))
+PACK_WORKERS = int(os.environ.get('SAGAPI_PDF_WORKERS', os.cpu_count() or 1))
+PACK_LIMIT = int(os.environ.get('SAGAPI_PDF_PACK_LIMIT', 5000))
+LOGO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logo-PTSAG.png')
+
+# Fewer missing slips than this are rendered in the request's own process
+_POOL_THRESHOLD = 8
+_CHUNK = 500
+
+HEADER_COLUMNS = ['id', 'document_no', 'timestamp', 'partner_id', 'journal_id', 'date_order', 'officers',
+                  'keterangan_description', 'driver_name', 'vehicle_no', 'destination_warehouse_id', 'branch_id']
+LINE_COLUMNS = ['receiving_tbs_id', 'product_code', 'qty_brutto', 'qty_tara', 'qty_netto', 'product_uom',
+                'sortation_percent', 'sortation_weight', 'qty_netto2', 'price_unit', 'product_qty',
+                'incoming_date', 'outgoing_date']
+
+# (title, width in mm, value of a line) for the order line table
+TABLE = [
+    ('No', 8, None),
+    ('Product', 30, lambda line: line['product_code']),
+    ('Brutto (kg)', 22, lambda line: _number(line['qty_brutto'])),
+    ('Tara (kg)', 20, lambda line: _number(line['qty_tara'])),
+    ('Netto (kg)', 22, lambda line: _number(line['qty_netto'])),
+    ('Sort %', 14, lambda line: f"{line['sortation_percent'] or 0:.1f}%"),
+    ('Sort (kg)', 20, lambda line: _number(line['sortation_weight'] or 0)),
+    ('Netto2 (kg)', 22, lambda line: _number(_netto2(line))),
+    ('Price (Rp)', 20, lambda line: _number(line['price_unit'], 0)),
+    ('Value (Rp)', 28, lambda line: _number(_netto2(line) * line['price_unit'], 0)),
+    ('Incoming', 35, lambda line: line['incoming_date']),
+    ('Outgoing', 35, lambda line: line['outgoing_date']),
+]
+
+
+def _netto2(line):
+    return line['qty_netto2'] or line['qty_netto']
+
+
+def _number(value, places=2):
+    return f"{value or 0:,.{places}f}"
+
+
+def _text(value):
+    # The core fonts only cover latin-1
+    return str('-' if value in (None, '') else value).encode('latin-1', 'replace').decode('latin-1')
+
+
+def cache_path(document_no, timestamp):
+    key = hashlib.sha1(f'{RENDER_VERSION}|{document_no}|{timestamp}'.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, key[:2], f'{key}.pdf')
+
+
+def filename(document_no):
+    return document_no.replace('/', '-') + '.pdf'
+
+
+def render_slip(header, lines):
+    """PDF bytes of one receiving TBS slip (A4 landscape)."""
+    pdf = FPDF(orientation='L', unit='mm', format='A4')
+    pdf.set_title(_text(header['document_no']))
+    pdf.set_author('PT Sahabat Agro Group')
+    pdf.set_creator('SAGAPI-Proto')
+    # Same record, same bytes
+    pdf.set_creation_date(datetime.datetime.strptime(header['timestamp'], '%Y-%m-%d %H:%M:%S')
+                          .replace(tzinfo=datetime.timezone.utc))
+    pdf.set_auto_page_break(True, margin=15)
+    pdf.add_page()
+
+    if os.path.exists(LOGO_PATH):
+        pdf.image(LOGO_PATH, x=10, y=8, h=14)
+    pdf.set_font('Helvetica', 'B', 16)
+    pdf.cell(0, 8, 'RECEIVING TBS', align='C', new_x='LMARGIN', new_y='NEXT')
+    pdf.set_font('Helvetica', '', 11)
+    pdf.cell(0, 6, _text(header['document_no']), align='C', new_x='LMARGIN', new_y='NEXT')
+    pdf.ln(8)
+
+    left = [('Partner', header['partner_id']), ('Journal', header['journal_id']),
+            ('Date Order', header['date_order']), ('Officers', header['officers']),
+            ('Created', header['timestamp'])]
+    right = [('Driver', header['driver_name']), ('Vehicle No', header['vehicle_no']),
+             ('Destination', header['destination_warehouse_id']), ('Branch', header['branch_id']),
+             ('Description', header['keterangan_description'])]
+    pdf.set_font('Helvetica', '', 9)
+    for (left_label, left_value), (right_label, right_value) in zip(left, right):
+        pdf.set_font('Helvetica', 'B', 9)
+        pdf.cell(30, 6, left_label)
+        pdf.set_font('Helvetica', '', 9)
+        pdf.cell(108, 6, _text(left_value))
+        pdf.set_font('Helvetica', 'B', 9)
+        pdf.cell(30, 6, right_label)
+        pdf.set_font('Helvetica', '', 9)
+        pdf.cell(0, 6, _text(right_value), new_x='LMARGIN', new_y='NEXT')
+    pdf.ln(4)
+
+    pdf.set_font('Helvetica', 'B', 8)
+    pdf.set_fill_color(230, 230, 230)
+    for title, width, _ in TABLE:
+        pdf.cell(width, 7, title, border=1, align='C', fill=True)
+    pdf.ln()
+    pdf.set_font('Helvetica', '', 8)
+    for number, line in enumerate(lines, 1):
+        for title, width, value in TABLE:
+            text = str(number) if value is None else _text(value(line))
+            pdf.cell(width, 6, text, border=1, align='L' if title in ('Product', 'Incoming', 'Outgoing') else 'R')
+        pdf.ln()
+
+    totals = {
+        'Brutto (kg)': _number(sum(line['qty_brutto'] or 0 for line in lines)),
+        'Tara (kg)': _number(sum(line['qty_tara'] or 0 for line in lines)),
+        'Netto (kg)': _number(sum(line['qty_netto'] or 0 for line in lines)),
+        'Sort (kg)': _number(sum(line['sortation_weight'] or 0 for line in lines)),
+        'Netto2 (kg)': _number(sum(_netto2(line) or 0 for line in lines)),
+        'Value (Rp)': _number(sum((_netto2(line) or 0) * (line['price_unit'] or 0) for line in lines), 0),
+    }
+    pdf.set_font('Helvetica', 'B', 8)
+    pdf.cell(TABLE[0][1] + TABLE[1][1], 7, 'TOTAL', border=1, fill=True)
+    for title, width, _ in TABLE[2:]:
+        pdf.cell(width, 7, totals.get(title, ''), border=1, align='R', fill=True)
+    pdf.ln(20)
+
+    pdf.set_font('Helvetica', '', 9)
+    for label in ('Officer', 'Driver', 'Received by'):
+        pdf.cell(90, 6, label, align='C')
+    pdf.ln(22)
+    for name in (header['officers'], header['driver_name'], ''):
+        pdf.cell(90, 6, f"( {_text(name) if name else ' ' * 30} )", align='C')
+    return bytes(pdf.output())
+
+
+def _write(path, data):
+    # Rename into place so concurrent readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def render_to_cache(slip):
+    """Render a ``(header, lines)`` slip into the cache; runs in pool processes."""
+    header, lines = slip
+    path = cache_path(header['document_no'], header['timestamp'])
+    _write(path, render_slip(header, lines))
+    return path
+
+
+def load_slips(conn, ids):
+    """``{id: (header, lines)}`` for the given receiving_tbs ids."""
+    slips = {}
+    for start in range(0, len(ids), _CHUNK):
+        chunk = ids[start:start + _CHUNK]
+        placeholders = ', '.join('?' * len(chunk))
+        for row in conn.execute(f"SELECT {', '.join(HEADER_COLUMNS)} FROM receiving_tbs WHERE id IN ({placeholders})",
+                                chunk):
+            slips[row[0]] = (dict(zip(HEADER_COLUMNS, row)), [])
+        for row in conn.execute(f"SELECT {', '.join(LINE_COLUMNS)} FROM order_line "
+                                f"WHERE receiving_tbs_id IN ({placeholders}) ORDER BY receiving_tbs_id, id", chunk):
+            slips[row[0]][1].append(dict(zip(LINE_COLUMNS, row)))
+    return slips
+
+
+def slip_path(conn, tbs_id):
+    """Cached PDF of one transaction as ``(document_no, path)``, rendering it if needed; None if unknown."""
+    row = conn.execute('SELECT document_no, timestamp FROM receiving_tbs WHERE id = ?', (tbs_id,)).fetchone()
+    if row is None:
+        return None
+    path = cache_path(row[0], row[1])
+    if not os.path.exists(path):
+        render_to_cache(load_slips(conn, [tbs_id])[tbs_id])
+    return row[0], path
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # spawn: forking a worker that runs the log writer and ingest threads is not safe
+            _pool = concurrent.futures.ProcessPoolExecutor(PACK_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+atexit.register(_shutdown_pool)
+
+
+def render_missing(conn, rows):
+    """Render every ``(id, document_no, timestamp)`` row without a cached slip; returns how many were rendered."""
+    missing = [row[0] for row in rows if not os.path.exists(cache_path(row[1], row[2]))]
+    for start in range(0, len(missing), _CHUNK):
+        slips = list(load_slips(conn, missing[start:start + _CHUNK]).values())
+        if PACK_WORKERS <= 1 or len(missing) < _POOL_THRESHOLD:
+            for slip in slips:
+                render_to_cache(slip)
+            continue
+        try:
+            list(_get_pool().map(render_to_cache, slips, chunksize=max(1, len(slips) // (PACK_WORKERS * 4))))
+        except concurrent.futures.process.BrokenProcessPool as e:
+            print(f"PDF pool failed, rendering inline: {e}")
+            _shutdown_pool()
+            for slip in slips:
+                render_to_cache(slip)
+    return len(missing)
+
+
+def build_pack(conn, clauses, params):
+    """ZIP of the slips matching ``clauses`` as an open temporary file positioned at the start.
+
+    Raises ValueError when more than ``PACK_LIMIT`` transactions match.
+    """
+    sql = 'SELECT id, document_no, timestamp FROM receiving_tbs'
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    rows = conn.execute(sql + ' ORDER BY timestamp, id LIMIT ?', list(params) + [PACK_LIMIT + 1]).fetchall()
+    if len(rows) > PACK_LIMIT:
+        raise ValueError(f"More than {PACK_LIMIT} transactions in this range; narrow the dates")
+    render_missing(conn, rows)
+
+    output = tempfile.TemporaryFile(suffix='.zip')
+    # PDF streams are already compressed
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as pack:
+        for _, document_no, timestamp in rows:
+            pack.write(cache_path(document_no, timestamp), filename(document_no))
+    output.seek(0)
+    return output
+
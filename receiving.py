@@ -0,0 +1,188 @@
+"""Validation and persistence of receiving TBS orders.
+
+Shared by the single-ticket create endpoint and the batch endpoint. Orders are
+validated one by one against the schema in validation.py, then every valid
+order is written in a single transaction: one block of document numbers, one
+``executemany`` for the headers and one for all of their order lines.
+Original payloads are stored as compressed blobs (see payloads.py).
+"""
+import datetime
+
+import db
+import document_numbers
+import jsonutil
+import payloads
+import validation
+
+INSERT_HEADER_SQL = '''
+    INSERT INTO receiving_tbs
+    (document_no, timestamp, partner_id, journal_id, date_order, officers,
+     keterangan_description, driver_name, vehicle_no, destination_warehouse_id, branch_id,
+     date_order_epoch, line_count, total_netto, total_value, payload_hash)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+INSERT_LINE_SQL = '''
+    INSERT INTO order_line
+    (receiving_tbs_id, product_code, qty_brutto, qty_tara, qty_netto, product_uom,
+     sortation_percent, sortation_weight, qty_netto2, price_unit, product_qty,
+     incoming_date, outgoing_date, incoming_epoch, outgoing_epoch)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# SQLite's default limit on host parameters is 999 on older builds
+_LOOKUP_CHUNK = 500
+
+
+def error(message, code=400):
+    return {"code": code, "message": message}
+
+
+def insert_orders(conn, prepared, now=None):
+    """Insert prepared orders inside the caller's transaction.
+
+    ``prepared`` is a list of ``((header, lines), payload_text)`` pairs.
+    Returns the allocated document numbers in the same order.
+    """
+    if not prepared:
+        return []
+    now = now or datetime.datetime.now()
+    timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
+    numbers = document_numbers.allocate(conn, len(prepared), now)
+    hashes = payloads.store(conn, [payload for _, payload in prepared])
+
+    conn.executemany(INSERT_HEADER_SQL, [
+        (document_no, timestamp) + header + (payload_hash,)
+        for document_no, ((header, _), _), payload_hash in zip(numbers, prepared, hashes)
+    ])
+
+    # executemany does not expose lastrowid; map numbers back via the unique index
+    ids = {}
+    for start in range(0, len(numbers), _LOOKUP_CHUNK):
+        chunk = numbers[start:start + _LOOKUP_CHUNK]
+        placeholders = ', '.join('?' * len(chunk))
+        ids.update((no, tbs_id) for tbs_id, no in conn.execute(
+            f'SELECT id, document_no FROM receiving_tbs WHERE document_no IN ({placeholders})', chunk))
+
+    conn.executemany(INSERT_LINE_SQL, [
+        (ids[document_no],) + line
+        for document_no, ((_, lines), _) in zip(numbers, prepared)
+        for line in lines
+    ])
+    return numbers
+
+
+def create_orders(entries):
+    """Validate and store ``(order, payload)`` entries in one transaction.
+
+    Returns one result per entry: ``{"index", "code", "document_no"}`` for
+    stored orders or ``{"index", "code", "message", "errors"}`` for rejected
+    ones, where ``message`` is the first of the ``errors``.
+    """
+    results = [None] * len(entries)
+    prepared = []
+    positions = []
+    serialized = {}
+
+    for index, (order, payload) in enumerate(entries):
+        values, errors = validation.validate_order(order, f'order_data[{index}]')
+        if errors:
+            results[index] = dict(error(errors[0]['message']), index=index, errors=errors)
+            continue
+        # Orders from the same ticket share one serialized payload
+        key = id(payload)
+        if key not in serialized:
+            serialized[key] = payloads.dumps(payload)
+        prepared.append((values, serialized[key]))
+        positions.append(index)
+
+    if prepared:
+        with db.transaction() as conn:
+            numbers = insert_orders(conn, prepared)
+        for index, document_no in zip(positions, numbers):
+            results[index] = {"index": index, "code": 200, "document_no": document_no}
+
+    return results
+
+
+def create_response(order_data, data):
+    """Create the orders of one create request; returns ``(response, code)``.
+
+    A single order answers with its document number or validation errors,
+    several orders with a batch summary. Used by the create endpoint and by
+    the ingest queue workers, so queued tickets end with the same response.
+    """
+    results = create_orders([(order, data) for order in order_data])
+
+    if len(results) == 1:
+        result = results[0]
+        if result['code'] != 200:
+            response = {"code": result['code'], "message": result['message'], "errors": result['errors']}
+            return response, result['code']
+        return {
+            "code": 200,
+            "message": "Receiving TBS created successfully.",
+            "result": {
+                "document_no": result['document_no']
+            }
+        }, 200
+
+    return batch_response(results)
+
+
+def batch_response(results):
+    created = sum(1 for r in results if r['code'] == 200)
+    failed = len(results) - created
+    if not failed:
+        code, message = 200, "Receiving TBS created successfully."
+    elif created:
+        code, message = 207, f"{created} of {len(results)} orders created."
+    else:
+        code, message = 400, "No orders were created."
+    return {
+        "code": code,
+        "message": message,
+        "result": {
+            "created": created,
+            "failed": failed,
+            "orders": results
+        }
+    }, code
+
+def parse_batch(text):
+    """Parse a batch body: a JSON array, a single JSON object, or NDJSON.
+
+    Each item may be a full create payload (``{"params": {"order_data": [...]}}``)
+    or a bare order. Returns ``(entries, token)`` where entries are
+    ``(order, payload)`` pairs; raises ValueError on malformed input.
+    """
+    text = text.strip()
+    if not text:
+        raise ValueError("Empty request body")
+
+    if text[0] == '[':
+        items = jsonutil.loads(text)
+    else:
+        try:
+            items = [jsonutil.loads(text)]
+        except ValueError:
+            items = None
+    if items is None:
+        items = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if line.strip():
+                try:
+                    items.append(jsonutil.loads(line))
+                except ValueError as e:
+                    raise ValueError(f"Invalid JSON on line {number}: {e}")
+
+    entries = []
+    token = None
+    for item in items:
+        if isinstance(item, dict) and 'params' in item:
+            token = token or item.get('token')
+            order_data = (item.get('params') or {}).get('order_data') or []
+            entries.extend((order, item) for order in order_data)
+        else:
+            entries.append((item, item))
+    return entries, token
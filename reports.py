@@ -0,0 +1,240 @@
+"""Tonnage, sortation and value reports over receiving TBS order lines.
+
+Order lines are read with their header columns in chunks of
+``SAGAPI_REPORT_CHUNK_ROWS`` and reduced with pandas groupby sums as they
+arrive. Only the per-group partial sums are kept between chunks, so memory
+depends on the chunk size and the number of groups, not on the number of
+lines in the range. Averages are carried as sum and count and divided at the
+end.
+
+Chunks are cut at ticket boundaries (the rows of a chunk's last ticket wait
+for the next chunk), so distinct tickets per group can be summed across
+chunks too.
+
+Results are memoized per (report, basis, start, end). Receiving TBS data is
+write-once, so a result stays valid until a new order line arrives: each
+entry remembers ``MAX(order_line.id)`` and is recomputed when it grows. A
+range on the ``created`` basis cannot grow once a ticket stamped after its end
+has been stored, and is not checked again. Reports are computed one at a time per process, which keeps
+the memory budget fixed under concurrent requests.
+"""
+import os
+import threading
+import time
+
+import numpy
+import pandas
+
+import exports
+from cache import TTLCache
+
+CHUNK_ROWS = int(os.environ.get('SAGAPI_REPORT_CHUNK_ROWS', 50000))
+
+# Summed per group; qty_netto2 falls back to qty_netto as on the slips
+MEASURES = ('qty_brutto', 'qty_tara', 'qty_netto', 'sortation_weight', 'qty_netto2', 'value',
+            'sortation_sum', 'sortation_count')
+
+# (SQL expression, counts days since 1970) of the report day per date basis
+DAY_COLUMNS = {
+    'created': ('substr(r.timestamp, 1, 10)', False),
+    'order': ('r.date_order_epoch / 86400', True),
+    'incoming': ('ol.incoming_epoch / 86400', True),
+    'outgoing': ('ol.outgoing_epoch / 86400', True),
+}
+
+KEY_COLUMNS = {
+    'partner_id': 'r.partner_id',
+    'branch_id': 'r.branch_id',
+    'destination_warehouse_id': 'r.destination_warehouse_id',
+    'product_code': 'ol.product_code',
+}
+
+# name: (title, group keys, output columns)
+REPORTS = {
+    'daily-netto-partner': ('Daily netto per partner', ('day', 'partner_id'),
+                            ('tickets', 'lines', 'qty_netto', 'sortation_weight', 'qty_netto2')),
+    'netto-branch-warehouse': ('Netto per branch and destination warehouse', ('branch_id', 'destination_warehouse_id'),
+                               ('tickets', 'lines', 'qty_brutto', 'qty_tara', 'qty_netto', 'qty_netto2')),
+    'product': ('Tonnage, sortation and value per product code', ('product_code',),
+                ('tickets', 'lines', 'qty_netto', 'qty_netto2', 'sortation_percent_avg', 'value')),
+    'sortation-partner': ('Sortation per partner', ('partner_id',),
+                          ('tickets', 'lines', 'qty_netto', 'sortation_weight', 'sortation_percent_avg',
+                           'sortation_percent_weighted')),
+    'daily-value': ('Daily value totals', ('day',),
+                    ('tickets', 'lines', 'qty_netto2', 'value', 'price_avg')),
+}
+
+results = TTLCache(maxsize=int(os.environ.get('SAGAPI_REPORT_CACHE_SIZE', 64)),
+                   ttl=float(os.environ.get('SAGAPI_REPORT_CACHE_TTL', 3600)))
+
+_compute_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {'computed': 0, 'rows_scanned': 0, 'compute_ms_last': 0.0, 'compute_ms_max': 0.0, 'stale': 0}
+
+
+def columns(name):
+    _, keys, outputs = REPORTS[name]
+    return list(keys) + list(outputs)
+
+
+def _query(keys, basis, start, end):
+    clauses, params = exports.date_clause('order_line', basis, start, end)
+    day, _ = DAY_COLUMNS[basis]
+    selects = [f'{day} AS day' if key == 'day' else f'{KEY_COLUMNS[key]} AS {key}' for key in keys]
+    sql = f'''
+        SELECT ol.receiving_tbs_id, {', '.join(selects)}, ol.qty_brutto, ol.qty_tara, ol.qty_netto,
+               ol.sortation_percent, ol.sortation_weight, ol.qty_netto2, ol.price_unit
+        FROM order_line ol JOIN receiving_tbs r ON r.id = ol.receiving_tbs_id
+    '''
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    return sql + ' ORDER BY ol.receiving_tbs_id', params
+
+
+def _read_chunks(conn, sql, params):
+    """Frames of whole tickets, each at most about ``CHUNK_ROWS`` lines."""
+    dtype = {column: 'float64' for column in ('qty_brutto', 'qty_tara', 'qty_netto', 'sortation_percent',
+                                              'sortation_weight', 'qty_netto2', 'price_unit')}
+    carry = None
+    for frame in pandas.read_sql_query(sql, conn, params=params, chunksize=CHUNK_ROWS, dtype=dtype):
+        if frame.empty:
+            continue
+        if carry is not None:
+            frame = pandas.concat([carry, frame], ignore_index=True)
+        tickets = frame['receiving_tbs_id'].to_numpy()
+        tail = tickets == tickets[-1]
+        carry = frame[tail]
+        if not tail.all():
+            yield frame[~tail]
+    if carry is not None and len(carry):
+        yield carry
+
+
+def _reduce(frame, keys):
+    """Per-group partial sums of one chunk."""
+    netto2 = frame['qty_netto2'].to_numpy()
+    netto2 = numpy.where(numpy.nan_to_num(netto2) != 0, netto2, frame['qty_netto'].to_numpy())
+    sortation = frame['sortation_percent'].to_numpy()
+    frame = frame.assign(
+        qty_netto2=netto2,
+        value=netto2 * frame['price_unit'].to_numpy(),
+        sortation_weight=frame['sortation_weight'].fillna(0.0),
+        sortation_sum=numpy.nan_to_num(sortation),
+        sortation_count=~numpy.isnan(sortation),
+    )
+    grouped = frame.groupby(list(keys), dropna=False, sort=False)
+    partial = grouped[list(MEASURES)].sum()
+    partial['lines'] = grouped.size()
+    partial['tickets'] = frame.drop_duplicates(list(keys) + ['receiving_tbs_id']).groupby(
+        list(keys), dropna=False, sort=False).size()
+    return partial
+
+
+def _combine(partials, keys):
+    return pandas.concat(partials).groupby(level=list(range(len(keys))), dropna=False, sort=False).sum()
+
+
+def compute(conn, name, basis='created', start='', end=''):
+    """Run report ``name`` over the lines in range; returns a DataFrame of ``columns(name)``."""
+    _, keys, outputs = REPORTS[name]
+    sql, params = _query(keys, basis, start, end)
+
+    totals = None
+    partials = []
+    pending = 0
+    scanned = 0
+    for frame in _read_chunks(conn, sql, params):
+        scanned += len(frame)
+        partial = _reduce(frame, keys)
+        partials.append(partial)
+        pending += len(partial)
+        # Fold partials into the totals once they hold as many groups as a chunk has rows
+        if pending >= CHUNK_ROWS:
+            totals = _combine(partials if totals is None else [totals] + partials, keys)
+            partials, pending = [], 0
+    if partials:
+        totals = _combine(partials if totals is None else [totals] + partials, keys)
+
+    if totals is None:
+        result = pandas.DataFrame(columns=list(keys) + list(outputs))
+    else:
+        result = _finish(totals.reset_index(), basis, keys, outputs)
+    with _stats_lock:
+        _stats['rows_scanned'] += scanned
+    return result
+
+
+def _finish(totals, basis, keys, outputs):
+    if 'day' in keys and DAY_COLUMNS[basis][1]:
+        # Epochs are wall-clock seconds counted as UTC (see dates.py)
+        days = pandas.to_datetime(totals['day'], unit='D', errors='coerce')
+        totals['day'] = days.dt.strftime('%Y-%m-%d').where(days.notna(), None)
+    netto = totals['qty_netto'].to_numpy()
+    netto2 = totals['qty_netto2'].to_numpy()
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        totals['sortation_percent_avg'] = totals['sortation_sum'] / totals['sortation_count'].replace(0, numpy.nan)
+        totals['sortation_percent_weighted'] = numpy.where(netto != 0, totals['sortation_weight'] / netto * 100, numpy.nan)
+        totals['price_avg'] = numpy.where(netto2 != 0, totals['value'] / netto2, numpy.nan)
+    result = totals[list(keys) + list(outputs)].sort_values(list(keys), na_position='last', ignore_index=True)
+    for column in outputs:
+        if column in ('tickets', 'lines'):
+            result[column] = result[column].astype('int64')
+        else:
+            result[column] = result[column].round(2)
+    return result
+
+
+def rows(frame):
+    """Plain Python tuples of a report, with None for missing values."""
+    for row in frame.astype(object).itertuples(index=False, name=None):
+        yield tuple(None if isinstance(value, float) and value != value else value for value in row)
+
+
+def _version(conn, basis, end):
+    if basis == 'created' and end:
+        # Tickets are stamped inside the write transaction, so once a committed
+        # ticket is stamped after ``end`` no later commit can fall in the range
+        newest = conn.execute('SELECT MAX(timestamp) FROM receiving_tbs').fetchone()[0]
+        if newest and newest[:10] > end:
+            return 'closed'
+    return conn.execute('SELECT MAX(id) FROM order_line').fetchone()[0]
+
+
+def run(conn, name, basis='created', start='', end=''):
+    """Memoized ``compute()``; raises ValueError for bad filters."""
+    exports.date_clause('order_line', basis, start, end)
+    key = (name, basis, start or '', end or '')
+    version = _version(conn, basis, end)
+    cached = results.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _compute_lock:
+        # Another request may have computed it while this one waited
+        cached = results.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        if cached is not None:
+            with _stats_lock:
+                _stats['stale'] += 1
+        started = time.perf_counter()
+        result = compute(conn, name, basis, start, end)
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        results.set(key, (version, result))
+    with _stats_lock:
+        _stats['computed'] += 1
+        _stats['compute_ms_last'] = elapsed_ms
+        _stats['compute_ms_max'] = max(_stats['compute_ms_max'], elapsed_ms)
+    return result
+
+
+def catalog():
+    return [{'name': name, 'title': title, 'keys': list(keys), 'columns': columns(name)}
+            for name, (title, keys, _) in REPORTS.items()]
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result['cache'] = results.stats()
+    result['chunk_rows'] = CHUNK_ROWS
+    return result
@@ -0,0 +1,254 @@
+"""Retention and archival of api_logs.
+
+api_logs keeps a hot window of ``RETENTION_DAYS`` days. ``apply()`` moves older
+rows, oldest first, into one archive per calendar month under ``ARCHIVE_DIR``:
+
+* ``sqlite``  ``api_logs_YYYY_MM.db`` holding api_logs and payload_blobs tables
+              with the same columns, ready to ATTACH for historical queries
+* ``ndjson``  ``api_logs_YYYY_MM.ndjson.gz``, one JSON object per row with the
+              request and response bodies as text
+
+Rows move in small batches, each in its own short write transaction, so the
+API and the log writer keep going during a large purge. A batch is copied
+before it is deleted: if the process dies in between, the next run copies it
+again (sqlite archives skip rows they already hold). Payload blobs left
+without any reference are removed with the rows. Dashboard rollups are history
+and are not touched.
+
+Freed pages go back to the filesystem through incremental VACUUM, also run in
+short steps.
+"""
+import datetime
+import glob
+import gzip
+import json
+import os
+
+import db
+import exports
+import payloads
+
+RETENTION_DAYS = int(os.environ.get('SAGAPI_LOG_RETENTION_DAYS', 30))
+ARCHIVE_DIR = os.environ.get('SAGAPI_ARCHIVE_DIR', 'archive')
+ARCHIVE_FORMAT = os.environ.get('SAGAPI_ARCHIVE_FORMAT', 'sqlite')
+BATCH_SIZE = int(os.environ.get('SAGAPI_RETENTION_BATCH_SIZE', 500))
+VACUUM_STEP_PAGES = int(os.environ.get('SAGAPI_VACUUM_STEP_PAGES', 2000))
+
+ARCHIVE_EXTENSIONS = {'sqlite': '.db', 'ndjson': '.ndjson.gz'}
+
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+# Keeps IN (...) lists under SQLite's host parameter limit
+_CHUNK = 500
+
+
+def cutoff_timestamp(days=None, now=None):
+    """Rows with a timestamp before this are outside the hot window."""
+    now = now or datetime.datetime.now()
+    days = RETENTION_DAYS if days is None else days
+    start = (now - datetime.timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return start.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def archive_path(month, fmt=None):
+    """Archive file for a 'YYYY-MM' month."""
+    fmt = fmt or ARCHIVE_FORMAT
+    return os.path.join(ARCHIVE_DIR, f"api_logs_{month.replace('-', '_')}{ARCHIVE_EXTENSIONS[fmt]}")
+
+
+def _next_month(month):
+    year, number = int(month[:4]), int(month[5:7])
+    return f'{year + number // 12:04d}-{number % 12 + 1:02d}'
+
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+def _oldest_month(conn, cutoff):
+    row = conn.execute('SELECT MIN(timestamp) FROM api_logs WHERE timestamp < ?', (cutoff,)).fetchone()
+    return row[0][:7] if row[0] else None
+
+
+# Archive targets
+def _attach_sqlite_archive(conn, path):
+    # ATTACH is not allowed inside a transaction; the archive stays attached for the whole month
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    conn.execute('CREATE TABLE IF NOT EXISTS archive.api_logs AS SELECT * FROM main.api_logs WHERE 0')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_api_logs_id ON api_logs (id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_api_logs_timestamp ON api_logs (timestamp, id)')
+    conn.execute('CREATE TABLE IF NOT EXISTS archive.payload_blobs AS SELECT * FROM main.payload_blobs WHERE 0')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_payload_blobs_hash ON payload_blobs (hash)')
+    return [row[1] for row in conn.execute('PRAGMA archive.table_info(api_logs)')]
+
+
+def _copy_to_sqlite(conn, ids, hashes, columns):
+    column_list = ', '.join(columns)
+    conn.execute(f'''
+        INSERT OR IGNORE INTO archive.api_logs ({column_list})
+        SELECT {column_list} FROM main.api_logs WHERE id IN ({_placeholders(ids)})
+    ''', ids)
+    for start in range(0, len(hashes), _CHUNK):
+        chunk = hashes[start:start + _CHUNK]
+        conn.execute(f'''
+            INSERT OR IGNORE INTO archive.payload_blobs
+            SELECT * FROM main.payload_blobs WHERE hash IN ({_placeholders(chunk)})
+        ''', chunk)
+
+
+def _copy_to_ndjson(conn, ids, path):
+    columns = exports.table_columns(conn, 'api_logs')
+    cursor = conn.execute(f'''
+        SELECT {', '.join(exports.select_expression('api_logs', c) for c in columns)}
+        FROM api_logs WHERE id IN ({_placeholders(ids)}) ORDER BY timestamp, id
+    ''', ids)
+    # Each batch appends one gzip member; readers see a single stream
+    with gzip.open(path, 'at', encoding='utf-8') as f:
+        for row in cursor:
+            f.write(json.dumps(dict(zip(columns, row))) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _move_month(conn, month, cutoff, fmt, batch_size, report):
+    upper = min(f'{_next_month(month)}-01', cutoff)
+    path = archive_path(month, fmt)
+    columns = _attach_sqlite_archive(conn, path) if fmt == 'sqlite' else None
+    moved = 0
+    try:
+        while True:
+            with db.transaction():
+                rows = conn.execute('''
+                    SELECT id, request_hash, response_hash FROM api_logs
+                    WHERE timestamp >= ? AND timestamp < ?
+                    ORDER BY timestamp, id LIMIT ?
+                ''', (f'{month}-01', upper, batch_size)).fetchall()
+                if not rows:
+                    break
+                ids = [row[0] for row in rows]
+                hashes = sorted({h for row in rows for h in row[1:] if h})
+
+                if fmt == 'sqlite':
+                    _copy_to_sqlite(conn, ids, hashes, columns)
+                else:
+                    _copy_to_ndjson(conn, ids, path)
+
+                conn.execute(f'DELETE FROM api_logs WHERE id IN ({_placeholders(ids)})', ids)
+                report['blobs_removed'] += payloads.release(conn, hashes)
+                moved += len(ids)
+    finally:
+        if fmt == 'sqlite':
+            conn.execute('DETACH DATABASE archive')
+
+    report['archived'] += moved
+    report['months'][month] = {'rows': moved, 'path': path}
+
+
+def apply(days=None, fmt=None, batch_size=None, now=None):
+    """Archive and delete api_logs rows older than the hot window.
+
+    Returns ``{"cutoff", "archived", "blobs_removed", "months"}``.
+    """
+    fmt = fmt or ARCHIVE_FORMAT
+    if fmt not in ARCHIVE_EXTENSIONS:
+        raise ValueError(f"Unknown archive format: {fmt}")
+    batch_size = min(batch_size or BATCH_SIZE, _CHUNK)
+    cutoff = cutoff_timestamp(days, now)
+    report = {'cutoff': cutoff, 'archived': 0, 'blobs_removed': 0, 'months': {}}
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    conn = db.get_connection()
+    month = _oldest_month(conn, cutoff)
+    while month:
+        _move_month(conn, month, cutoff, fmt, batch_size, report)
+        month = _oldest_month(conn, cutoff)
+    return report
+
+
+# Space reclamation
+def auto_vacuum_mode(conn=None):
+    conn = conn or db.get_connection()
+    return AUTO_VACUUM_MODES.get(conn.execute('PRAGMA auto_vacuum').fetchone()[0], 'unknown')
+
+
+def incremental_vacuum(step_pages=None, max_pages=None):
+    """Release free pages to the filesystem a step at a time.
+
+    Returns the number of pages released, or None when the database was
+    created without incremental auto-vacuum (see ``enable_incremental_vacuum``).
+    """
+    conn = db.get_connection()
+    if auto_vacuum_mode(conn) != 'incremental':
+        return None
+    step_pages = step_pages or VACUUM_STEP_PAGES
+    released = 0
+    while max_pages is None or released < max_pages:
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            break
+        step = min(step_pages, free) if max_pages is None else min(step_pages, free, max_pages - released)
+        with db.transaction():
+            conn.execute(f'PRAGMA incremental_vacuum({step})').fetchall()
+        released += step
+    return released
+
+
+def enable_incremental_vacuum():
+    """Switch an existing database to incremental auto-vacuum.
+
+    Needs one full VACUUM, which rewrites the file and holds the write lock
+    throughout: run it in a maintenance window.
+    """
+    conn = db.get_connection()
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('VACUUM')
+    return auto_vacuum_mode(conn)
+
+
+# Admin page
+def partition_stats(days=None):
+    """Sizes of the hot api_logs partitions, the database file and the archives."""
+    conn = db.get_connection()
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+    # Grouped over the (timestamp, id) index, never the table rows
+    hot = conn.execute('''
+        SELECT substr(timestamp, 1, 7), COUNT(*), MIN(timestamp), MAX(timestamp)
+        FROM api_logs GROUP BY 1 ORDER BY 1
+    ''').fetchall()
+    blob_count, blob_bytes, blob_raw = conn.execute(
+        'SELECT COUNT(*), COALESCE(SUM(length(data)), 0), COALESCE(SUM(size), 0) FROM payload_blobs').fetchone()
+
+    archives = []
+    for path in sorted(glob.glob(os.path.join(ARCHIVE_DIR, 'api_logs_*'))):
+        name = os.path.basename(path)
+        fmt = next((f for f, ext in ARCHIVE_EXTENSIONS.items() if name.endswith(ext)), None)
+        if fmt is None:
+            continue
+        stat = os.stat(path)
+        archives.append({
+            'name': name,
+            'format': fmt,
+            'month': name[len('api_logs_'):len('api_logs_') + 7].replace('_', '-'),
+            'bytes': stat.st_size,
+            'modified': datetime.datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
+        })
+
+    return {
+        'retention_days': RETENTION_DAYS if days is None else days,
+        'cutoff': cutoff_timestamp(days),
+        'archive_dir': ARCHIVE_DIR,
+        'archive_format': ARCHIVE_FORMAT,
+        'database': {
+            'path': db.DB_PATH,
+            'bytes': page_size * page_count,
+            'free_bytes': page_size * free_pages,
+            'auto_vacuum': auto_vacuum_mode(conn),
+        },
+        'hot': [{'month': month, 'rows': rows, 'oldest': oldest, 'newest': newest}
+                for month, rows, oldest, newest in hot],
+        'blobs': {'count': blob_count, 'bytes': blob_bytes, 'raw_bytes': blob_raw},
+        'archives': archives,
+    }
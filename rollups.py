@@ -0,0 +1,210 @@
+"""Incrementally maintained counters behind the dashboard.
+
+Triggers on api_logs and receiving_tbs bump per-hour, per-day and all-time
+buckets as rows are written, broken down by endpoint and site (api_logs) or
+branch (receiving_tbs). The dashboard reads a handful of small rollup rows
+instead of scanning the base tables, so its cost does not grow with history.
+
+Rollups are history: deleting base rows (retention, cleanup) does not change
+them. ``rebuild()`` therefore recomputes api_logs hour and day buckets only
+from the oldest day still in api_logs; older days, whose rows retention has
+archived, keep their counters. All-time totals are the sum of the day buckets.
+"""
+import datetime
+
+import dates
+import db
+
+# (granularity, bucket expression over the row's 'YYYY-MM-DD HH:MM:SS' timestamp)
+GRANULARITIES = (
+    ('hour', 'substr({row}.timestamp, 1, 13)'),
+    ('day', 'substr({row}.timestamp, 1, 10)'),
+    ('all', "''"),
+)
+
+
+def create_schema(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='api_log_rollups'")
+    existed = cursor.fetchone() is not None
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_log_rollups (
+            granularity TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            site TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            success INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket, endpoint, site)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS receiving_tbs_rollups (
+            granularity TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            branch_id TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket, branch_id)
+        ) WITHOUT ROWID
+    ''')
+
+    create_triggers(cursor)
+
+    if not existed:
+        _rebuild(cursor)
+
+
+def create_triggers(cursor):
+    log_upserts = ''.join(f'''
+            INSERT INTO api_log_rollups (granularity, bucket, endpoint, site, total, success, failed)
+            VALUES ('{name}', {bucket.format(row='new')}, new.endpoint, COALESCE(new.site, ''), 1,
+                    new.response_code = 200, new.response_code != 200)
+            ON CONFLICT (granularity, bucket, endpoint, site) DO UPDATE SET
+                total = total + 1, success = success + excluded.success, failed = failed + excluded.failed;'''
+        for name, bucket in GRANULARITIES)
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS api_logs_rollup_ai AFTER INSERT ON api_logs BEGIN{log_upserts}
+        END
+    ''')
+
+    tbs_upserts = ''.join(f'''
+            INSERT INTO receiving_tbs_rollups (granularity, bucket, branch_id, total)
+            VALUES ('{name}', {bucket.format(row='new')}, new.branch_id, 1)
+            ON CONFLICT (granularity, bucket, branch_id) DO UPDATE SET total = total + 1;'''
+        for name, bucket in GRANULARITIES)
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS receiving_tbs_rollup_ai AFTER INSERT ON receiving_tbs BEGIN{tbs_upserts}
+        END
+    ''')
+
+
+def _rebuild(cursor):
+    # Retention deletes whole days before its cutoff, so the oldest day left is complete
+    cursor.execute('SELECT substr(MIN(timestamp), 1, 10) FROM api_logs')
+    since = cursor.fetchone()[0]
+    if since:
+        # Hour buckets ('YYYY-MM-DD HH') of that day sort after the day itself too
+        cursor.execute("DELETE FROM api_log_rollups WHERE granularity IN ('hour', 'day') AND bucket >= ?",
+                       (since,))
+        for name, bucket in GRANULARITIES:
+            if name == 'all':
+                continue
+            cursor.execute(f'''
+                INSERT INTO api_log_rollups (granularity, bucket, endpoint, site, total, success, failed)
+                SELECT '{name}', {bucket.format(row='l')}, l.endpoint, COALESCE(l.site, ''), COUNT(*),
+                       SUM(l.response_code = 200), SUM(l.response_code != 200)
+                FROM api_logs l
+                GROUP BY 2, 3, 4
+            ''')
+    cursor.execute("DELETE FROM api_log_rollups WHERE granularity = 'all'")
+    cursor.execute('''
+        INSERT INTO api_log_rollups (granularity, bucket, endpoint, site, total, success, failed)
+        SELECT 'all', '', endpoint, site, SUM(total), SUM(success), SUM(failed)
+        FROM api_log_rollups WHERE granularity = 'day'
+        GROUP BY endpoint, site
+    ''')
+
+    # receiving_tbs rows are never deleted
+    cursor.execute('DELETE FROM receiving_tbs_rollups')
+    for name, bucket in GRANULARITIES:
+        cursor.execute(f'''
+            INSERT INTO receiving_tbs_rollups (granularity, bucket, branch_id, total)
+            SELECT '{name}', {bucket.format(row='r')}, r.branch_id, COUNT(*)
+            FROM receiving_tbs r
+            GROUP BY 2, 3
+        ''')
+    return since
+
+
+def rebuild():
+    """Recompute the rollups that the base tables still cover.
+
+    Returns the first api_logs day recomputed (None when api_logs is empty);
+    earlier hour and day buckets are kept as they are.
+    """
+    with db.transaction() as conn:
+        return _rebuild(conn.cursor())
+
+
+def dashboard_stats(conn, start='', end='', days=7, hours=24):
+    """Counters, per-day chart data and breakdowns for the dashboard.
+
+    Without a range the counters are all-time and the chart and breakdowns
+    cover the last ``days`` days. With ``start``/``end`` (YYYY-MM-DD) all of
+    them are limited to those days, summed from the per-day buckets. The
+    hourly series always covers the last ``hours`` hours, including empty ones.
+    """
+    cursor = conn.cursor()
+
+    if start or end:
+        lower, upper = dates.day_range(start, end)
+        bucket_clause = 'bucket >= ? AND bucket < ?'
+        bucket_params = [lower.strftime('%Y-%m-%d') if lower else '',
+                         upper.strftime('%Y-%m-%d') if upper else '9999']
+        totals_clause, totals_params = f"granularity = 'day' AND {bucket_clause}", bucket_params
+    else:
+        bucket_clause = "bucket >= DATE('now', ?)"
+        bucket_params = [f'-{days} days']
+        totals_clause, totals_params = "granularity = 'all'", []
+
+    cursor.execute(f'''
+        SELECT COALESCE(SUM(total), 0), COALESCE(SUM(success), 0), COALESCE(SUM(failed), 0)
+        FROM api_log_rollups WHERE {totals_clause}
+    ''', totals_params)
+    total_requests, success_requests, failed_requests = cursor.fetchone()
+
+    cursor.execute(f'SELECT COALESCE(SUM(total), 0) FROM receiving_tbs_rollups WHERE {totals_clause}',
+                   totals_params)
+    total_tbs = cursor.fetchone()[0]
+
+    cursor.execute(f'''
+        SELECT bucket, SUM(total), SUM(success)
+        FROM api_log_rollups
+        WHERE granularity = 'day' AND {bucket_clause}
+        GROUP BY bucket
+        ORDER BY bucket
+    ''', bucket_params)
+    daily_stats = cursor.fetchall()
+
+    cursor.execute(f'''
+        SELECT endpoint, SUM(total), SUM(success), SUM(failed)
+        FROM api_log_rollups
+        WHERE granularity = 'day' AND {bucket_clause}
+        GROUP BY endpoint
+        ORDER BY SUM(total) DESC
+    ''', bucket_params)
+    endpoint_stats = cursor.fetchall()
+
+    cursor.execute(f'''
+        SELECT site, SUM(total), SUM(success), SUM(failed)
+        FROM api_log_rollups
+        WHERE granularity = 'day' AND {bucket_clause} AND site != ''
+        GROUP BY site
+        ORDER BY SUM(total) DESC
+    ''', bucket_params)
+    site_stats = cursor.fetchall()
+
+    # Timestamps are local wall-clock time (see dates.py)
+    now = datetime.datetime.now()
+    hour_buckets = [(now - datetime.timedelta(hours=offset)).strftime('%Y-%m-%d %H')
+                    for offset in range(hours - 1, -1, -1)]
+    cursor.execute('''
+        SELECT bucket, SUM(total), SUM(success)
+        FROM api_log_rollups
+        WHERE granularity = 'hour' AND bucket >= ?
+        GROUP BY bucket
+    ''', (hour_buckets[0],))
+    counted = {bucket: (total, success) for bucket, total, success in cursor.fetchall()}
+    hourly_stats = [(bucket,) + counted.get(bucket, (0, 0)) for bucket in hour_buckets]
+
+    return {
+        'total_requests': total_requests,
+        'success_requests': success_requests,
+        'failed_requests': failed_requests,
+        'total_tbs': total_tbs,
+        'daily_stats': daily_stats,
+        'hourly_stats': hourly_stats,
+        'endpoint_stats': endpoint_stats,
+        'site_stats': site_stats,
+    }
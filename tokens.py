@@ -0,0 +1,211 @@
+"""Issued API tokens: storage, rotation, revocation and cached validation.
+
+``/api/auth/login`` issues an access/refresh pair. Only SHA-256 digests of the
+tokens are stored, in ``api_tokens``, together with their expiry and the
+family (one login session) they belong to. Refreshing rotates the pair: the old
+refresh and access tokens are revoked and a new pair joins the same family.
+Presenting a refresh token that was already rotated revokes the whole family.
+
+``validate()`` runs on every API request. Lookups are kept in a per-worker
+TTL/LRU cache, so a token is read from SQLite once and then checked in memory.
+Unknown tokens go to a separate, smaller cache with a short TTL, so a flood of
+made-up tokens cannot push live ones out of the main cache.
+Revocation bumps a generation counter in ``token_generation``; each worker
+rereads it at most every ``GENERATION_CHECK_SECONDS`` and drops its cache when
+it moved, so revoking in one gunicorn worker reaches the others within that
+interval without a query per request.
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+import db
+from cache import TTLCache
+
+ACCESS_TOKEN_TTL = int(os.environ.get('SAGAPI_ACCESS_TOKEN_TTL', 24 * 3600))
+REFRESH_TOKEN_TTL = int(os.environ.get('SAGAPI_REFRESH_TOKEN_TTL', 30 * 24 * 3600))
+GENERATION_CHECK_SECONDS = float(os.environ.get('SAGAPI_TOKEN_GENERATION_CHECK_S', 1.0))
+
+# digest -> (login, database, expires_at) of live access tokens
+_cache = TTLCache(maxsize=int(os.environ.get('SAGAPI_TOKEN_CACHE_SIZE', 10000)),
+                  ttl=float(os.environ.get('SAGAPI_TOKEN_CACHE_TTL', 60)))
+# digests of unknown or revoked tokens
+_misses = TTLCache(maxsize=int(os.environ.get('SAGAPI_TOKEN_MISS_CACHE_SIZE', 1000)),
+                   ttl=float(os.environ.get('SAGAPI_TOKEN_MISS_CACHE_TTL', 5)))
+
+_generation_lock = threading.Lock()
+_generation = {'value': None, 'checked': 0.0}
+
+
+def create_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_tokens (
+            token_hash TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            family TEXT NOT NULL,
+            login TEXT NOT NULL,
+            database TEXT NOT NULL,
+            issued_at INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            revoked_at INTEGER
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_tokens_family ON api_tokens (family)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_api_tokens_expires ON api_tokens (expires_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS token_generation (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO token_generation (id, value) VALUES (1, 0)')
+
+
+def digest(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def _insert_pair(conn, family, login, database, now):
+    access_token = str(uuid.uuid4())
+    refresh_token = str(uuid.uuid4())
+    conn.executemany('''
+        INSERT INTO api_tokens (token_hash, kind, family, login, database, issued_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (digest(access_token), 'access', family, login, database, now, now + ACCESS_TOKEN_TTL),
+        (digest(refresh_token), 'refresh', family, login, database, now, now + REFRESH_TOKEN_TTL),
+    ])
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "expires_in": ACCESS_TOKEN_TTL,
+    }
+
+
+def issue(login, database):
+    """Store and return a new access/refresh pair for a fresh login."""
+    with db.transaction() as conn:
+        return _insert_pair(conn, str(uuid.uuid4()), login, database, int(time.time()))
+
+
+def refresh(refresh_token):
+    """Rotate a refresh token into a new pair; returns None if it is not valid.
+
+    Reuse of an already rotated refresh token revokes its whole family.
+    """
+    now = int(time.time())
+    with db.transaction() as conn:
+        row = conn.execute('''
+            SELECT family, login, database, expires_at, revoked_at FROM api_tokens
+            WHERE token_hash = ? AND kind = 'refresh'
+        ''', (digest(refresh_token),)).fetchone()
+        if row is None:
+            return None
+        family, login, database, expires_at, revoked_at = row
+        if revoked_at is not None:
+            _revoke_family(conn, family, now)
+            return None
+        if expires_at <= now:
+            return None
+        _revoke_family(conn, family, now)
+        return _insert_pair(conn, family, login, database, now)
+
+
+def _revoke_family(conn, family, now):
+    cursor = conn.execute('UPDATE api_tokens SET revoked_at = ? WHERE family = ? AND revoked_at IS NULL',
+                          (now, family))
+    if cursor.rowcount:
+        _bump_generation(conn)
+    return cursor.rowcount
+
+
+def _bump_generation(conn):
+    conn.execute('UPDATE token_generation SET value = value + 1 WHERE id = 1')
+    # This worker sees its own revocations immediately
+    with _generation_lock:
+        _generation['checked'] = 0.0
+    _cache.clear()
+
+
+def revoke(token=None, login=None):
+    """Revoke the family of ``token`` or every token of ``login``; returns tokens revoked."""
+    now = int(time.time())
+    with db.transaction() as conn:
+        if token is not None:
+            row = conn.execute('SELECT family FROM api_tokens WHERE token_hash = ?', (digest(token),)).fetchone()
+            return _revoke_family(conn, row[0], now) if row else 0
+        cursor = conn.execute('UPDATE api_tokens SET revoked_at = ? WHERE login = ? AND revoked_at IS NULL',
+                              (now, login))
+        if cursor.rowcount:
+            _bump_generation(conn)
+        return cursor.rowcount
+
+
+def _check_generation():
+    now = time.monotonic()
+    if now - _generation['checked'] < GENERATION_CHECK_SECONDS:
+        return
+    with _generation_lock:
+        if now - _generation['checked'] < GENERATION_CHECK_SECONDS:
+            return
+        value = db.get_connection().execute('SELECT value FROM token_generation WHERE id = 1').fetchone()[0]
+        if value != _generation['value']:
+            _cache.clear()
+            _misses.clear()
+            _generation['value'] = value
+        _generation['checked'] = now
+
+
+def _lookup(token_hash):
+    row = db.get_connection().execute('''
+        SELECT login, database, expires_at FROM api_tokens
+        WHERE token_hash = ? AND kind = 'access' AND revoked_at IS NULL
+    ''', (token_hash,)).fetchone()
+    return tuple(row) if row else None
+
+
+def validate(token):
+    """Return ``{"login", "database"}`` for a live access token, else None."""
+    if not token:
+        return None
+    _check_generation()
+    token_hash = digest(token)
+    entry = _cache.get(token_hash)
+    if entry is None:
+        if _misses.get(token_hash):
+            return None
+        entry = _lookup(token_hash)
+        if entry is None:
+            _misses.set(token_hash, True)
+            return None
+        _cache.set(token_hash, entry)
+    if entry[2] <= time.time():
+        return None
+    return {"login": entry[0], "database": entry[1]}
+
+
+def bearer_token(header):
+    """Token from an ``Authorization`` header, with or without the Bearer scheme."""
+    if not header:
+        return None
+    scheme, _, value = header.strip().partition(' ')
+    if scheme.lower() == 'bearer':
+        return value.strip() or None
+    return header.strip()
+
+
+def purge_expired(now=None):
+    """Delete tokens that expired; returns how many rows went."""
+    now = int(now or time.time())
+    with db.transaction() as conn:
+        return conn.execute('DELETE FROM api_tokens WHERE expires_at <= ?', (now,)).rowcount
+
+
+def stats():
+    result = _cache.stats()
+    result['negative'] = _misses.stats()
+    result['generation'] = _generation['value']
+    result['generation_check_s'] = GENERATION_CHECK_SECONDS
+    return result
@@ -0,0 +1,188 @@
+"""Declarative schema for receiving TBS orders, checked in a single pass.
+
+``ORDER_SCHEMA`` and ``LINE_SCHEMA`` list every field once: whether it is
+required, how it is coerced and the message agents see when it is wrong. They
+are compiled at import into flat tuples, and ``validate_order()`` walks an
+order and all of its lines once, coercing values as it goes. It reports every
+problem, each with its path (``order_data[0].order_line[2].qty_brutto``),
+instead of stopping at the first one, and on success returns the header and
+line values ready for ``receiving.INSERT_HEADER_SQL`` / ``INSERT_LINE_SQL``.
+"""
+import dates
+
+DATE_MESSAGE = "Please provide the correct incoming date and outgoing date."
+NUMERIC_MESSAGE = "Order line quantities and prices must be numeric"
+
+
+class Field:
+    """One payload field.
+
+    ``kind`` is ``'text'`` (a string or number, stored as sent), ``'number'``
+    (coerced to float; numeric strings are accepted) or ``'integer'``.
+    ``default`` is used when an optional field is absent; ``default_from``
+    names a field of the same object to copy instead. ``message`` replaces the
+    generic missing/invalid messages.
+    """
+
+    def __init__(self, kind='text', required=True, default=None, default_from=None, message=None):
+        self.kind = kind
+        self.required = required
+        self.default = default
+        self.default_from = default_from
+        self.message = message
+
+
+# Header fields, checked and stored in this order
+ORDER_SCHEMA = (
+    ('partner_id', Field(message="Sorry, we couldn't find a valid partner with the information provided.")),
+    ('journal_id', Field()),
+    ('date_order', Field()),
+    ('officers', Field()),
+    ('keterangan_description', Field(required=False, default='')),
+    ('driver_name', Field(message="Missing Driver Name. Please fill in this information.")),
+    ('vehicle_no', Field()),
+    ('destination_warehouse_id', Field()),
+    ('branch_id', Field()),
+)
+
+# Line fields in the order they are checked: dates first, as the original API
+# reported them before anything else
+LINE_SCHEMA = (
+    ('incoming_date', Field(message=DATE_MESSAGE)),
+    ('outgoing_date', Field(message=DATE_MESSAGE)),
+    ('product_code', Field()),
+    ('qty_brutto', Field('number')),
+    ('qty_tara', Field('number')),
+    ('qty_netto', Field('number')),
+    ('product_uom', Field()),
+    ('sortation_percent', Field('number', required=False, default=0)),
+    ('sortation_weight', Field('number', required=False, default=0)),
+    ('qty_netto2', Field('number', required=False, default_from='qty_netto')),
+    ('price_unit', Field('number')),
+    ('product_qty', Field('integer')),
+)
+
+# Storage order, as in receiving.INSERT_HEADER_SQL / INSERT_LINE_SQL
+ORDER_COLUMNS = tuple(name for name, _ in ORDER_SCHEMA)
+LINE_COLUMNS = ('product_code', 'qty_brutto', 'qty_tara', 'qty_netto', 'product_uom',
+                'sortation_percent', 'sortation_weight', 'qty_netto2', 'price_unit', 'product_qty',
+                'incoming_date', 'outgoing_date')
+
+
+def _compile(schema, columns, missing_message):
+    """Flatten a schema into ``(position, name, kind, required, default, default_from,
+    missing, invalid)`` tuples, in checking order."""
+    compiled = []
+    for name, field in schema:
+        missing = field.message or missing_message.format(name=name)
+        if field.message:
+            invalid = field.message
+        elif field.kind == 'text':
+            invalid = f"{name} must be text"
+        else:
+            invalid = NUMERIC_MESSAGE
+        compiled.append((columns.index(name), name, field.kind, field.required, field.default,
+                         field.default_from, missing, invalid))
+    return tuple(compiled)
+
+
+_ORDER_FIELDS = _compile(ORDER_SCHEMA, ORDER_COLUMNS, "Missing required field: {name}")
+_LINE_FIELDS = _compile(LINE_SCHEMA, LINE_COLUMNS, "Missing required order line field: {name}")
+
+# Positions used for the header totals and epochs
+_DATE_ORDER = ORDER_COLUMNS.index('date_order')
+_QTY_NETTO2 = LINE_COLUMNS.index('qty_netto2')
+_PRICE_UNIT = LINE_COLUMNS.index('price_unit')
+_INCOMING_DATE = LINE_COLUMNS.index('incoming_date')
+_OUTGOING_DATE = LINE_COLUMNS.index('outgoing_date')
+
+
+def _coerce(value, kind):
+    """Coerced value, or None when it is not usable for ``kind``."""
+    if isinstance(value, bool):
+        return None
+    if kind == 'text':
+        return value if isinstance(value, (str, int, float)) else None
+    if kind == 'integer':
+        if isinstance(value, int):
+            return value
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        return int(number) if number.is_integer() else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _check(obj, fields, path, errors):
+    values = [None] * len(fields)
+    for position, name, kind, required, default, default_from, missing, invalid in fields:
+        value = obj.get(name)
+        if value is None or value == '':
+            if required:
+                errors.append({"path": f"{path}.{name}", "message": missing})
+                continue
+            if default_from and any(error['path'] == f"{path}.{default_from}" for error in errors):
+                # The source field is already reported; its copy would only repeat that error
+                continue
+            value = obj.get(default_from) if default_from else default
+            if value is None:
+                continue
+        coerced = _coerce(value, kind)
+        if coerced is None:
+            errors.append({"path": f"{path}.{name}", "message": invalid})
+        values[position] = coerced
+    return values
+
+
+def order_data_of(data, path='params.order_data'):
+    """``(order_data, errors)`` of a create payload: its non-empty list of orders, or why it has none."""
+    params = data.get('params') if isinstance(data, dict) else None
+    order_data = params.get('order_data') if isinstance(params, dict) else None
+    if order_data is None or order_data == []:
+        return None, [{"path": path, "message": "order_data is required"}]
+    if not isinstance(order_data, list):
+        return None, [{"path": path, "message": "order_data must be a list of orders"}]
+    return order_data, []
+
+
+def validate_order(order, path='order'):
+    """Validate and coerce one order.
+
+    Returns ``((header, lines), [])`` on success or ``(None, errors)`` where
+    each error is ``{"path", "message"}``.
+    """
+    if not isinstance(order, dict):
+        return None, [{"path": path, "message": "Each order must be a JSON object"}]
+
+    errors = []
+    header = _check(order, _ORDER_FIELDS, path, errors)
+
+    order_lines = order.get('order_line')
+    lines = []
+    if not order_lines or not isinstance(order_lines, list):
+        errors.append({"path": f"{path}.order_line", "message": "At least one order line is required"})
+    else:
+        for number, line in enumerate(order_lines):
+            line_path = f"{path}.order_line[{number}]"
+            if not isinstance(line, dict):
+                errors.append({"path": line_path, "message": "Each order line must be a JSON object"})
+                continue
+            lines.append(_check(line, _LINE_FIELDS, line_path, errors))
+
+    if errors:
+        return None, errors
+
+    header.append(dates.to_epoch(header[_DATE_ORDER]))
+    total_netto = 0.0
+    total_value = 0.0
+    for values in lines:
+        total_netto += values[_QTY_NETTO2] or 0
+        total_value += (values[_QTY_NETTO2] or 0) * values[_PRICE_UNIT]
+        values.append(dates.to_epoch(values[_INCOMING_DATE]))
+        values.append(dates.to_epoch(values[_OUTGOING_DATE]))
+    header.extend((len(lines), total_netto, total_value))
+    return (tuple(header), [tuple(values) for values in lines]), []